@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""A local daemon that keeps rmx warm between invocations.
+
+`rmx agent start` launches a server listening on a unix socket. `rmx.cli:main` forwards each command
+(together with its cwd, environment and stdio file descriptors) to the agent, which forks an already
+initialized copy of itself to run it. This way, each command skips the Python startup and imports, and
+starts with the configs, manifests and file lists the agent has already parsed.
+The agent also holds a session on the ssh master connection (see SSHMaster) of every machine it has seen,
+so that the master does not time out and commands never pay for the ssh handshake.
+An agent started from another version of rmx (e.g., before `pip install -U`) exits on the first request,
+and the client starts a new one.
+"""
+from __future__ import annotations
+import os
+import sys
+import json
+import struct
+from os.path import expandvars
+
+from rmx import logger
+
+AGENT_SOCKET = expandvars('$HOME/.rmx/agent.sock')
+AGENT_PIDFILE = expandvars('$HOME/.rmx/agent.pid')
+AGENT_LOGFILE = expandvars('$HOME/.rmx/agent.log')
+
+# How often the agent checks the master connections and reloads the files that changed
+KEEPALIVE_INTERVAL = 30
+
+_HEADER = struct.Struct('!I')
+
+
+def get_stamp() -> str:
+    """Identifies the installed rmx: its version and the last modification of its modules."""
+    from glob import glob
+    from rmx._version import __version__
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    mtime = max(os.stat(path).st_mtime_ns for path in glob(f'{package_dir}/**/*.py', recursive=True))
+    return f'{__version__}:{mtime}'
+
+
+def forward(args: list[str], socket_path: str = AGENT_SOCKET, fds: list[int] | None = None,
+            pidfile: str = AGENT_PIDFILE) -> int | None:
+    """Run the command on the agent and return its exit code.
+
+    Returns None if the agent is not running (or RMX_NO_AGENT is set); the caller should run the command by itself.
+    An agent of another rmx installation exits instead of running the command; a new one is started in its place.
+    """
+    import array
+    import signal
+    import socket
+    if os.environ.get('RMX_NO_AGENT') or not os.path.exists(socket_path):
+        return None
+
+    if fds is None:
+        try:
+            fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        payload = json.dumps({'args': args, 'cwd': os.getcwd(), 'env': dict(os.environ),
+                              'stamp': get_stamp()}).encode('utf-8')
+        sock.sendmsg([_HEADER.pack(len(payload))], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+        sock.sendall(payload)
+
+        reader = sock.makefile('r')
+        line = reader.readline()
+        if not line:
+            return None
+        reply = json.loads(line)
+        if reply.get('stale'):
+            logger.info('Restarting the rmx agent, which runs another version of rmx.')
+            start(socket_path, pidfile, wait=False)
+            return None
+        pid = reply['pid']
+
+        # The command runs in another process, so pass the signals on to it (e.g., Ctrl-C or terminal resizes)
+        def _forward_signal(signum, frame):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+        for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGWINCH]:
+            signal.signal(sig, _forward_signal)
+
+        line = reader.readline()
+        if not line:
+            logger.error('The rmx agent exited before the command finished.')
+            return 1
+        return json.loads(line)['exit']
+
+
+def is_running(pidfile: str = AGENT_PIDFILE) -> int | None:
+    """Returns the pid of the agent if it is running."""
+    try:
+        with open(pidfile, 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (FileNotFoundError, ValueError, ProcessLookupError, PermissionError):
+        return None
+    return pid
+
+
+def start(socket_path: str = AGENT_SOCKET, pidfile: str = AGENT_PIDFILE, logfile: str = AGENT_LOGFILE,
+          timeout: float = 10., wait: bool = True) -> int:
+    """Launch the agent in the background and wait until it accepts connections (unless wait is False)."""
+    import time
+    import subprocess
+    pid = is_running(pidfile)
+    if pid is not None:
+        return pid
+
+    os.makedirs(os.path.dirname(logfile), exist_ok=True)
+    with open(logfile, 'a') as log:
+        proc = subprocess.Popen([sys.executable, '-m', 'rmx.agent', socket_path, pidfile],
+                                stdin=subprocess.DEVNULL, stdout=log, stderr=log, cwd='/', start_new_session=True)
+    if not wait:
+        return proc.pid
+
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f'The rmx agent failed to start. See {logfile}')
+        if os.path.exists(socket_path) and is_running(pidfile) == proc.pid:
+            return proc.pid
+        time.sleep(0.05)
+    raise RuntimeError(f'The rmx agent did not start in {timeout} seconds. See {logfile}')
+
+
+def stop(pidfile: str = AGENT_PIDFILE) -> int | None:
+    import signal
+    pid = is_running(pidfile)
+    if pid is not None:
+        os.kill(pid, signal.SIGTERM)
+    return pid
+
+
+def _preload():
+    """Import everything that commands may need, so that forked processes don't have to."""
+    import importlib
+    for module in ['docker', 'python_on_whales', 'simple_slurm_command',
+                   'pyjson5', 'dotenv', 'rmx.cli', 'rmx.cli.run', 'rmx.cli.sync', 'rmx.runner', 'rmx.config']:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning(f'Failed to preload {module}: {e}')
+
+
+class StaleAgent(Exception):
+    """The request came from another rmx installation than the agent's"""
+
+
+class AgentServer:
+    def __init__(self, socket_path: str = AGENT_SOCKET, pidfile: str = AGENT_PIDFILE) -> None:
+        self.socket_path = socket_path
+        self.pidfile = pidfile
+        self.sock = None
+        self.stamp = get_stamp()
+        # {base_uri: a long-running ssh session on the master connection}
+        self._holders = {}
+        # The pids of the forked commands that are not reaped yet
+        self._workers = set()
+        self._cleaned_up = False
+
+    def serve(self):
+        import signal
+        import socket
+        _preload()
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # NOTE: The socket is created with the permissions from umask; only the user may connect from the start
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        self.sock.settimeout(KEEPALIVE_INTERVAL)
+        with open(self.pidfile, 'w') as f:
+            f.write(str(os.getpid()))
+
+        def _terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, _terminate)
+
+        logger.info(f'rmx agent (pid {os.getpid()}) is listening on {self.socket_path}')
+        try:
+            while True:
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    self._reap()
+                    self._keepalive()
+                    continue
+                self._reap()
+                try:
+                    self._handle(conn)
+                except StaleAgent:
+                    logger.info('Exiting, since rmx has been updated.')
+                    return
+                except Exception as e:
+                    logger.error(f'Failed to handle a request: {e}')
+                finally:
+                    conn.close()
+        finally:
+            self._cleanup()
+
+    def _receive(self, conn) -> tuple[dict, list[int]]:
+        import array
+        import socket
+        fds = array.array('i')
+        msg, ancdata, _, _ = conn.recvmsg(_HEADER.size, socket.CMSG_SPACE(3 * fds.itemsize))
+        for level, type_, data in ancdata:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+        length, = _HEADER.unpack(msg)
+        payload = b''
+        while len(payload) < length:
+            chunk = conn.recv(length - len(payload))
+            if not chunk:
+                raise ConnectionError('Connection closed while receiving a request')
+            payload += chunk
+        return json.loads(payload.decode('utf-8')), list(fds)
+
+    def _handle(self, conn):
+        request, fds = self._receive(conn)
+        try:
+            if request.get('stamp') != self.stamp:
+                # NOTE: Remove the socket and pidfile before replying, so that the client can start a new agent
+                self._cleanup()
+                conn.sendall((json.dumps({'stale': True}) + '\n').encode('utf-8'))
+                raise StaleAgent
+            if len(fds) != 3:
+                raise ValueError(f'Expected the stdio file descriptors, received {len(fds)}')
+            machine_names = self._warm(request)
+            # NOTE: The agent never starts threads. Only the forking thread survives in the child,
+            # so a lock held by another thread at this moment would stay locked there forever.
+            pid = os.fork()
+            if pid == 0:
+                self._run_child(conn, request, fds)  # never returns
+            self._workers.add(pid)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        logger.info(f'[{pid}] rmx {" ".join(request["args"])}')
+
+        # Keep the connections of the machines in use alive (the child is already running)
+        for base_uri in machine_names:
+            self._hold(base_uri)
+
+    def _run_child(self, conn, request, fds):
+        code = 1
+        try:
+            self.sock.close()
+            for holder in list(self._holders.values()):
+                if holder.stdin is not None:
+                    holder.stdin.close()
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            sys.stdin = open(0, 'r', closefd=False)
+            sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1, closefd=False)
+            sys.stderr = open(2, 'w', buffering=1, closefd=False)
+            from rmx import handler
+            handler.setStream(sys.stderr)
+
+            import signal
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            conn.sendall((json.dumps({'pid': os.getpid()}) + '\n').encode('utf-8'))
+
+            from rmx.cli import core
+            try:
+                core(request['args'])
+                code = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    code = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    code = 1
+            except KeyboardInterrupt:
+                code = 130
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall((json.dumps({'exit': code}) + '\n').encode('utf-8'))
+        finally:
+            os._exit(code)
+
+    def _warm(self, request) -> list[str]:
+        """Parse the config of the project in request['cwd'] and reload the manifests and file lists of the project
+        for the machines in the command, so that the forked process inherits them
+        (parse_config and load_json_cached reuse what they parsed while the files are unchanged).
+
+        The cwd and environment of the request are passed explicitly; the agent itself stays in its own.
+        Returns the base_uri of the machines in the command.
+        """
+        from pathlib import Path
+        from rmx.helpers import find_project_root, parse_config
+        from rmx.cli._config_loader import REMOTE_ROOT_DIR, Machine
+        from rmx.filelist import FileListBuilder
+        from rmx.machine import RemoteConfig
+        from rmx.manifest import SyncManifest
+        try:
+            rootdir = find_project_root(cwd=request['cwd'])
+            config = parse_config(rootdir, env=request['env'])
+        except Exception as e:
+            logger.debug(f'Failed to load the config in {request["cwd"]}: {e}')
+            return []
+
+        # NOTE: We don't parse the arguments here; anything that looks like a configured machine (or group) is good enough
+        mconfs, groups = config.get('machines', {}), config.get('groups', {})
+        names = [name for arg in request['args'] for name in arg.split(',')]
+        names = [member for name in names for member in ([name] if name in mconfs else groups.get(name, []))]
+        machines = [Machine(RemoteConfig(mconfs[name]['user'], mconfs[name]['host']), name=name, parsed_conf=mconfs[name],
+                            rmxdir=mconfs[name].get('root_dir', f'{REMOTE_ROOT_DIR}/{mconfs[name]["user"]}/rmx'))
+                    for name in dict.fromkeys(names)
+                    if isinstance(mconfs.get(name), dict) and 'user' in mconfs[name] and 'host' in mconfs[name]]
+
+        # The same keys as `rmx sync` (see _get_sources); relative mount dirs are relative to the request's cwd
+        pconf = config.get('project', {})
+        project_name = pconf.get('name', rootdir.stem)
+        for machine in machines:
+            rmxdirs = machine.get_rmxdirs(project_name)
+            mount_dirs = machine.parsed_conf.get('mount', pconf.get('mount', []))
+            sources = [(rootdir, rmxdirs.codedir)] + [(Path(request['cwd'], mount_dir), rmxdirs.mountdir)
+                                                      for mount_dir in mount_dirs]
+            for source_dir, target_path in sources:
+                try:
+                    SyncManifest.for_target(source_dir, machine.uri(target_path))
+                    FileListBuilder(source_dir, exclude=pconf.get('exclude', []),
+                                    use_gitignore=pconf.get('use_gitignore', False))
+                except (OSError, ValueError):
+                    pass
+        return list(dict.fromkeys(machine.base_uri for machine in machines))
+
+    def _hold(self, base_uri):
+        """Keep a session open on the master connection to base_uri, so that it never times out.
+
+        The session is an ssh subprocess that opens the master by itself if needed (ControlMaster=auto),
+        thus the handshake does not block the accept loop.
+        """
+        import subprocess
+        from rmx.machine import SSHMaster
+        holder = self._holders.get(base_uri)
+        if holder is not None and holder.poll() is None:
+            return
+        master = SSHMaster(base_uri)
+        try:
+            os.makedirs(master.control_dir, mode=0o700, exist_ok=True)
+            # `cat` exits as soon as the agent goes away (EOF on stdin)
+            self._holders[base_uri] = subprocess.Popen(['ssh', *master.options, '-T', base_uri, 'cat > /dev/null'],
+                                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                                       stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logger.warning(f'Failed to hold the connection to {base_uri}: {e}')
+
+    def _keepalive(self):
+        for base_uri in list(self._holders):
+            self._hold(base_uri)
+
+    def _reap(self):
+        """Collect the exit status of finished commands.
+
+        NOTE: Only the forked commands are waited for; the holders are subprocess.Popen that wait for themselves.
+        """
+        for pid in list(self._workers):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+            self._workers.discard(pid)
+
+    def _cleanup(self):
+        if self._cleaned_up:
+            return
+        self._cleaned_up = True
+        for holder in list(self._holders.values()):
+            holder.stdin.close()
+        if self.sock is not None:
+            self.sock.close()
+        for path in [self.socket_path, self.pidfile]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+if __name__ == '__main__':
+    from logging import INFO
+    logger.setLevel(INFO)
+    AgentServer(*sys.argv[1:3]).serve()
@@ -7,8 +7,8 @@ import argparse
 
 
 def global_parser():
-    from . import run, sync, nv
-    commands = [run, sync, nv]
+    from . import run, sync, logs, status, wait, nv, agent
+    commands = [run, sync, logs, status, wait, nv, agent]
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -40,7 +40,7 @@ def global_parser():
 
         # NOTE: I don't particularly like this, but I follow how PDM handles (sub)commands.
         # This registers cmd.handler function as args.handler and it will be called later.
-        subp.set_defaults(handler=cmd.handler)
+        subp.set_defaults(handler=cmd.handler, multi_handler=getattr(cmd, 'multi_handler', None))
         name2subparser[cmd.name] = subp
     return parser
 
@@ -58,10 +58,27 @@ def core(args):
     if parsed.verbose:
         logger.setLevel(DEBUG)
 
+    # Commands that don't act on a machine (e.g., agent)
+    if 'machine' not in vars(parsed):
+        parsed.handler(parsed)
+        return
+
     # Load config and fuse it with parsed arguments
-    from ._config_loader import load_config
-    project, remote_conf, preset_conf = load_config(parsed.machine)
-    parsed.handler(project, remote_conf, parsed, preset_conf)
+    # NOTE: Commands with an optional machine (e.g., nv) act on all the machines by default.
+    # Groups of machines (see resolve_machine_names) are expanded and parsed.group is set.
+    from ._config_loader import resolve_machine_names, load_config, load_configs
+    machine_names, parsed.group = resolve_machine_names(parsed.machine)
+    if not machine_names:
+        parser.error('No machines are specified (or found in the configuration)')
+    # NOTE: A group goes to multi_handler even if it has a single machine (e.g., to spread a sweep over its GPUs)
+    if len(machine_names) > 1 or (parsed.group is not None and parsed.multi_handler is not None):
+        if parsed.multi_handler is None:
+            parser.error(f'This command does not support multiple machines: {parsed.machine}')
+        projects, machines, preset_conf = load_configs(machine_names)
+        parsed.multi_handler(projects, machines, parsed, preset_conf)
+    else:
+        project, remote_conf, preset_conf = load_config(machine_names[0])
+        parsed.handler(project, remote_conf, parsed, preset_conf)
 
 
 def main(args: list[str] | None = None) -> None:
@@ -69,4 +86,10 @@ def main(args: list[str] | None = None) -> None:
     Entrypoint for the CLI.
     Arguments are only for test (it is always None if calling via CLI).
     """
+    # Let the rmx agent run the command if it is running (see rmx.agent)
+    if args is None and sys.argv[1:] and sys.argv[1] != 'agent':
+        from rmx.agent import forward
+        code = forward(sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
     core(args)
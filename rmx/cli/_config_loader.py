@@ -18,15 +18,19 @@ DOCKER_ROOT_DIR = '/rmx'
 # to be his/hers, thus others trying to use it later cannot access it.
 REMOTE_ROOT_DIR = '/tmp'
 
+# The machine group that contains all the machines not in ssh mode (unless "groups" in the config defines it)
+AUTO_GROUP = 'auto'
+
 class Project:
     """Maintains the info specific to the local project"""
     def __init__(self, name, rootdir, outdir=None, exclude=None, startup: str = "", 
                  mount_dirs: dict | None = None, mount_from_host: dict | None = None,
-                 env: dict | None = None) -> None:
+                 env: dict | None = None, use_gitignore: bool = False) -> None:
         self.name = name
         self.rootdir = Path(rootdir)
         self.outdir = self.rootdir / ".output" if outdir is None else outdir
         self.exclude = exclude
+        self.use_gitignore = use_gitignore
         self.startup = startup
         self.env = env if env is not None else {}
         self.mount_dirs = mount_dirs if mount_dirs is not None else {}
@@ -52,12 +56,16 @@ class Machine:
     def __init__(self, remote_conf: RemoteConfig, rmxdir: str | Path,
                  parsed_conf: dict,
                  startup: str = "",
-                 env: dict | None = None) -> None:
+                 env: dict | None = None,
+                 name: str | None = None) -> None:
         self.remote_conf = remote_conf
+        self.name = name if name is not None else remote_conf.host
         self.rmxdir = Path(rmxdir)
         self.env = env if env is not None else {}
         self.startup = startup
         self.parsed_conf = parsed_conf
+        # NOTE: Unlike rmxdir, this stays put with --contain, so that `rmx logs` can find the runs
+        self.logdir = self.rmxdir / 'logs'
 
         # aliases
         self.user = remote_conf.user
@@ -76,6 +84,10 @@ class Machine:
             outdir=str(rootdir / 'output')
         )
 
+    def get_logdir(self, project_name: str) -> Path:
+        """The directory on the remote that keeps the output of the (disowned) runs of the project"""
+        return self.logdir / project_name
+
 
 def get_docker_rmxdirs(rmxdir: Path | str, project_name: str) -> Namespace:
         rootdir = Path(rmxdir) / project_name
@@ -86,22 +98,56 @@ def get_docker_rmxdirs(rmxdir: Path | str, project_name: str) -> Namespace:
         )
 
 
+def resolve_machine_names(spec: str | None) -> tuple[list[str], str | None]:
+    """Machine names from comma-separated machine or group names (all the machines if spec is None).
+
+    A group is either listed under "groups" in the configuration (e.g., "gpus": ["birch", "oak"]),
+    or "auto" that is all the machines not in ssh mode.
+    Returns the machine names and the name of the group (None if spec does not contain any).
+    """
+    config = parse_config(find_project_root())
+    machines, groups = config['machines'], config.get('groups', {})
+    if spec is None:
+        return list(machines.keys()), None
+
+    names, group = [], None
+    for name in [name.strip() for name in spec.split(',') if name.strip()]:
+        if name in machines:
+            names.append(name)
+        elif name in groups:
+            names += groups[name]
+            group = name
+        elif name == AUTO_GROUP:
+            names += [mname for mname, mconf in machines.items() if mconf.get('mode', 'ssh') != 'ssh']
+            group = name
+        else:
+            # NOTE: load_configs reports unknown machines
+            names.append(name)
+    return list(dict.fromkeys(names)), group
+
+
 def load_config(machine_name: str):
+    projects, machines, preset_conf = load_configs([machine_name])
+    return projects[0], machines[0], preset_conf
+
+
+def load_configs(machine_names: list[str]):
+    """Load the configurations for multiple machines at once.
+
+    Returns a list of Project (mount dirs can be overwritten per machine), a list of Machine and the preset config.
+    """
     proj_rootdir = find_project_root()
     config = parse_config(proj_rootdir)
 
-    if machine_name not in config['machines']:
-        raise KeyError(
-            f'Machine "{machine_name}" not found in the configuration. '
-            f'Available machines are: {" ".join(config["machines"].keys())}'
-        )
+    for machine_name in machine_names:
+        if machine_name not in config['machines']:
+            raise KeyError(
+                f'Machine "{machine_name}" not found in the configuration. '
+                f'Available machines are: {" ".join(config["machines"].keys())}'
+            )
 
     pconf = config.get('project', {})
 
-    if machine_name not in config['machines']:
-        raise KeyError(f'The specified machine {machine_name} is not found in the configuration file.')
-    mconf = config['machines'].get(machine_name)
-
     # Parse special config params
     preset_conf = {
         'slurm-configs': config.get('slurm-configs', {}),
@@ -112,14 +158,6 @@ def load_config(machine_name: str):
     logger.info(f'Project name     : {name}')
     logger.info(f'Project directory: {proj_rootdir}')
 
-    mount_dirs = pconf.get('mount', [])
-    mount_from_host = pconf.get('mount_from_host', {})
-
-    if 'mount' in mconf:
-        mount_dirs = mconf.get('mount', [])
-    if 'mount_from_host' in mconf:
-        mount_from_host = mconf.get('mount_from_host', {})
-
     # Load extra env vars from .env.secret
     secret_env_path = (proj_rootdir / ".secret.env").resolve()
     if not secret_env_path.is_file():
@@ -133,22 +171,38 @@ def load_config(machine_name: str):
     if secret_env:
         logger.debug(f'Loaded the following envs from secret env file: {dict(secret_env)}')
 
-    project_env = pconf.get('environment', {})
-    project = Project(name,
-                      proj_rootdir,
-                      outdir=pconf.get('outdir'),
-                      exclude=pconf.get('exclude', []),
-                      startup=pconf.get('startup', ""),
-                      env={**project_env, **secret_env},
-                      mount_dirs=mount_dirs,
-                      mount_from_host=mount_from_host)
-
-    user, host = mconf['user'], mconf['host']
-    remote_conf = RemoteConfig(user, host)
-
-    machine = Machine(remote_conf,
-                      parsed_conf=mconf,
-                      rmxdir=mconf.get('root_dir', f'{REMOTE_ROOT_DIR}/{remote_conf.user}/rmx'),
-                      env=mconf.get('environment', {}))
-
-    return project, machine, preset_conf
+    projects, machines = [], []
+    for machine_name in machine_names:
+        mconf = config['machines'].get(machine_name)
+
+        mount_dirs = pconf.get('mount', [])
+        mount_from_host = pconf.get('mount_from_host', {})
+
+        if 'mount' in mconf:
+            mount_dirs = mconf.get('mount', [])
+        if 'mount_from_host' in mconf:
+            mount_from_host = mconf.get('mount_from_host', {})
+
+        project_env = pconf.get('environment', {})
+        project = Project(name,
+                          proj_rootdir,
+                          outdir=pconf.get('outdir'),
+                          exclude=pconf.get('exclude', []),
+                          use_gitignore=pconf.get('use_gitignore', False),
+                          startup=pconf.get('startup', ""),
+                          env={**project_env, **secret_env},
+                          mount_dirs=mount_dirs,
+                          mount_from_host=mount_from_host)
+
+        user, host = mconf['user'], mconf['host']
+        remote_conf = RemoteConfig(user, host)
+
+        machine = Machine(remote_conf,
+                          name=machine_name,
+                          parsed_conf=mconf,
+                          rmxdir=mconf.get('root_dir', f'{REMOTE_ROOT_DIR}/{remote_conf.user}/rmx'),
+                          env=mconf.get('environment', {}))
+        projects.append(project)
+        machines.append(machine)
+
+    return projects, machines, preset_conf
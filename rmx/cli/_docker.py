@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Helpers to talk to the docker daemon on a machine."""
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from rmx import logger
+
+DEFAULT_DOCKER_SOCKET = '/var/run/docker.sock'
+
+
+def get_docker_client(machine):
+    """Returns a DockerClient for the docker daemon on machine, and its base_url.
+
+    The daemon socket is forwarded over the shared ssh connection (see SSHMaster),
+    rather than letting docker-py and the docker cli open ssh connections on their own.
+    """
+    from docker import DockerClient
+    docker_pconf = machine.parsed_conf.get('docker', {})
+    docker_socket = machine.remote_conf.get_master().forward_unix_socket(docker_pconf.get('socket', DEFAULT_DOCKER_SOCKET))
+    base_url = 'unix://' + docker_socket
+    # client = DockerClient(base_url="ssh://" + machine.base_uri, use_ssh_client=True)
+    client = DockerClient(base_url=base_url)  # dockerpty hangs with use_ssh_client=True
+    return client, base_url
+
+
+def get_preset_images(preset: dict) -> list[str]:
+    """The images listed under "docker-images" in the config."""
+    images = []
+    for entry in preset.get('docker-images', {}).values():
+        image = entry.get('name') if isinstance(entry, dict) else entry
+        if image:
+            images.append(image)
+    return images
+
+
+def ensure_images(machine, images: list[str]) -> list[str]:
+    """Pull the images that are not on machine yet. Returns the images that were pulled."""
+    import time
+    from docker.errors import ImageNotFound
+    client, _ = get_docker_client(machine)
+    pulled = []
+    for image in dict.fromkeys(images):
+        try:
+            client.images.get(image)
+            logger.debug(f'{machine.name}: image {image} is already there')
+            continue
+        except ImageNotFound:
+            pass
+        logger.info(f'{machine.name}: pulling image {image}...')
+        start = time.time()
+        client.images.pull(image)
+        logger.info(f'{machine.name}: pulled image {image} ({time.time() - start:.1f}s)')
+        pulled.append(image)
+    return pulled
+
+
+def prefetch_images(machine, images: list[str]) -> Future:
+    """Start pulling images on machine in the background (e.g., while syncing code).
+
+    Call `wait_prefetch` on the returned future before launching containers.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(ensure_images, machine, images)
+    future.machine = machine
+    executor.shutdown(wait=False)
+    return future
+
+
+def wait_prefetch(future: Future | None) -> None:
+    """Wait for prefetch_images to finish. Failures are only warned about, as docker pulls the image on launch anyway."""
+    if future is None:
+        return
+    try:
+        future.result()
+    except Exception as e:
+        logger.warning(f'{future.machine.name}: failed to pull the image in advance: {e}')
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Probe the GPUs, CPU load and memory of machines (used by `rmx nv`, and to spread sweeps over a machine group)."""
+from __future__ import annotations
+from rmx import logger
+from rmx.cli._config_loader import Machine
+
+# Seconds to wait for the ssh connection and for nvidia-smi (that can hang with a broken driver) on each machine
+PROBE_TIMEOUT = 10
+# A GPU counts as free if nothing runs on it and it is (almost) idle
+FREE_GPU_UTILIZATION = 10  # %
+FREE_GPU_MEMORY = 1024  # MiB
+
+_GPU_QUERY = 'index,uuid,name,memory.used,memory.total,utilization.gpu'
+
+
+def get_probe_cmd(timeout: int = PROBE_TIMEOUT) -> str:
+    """A single command that prints everything to probe, in sections that start with `rmx-<section>`
+
+    The `smi` section has the exit code of nvidia-smi (124 if it timed out), or nothing if it is not installed.
+    """
+    return ' ; '.join([
+        'echo rmx-gpu',
+        f'timeout {timeout} nvidia-smi --query-gpu={_GPU_QUERY} --format=csv,noheader,nounits 2>/dev/null',
+        'rmx_smi=$?',
+        'echo rmx-smi',
+        'command -v nvidia-smi >/dev/null 2>&1 && echo $rmx_smi',
+        'echo rmx-app',
+        f'timeout {timeout} nvidia-smi --query-compute-apps=gpu_uuid --format=csv,noheader 2>/dev/null',
+        'echo rmx-cpu',
+        'nproc',
+        'cat /proc/loadavg',
+        'echo rmx-mem',
+        "grep -E '^(MemTotal|MemAvailable):' /proc/meminfo",
+        'true',
+    ])
+
+
+def _to_number(value: str, dtype=float):
+    try:
+        return dtype(value.strip())
+    except ValueError:  # e.g., [N/A]
+        return None
+
+
+def parse_probe(stdout: str) -> dict:
+    """Parse the output of get_probe_cmd"""
+    sections = {}
+    lines = None
+    for line in stdout.splitlines():
+        if line.startswith('rmx-'):
+            lines = sections.setdefault(line[len('rmx-'):].strip(), [])
+        elif lines is not None and line.strip():
+            lines.append(line.strip())
+
+    num_procs = {}
+    for uuid in sections.get('app', []):
+        num_procs[uuid] = num_procs.get(uuid, 0) + 1
+    gpus = []
+    for line in sections.get('gpu', []):
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) != 6:
+            continue
+        index, uuid, name, memory_used, memory_total, utilization = fields
+        gpus.append({'index': _to_number(index, int), 'name': name, 'memory_used': _to_number(memory_used),
+                     'memory_total': _to_number(memory_total), 'utilization': _to_number(utilization),
+                     'num_procs': num_procs.get(uuid, 0)})
+
+    smi = sections.get('smi', [])
+    cpu = sections.get('cpu', [])
+    ncpus = _to_number(cpu[0], int) if cpu else None
+    load = _to_number(cpu[1].split()[0]) if len(cpu) > 1 else None
+    # NOTE: /proc/meminfo is in kB
+    mem = {line.split(':')[0]: _to_number(line.split(':')[1].split()[0]) for line in sections.get('mem', [])}
+    return {'gpus': gpus, 'nvidia_smi': _to_number(smi[0], int) if smi else None, 'ncpus': ncpus, 'load': load,
+            'mem_total': mem['MemTotal'] * 1024 if mem.get('MemTotal') else None,
+            'mem_available': mem['MemAvailable'] * 1024 if mem.get('MemAvailable') else None}
+
+
+def is_free_gpu(gpu: dict) -> bool:
+    return (not gpu['num_procs'] and (gpu['utilization'] or 0) < FREE_GPU_UTILIZATION
+            and (gpu['memory_used'] or 0) < FREE_GPU_MEMORY)
+
+
+def get_free_gpus(result: dict) -> list[int]:
+    return [gpu['index'] for gpu in result.get('gpus', []) if is_free_gpu(gpu)]
+
+
+def probe(machine: Machine, timeout: int = PROBE_TIMEOUT) -> dict:
+    """Probe a machine with a single ssh command. Failures are reported in result['error'] rather than raised.
+
+    A machine whose nvidia-smi fails (or hangs) is a failure too, rather than a machine without GPUs.
+    """
+    import time
+    from rmx.machine import SimpleSSHClient
+    try:
+        client = SimpleSSHClient(machine.remote_conf)
+        # NOTE: Each of the two nvidia-smi calls may take up to timeout
+        result = client.run(get_probe_cmd(timeout), hide=True, warn=True, in_stream=False, timeout=3 * timeout)
+        if result.exited != 0:
+            raise OSError(result.stderr.strip())
+        result = parse_probe(result.stdout)
+        if result['nvidia_smi'] == 124:
+            raise OSError(f'nvidia-smi timed out after {timeout} seconds')
+        elif result['nvidia_smi']:
+            raise OSError(f'nvidia-smi failed with exit code {result["nvidia_smi"]}')
+        return {**result, 'error': None, 'probed_at': time.time()}
+    except Exception as e:
+        logger.debug(f'Failed to probe {machine.name}: {e}')
+        return {'gpus': [], 'nvidia_smi': None, 'ncpus': None, 'load': None, 'mem_total': None,
+                'mem_available': None, 'error': str(e) or type(e).__name__, 'probed_at': time.time()}
+
+
+def probe_machines(machines: list[Machine], ttl: float = 30., timeout: int = PROBE_TIMEOUT,
+                   max_workers: int = 32) -> dict[str, dict]:
+    """Probe all the machines in parallel (thus it takes about a single round trip), unless probed within ttl seconds.
+
+    Returns {machine name: result} in the order of machines.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from rmx.store import ProbeCache
+    cache = ProbeCache(ttl=ttl)
+    results = cache.get([machine.name for machine in machines])
+    stale = [machine for machine in machines if machine.name not in results]
+    if stale:
+        logger.debug(f'Probing {len(stale)} machines: {" ".join(machine.name for machine in stale)}')
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stale)))) as executor:
+            probed = dict(zip([machine.name for machine in stale],
+                              executor.map(lambda machine: probe(machine, timeout), stale)))
+        # NOTE: sqlite connections cannot be shared across threads, thus the cache is only touched here.
+        # Failures are not cached so that the next call retries.
+        cache.put({name: result for name, result in probed.items() if result['error'] is None})
+        results.update(probed)
+    return {machine.name: results[machine.name] for machine in machines}
+
+
+def get_capacity(result: dict) -> int:
+    """How many more jobs a machine can take: its free GPUs, or its idle CPU cores if it has no GPUs"""
+    if result['error'] is not None:
+        return 0
+    if result['gpus']:
+        return len(get_free_gpus(result))
+    if result['ncpus'] is None or result['load'] is None:
+        return 0
+    return max(0, int(result['ncpus'] - result['load']))
+
+
+def _split(num: int, weights: list[float]) -> list[int]:
+    """Split num into integers proportional to weights (largest remainder). Evenly if all the weights are 0."""
+    if not weights:
+        return []
+    total = sum(weights)
+    if total <= 0:
+        weights, total = [1] * len(weights), len(weights)
+    quotas = [num * weight / total for weight in weights]
+    counts = [int(quota) for quota in quotas]
+    for i in sorted(range(len(weights)), key=lambda i: counts[i] - quotas[i])[:num - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def distribute_sweep(sweep_ind, capacities: dict[str, int], overflow: list[str] | None = None) -> dict[str, list[int]]:
+    """Split the sweep indices into contiguous shares {machine name: indices}.
+
+    The machines in capacities get up to their capacity (proportionally when there is more than enough room).
+    The indices that don't fit go to the machines in overflow (e.g., slurm clusters that queue them), or if there is
+    none, over the machines in capacities by their capacity. Machines without a share are left out.
+    """
+    sweep_ind = list(sweep_ind)
+    overflow = [name for name in overflow or [] if name not in capacities]
+    names = list(capacities)
+    num_fit = min(len(sweep_ind), sum(capacities.values()))
+    counts = dict(zip(names, _split(num_fit, [capacities[name] for name in names])))
+    num_over = len(sweep_ind) - num_fit
+    if num_over:
+        targets = overflow or names
+        weights = [1] * len(overflow) if overflow else [capacities[name] for name in names]
+        for name, count in zip(targets, _split(num_over, weights)):
+            counts[name] = counts.get(name, 0) + count
+
+    shares, begin = {}, 0
+    for name in [*names, *overflow]:
+        count = counts.get(name, 0)
+        if count:
+            shares[name] = sweep_ind[begin:begin + count]
+            begin += count
+    return shares
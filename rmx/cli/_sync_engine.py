@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Run many transfer streams (rsync or tar) concurrently and aggregate their stats."""
+from __future__ import annotations
+import os
+import re
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rmx import logger
+from rmx.cli._utils import rsync
+
+# Directories with fewer files / bytes than this to transfer go through a single rsync stream.
+SHARD_MIN_FILES = 2000
+SHARD_MIN_BYTES = 256 * 1024 * 1024
+
+_RSYNC_STATS_KEYS = {
+    'Number of files': 'num_files',
+    'Number of regular files transferred': 'files_transferred',
+    'Total file size': 'total_size',
+    'Total transferred file size': 'transferred_size',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+
+
+def parse_rsync_stats(stdout: str) -> dict:
+    """Parse the output of `rsync --stats` into a dict of integers."""
+    stats = {key: 0 for key in _RSYNC_STATS_KEYS.values()}
+    for line in stdout.splitlines():
+        if ':' not in line:
+            continue
+        label, value = line.split(':', 1)
+        key = _RSYNC_STATS_KEYS.get(label.strip())
+        if key is None:
+            continue
+        # e.g., "Total file size: 1,234,567 bytes" or "Number of files: 12 (reg: 10, dir: 2)"
+        match = re.match(r'\s*([\d,]+)', value)
+        if match:
+            stats[key] = int(match.group(1).replace(',', ''))
+    return stats
+
+
+def shard_files(files: list[str], sizes: dict, num_shards: int) -> list[list[str]]:
+    """Split files into at most num_shards lists of roughly equal total size (greedy, largest first)."""
+    num_shards = max(1, min(num_shards, len(files)))
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for path in sorted(files, key=lambda p: sizes.get(p, 0), reverse=True):
+        idx = loads.index(min(loads))
+        shards[idx].append(path)
+        loads[idx] += sizes.get(path, 0)
+    return [sorted(shard) for shard in shards if shard]
+
+
+def num_shards_for(files: list[str], sizes: dict, max_streams: int) -> int:
+    """Number of parallel streams worth using for a transfer of files."""
+    total_bytes = sum(sizes.get(path, 0) for path in files)
+    by_files = len(files) // SHARD_MIN_FILES
+    by_bytes = total_bytes // SHARD_MIN_BYTES
+    return max(1, min(max_streams, max(by_files, by_bytes)))
+
+
+class RsyncTask:
+    """A single rsync stream. See `rsync` for the meaning of the arguments."""
+    transport = 'rsync'
+
+    def __init__(self, source_dir, target_dir: str, label: str, options: str = '', exclude=None,
+                 transfer_rootdir: bool = True, files_from: list[str] | None = None,
+                 compression: str = 'zlib', ssh_command: str | None = None) -> None:
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+        self.label = label
+        self.options = options
+        self.exclude = exclude
+        self.transfer_rootdir = transfer_rootdir
+        self.files_from = files_from
+        self.compression = compression
+        self.ssh_command = ssh_command
+        self.done = False
+
+    def run(self, dry_run: bool = False) -> dict:
+        start = time.time()
+        out = rsync(source_dir=self.source_dir, target_dir=self.target_dir, options=self.options,
+                    exclude=self.exclude, dry_run=dry_run, transfer_rootdir=self.transfer_rootdir,
+                    files_from=self.files_from, compression=self.compression, ssh_command=self.ssh_command)
+        self.done = True
+        stats = parse_rsync_stats(out.stdout.decode('utf-8', 'ignore')) if out is not None else {}
+        stats['elapsed'] = time.time() - start
+        return stats
+
+
+# Commands to (de)compress a tar stream on each side
+TAR_COMPRESSORS = {
+    'zstd': ('zstd -q -c -T0 -3', 'zstd -q -d -c'),
+    'gzip': ('gzip -c -1', 'gzip -d -c'),
+}
+
+
+class TarTask:
+    """Pack files into a compressed tar stream locally and unpack it on the remote over a single SSH channel.
+
+    This is much faster than rsync for cold targets with many small files, since rsync
+    negotiates every file with the remote while the tar stream is just a pipe.
+    """
+    transport = 'tar'
+
+    def __init__(self, client, source_dir, target_path: str, label: str, files: list[str],
+                 transfer_rootdir: bool = True, compression: str = 'zstd', remote_dirs: list[str] = ()) -> None:
+        """remote_dirs: other directories to create on the remote (like the --rsync-path trick of the rsync streams)"""
+        self.client = client
+        self.source_dir = source_dir
+        self.target_path = target_path
+        self.files = files
+        self.transfer_rootdir = transfer_rootdir
+        self.compression = compression
+        self.label = label
+        self.remote_dirs = list(remote_dirs)
+        self.done = False
+
+    def run(self, dry_run: bool = False) -> dict:
+        import shlex
+        import subprocess
+        import tempfile
+        compress, decompress = TAR_COMPRESSORS[self.compression]
+
+        source_dir, files = str(self.source_dir).rstrip('/'), self.files
+        if self.transfer_rootdir:
+            prefix = os.path.basename(source_dir) + '/'
+            source_dir = os.path.dirname(source_dir) or '.'
+            files = [prefix + path for path in files]
+
+        target_path = shlex.quote(str(self.target_path))
+        mkdirs = ' '.join(shlex.quote(str(path)) for path in [*self.remote_dirs, self.target_path])
+        remote_cmd = f'mkdir -p {mkdirs} && {decompress} | tar -xf - -C {target_path}'
+        logger.debug(f'tar transfer: {source_dir} -> {remote_cmd}')
+        if dry_run:
+            return {}
+
+        start = time.time()
+        with tempfile.NamedTemporaryFile('w', prefix='rmx-tar-files-', delete=False) as f:
+            f.write('\0'.join(files))
+            files_from_path = f.name
+        # NOTE: stderr goes to a file, since a pipe that nobody reads until tar exits would block tar once it is full
+        with tempfile.TemporaryFile(prefix='rmx-tar-stderr-') as stderr:
+            try:
+                # NOTE: tar and the compressor are separate processes (not a shell pipeline) so that a failure of
+                # tar is not hidden by the exit status of the compressor.
+                # COPYFILE_DISABLE prevents macOS tar from adding AppleDouble (._*) files to the archive.
+                # --no-recursion: the directories in the list are empty ones (their ignored content stays local).
+                tar_proc = subprocess.Popen(['tar', '-C', source_dir, '--no-recursion', '--null', '-T', files_from_path,
+                                             '-cf', '-'],
+                                            stdout=subprocess.PIPE, stderr=stderr,
+                                            env={**os.environ, 'COPYFILE_DISABLE': '1'})
+                proc = subprocess.Popen(shlex.split(compress), stdin=tar_proc.stdout, stdout=subprocess.PIPE,
+                                        stderr=stderr)
+                tar_proc.stdout.close()
+                try:
+                    status, num_bytes, remote_stderr = self.client.pipe(remote_cmd, proc.stdout)
+                except Exception as e:
+                    # e.g., the master connection to the remote cannot be opened
+                    proc.kill()
+                    tar_proc.kill()
+                    raise OSError(f'The tar stream to the remote failed: {type(e).__name__}: {e}') from e
+                finally:
+                    proc.wait()
+                    tar_proc.wait()
+            finally:
+                os.remove(files_from_path)
+            stderr.seek(0)
+            local_stderr = stderr.read().decode('utf-8', 'ignore')
+
+        if tar_proc.returncode != 0 or proc.returncode != 0:
+            raise OSError(f'Failed to pack {source_dir}:\n{local_stderr}')
+        if status != 0:
+            raise OSError(f'Failed to unpack the tar stream on the remote ({remote_cmd}):\n{remote_stderr}')
+        self.done = True
+        return {'files_transferred': len(files), 'bytes_sent': num_bytes, 'elapsed': time.time() - start}
+
+
+def get_remote_compressors(client) -> set[str]:
+    """The compressors of TAR_COMPRESSORS available on the remote (checked once per host)."""
+    key = client.remote_conf.base_uri
+    with _remote_compressors_lock:
+        if key not in _remote_compressors:
+            check = ' ; '.join(f'command -v {name} >/dev/null 2>&1 && echo {name}' for name in TAR_COMPRESSORS)
+            result = client.run(f'{check} ; true', hide=True, warn=True, in_stream=False)
+            _remote_compressors[key] = set(result.stdout.split()) if result is not None and result.exited == 0 else set()
+        return _remote_compressors[key]
+
+
+def get_tar_compression(client, preferred: str | None = None) -> str | None:
+    """Pick the compressor for the tar transport: zstd if both sides have it, otherwise gzip.
+
+    Returns None if the remote has none of them (sync with rsync then).
+    """
+    if preferred is not None and preferred not in TAR_COMPRESSORS:
+        raise ValueError(f'Unknown tar_compression: {preferred}. Choose from {list(TAR_COMPRESSORS)}')
+    remote = get_remote_compressors(client)
+    available = [name for name in TAR_COMPRESSORS if name in remote and shutil.which(name) is not None]
+    if not available:
+        return None
+    if preferred is not None and preferred not in available:
+        logger.warning(f'{preferred} is not available on both sides. Falling back to {available[0]} for the tar transport.')
+        return available[0]
+    return preferred or available[0]
+
+
+_remote_compressors_lock = threading.Lock()
+_remote_compressors = {}
+
+
+class TransferStats:
+    """Aggregated stats over multiple rsync streams."""
+    def __init__(self) -> None:
+        self.streams = 0
+        self.files_transferred = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.start = time.time()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def add(self, stats: dict) -> None:
+        with self._lock:
+            self.streams += 1
+            self.files_transferred += stats.get('files_transferred', 0)
+            self.bytes_sent += stats.get('bytes_sent', 0)
+            self.bytes_received += stats.get('bytes_received', 0)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second over the wire (both directions)."""
+        return (self.bytes_sent + self.bytes_received) / max(self.elapsed, 1e-6)
+
+    def summary(self) -> str:
+        return (f'{self.files_transferred} files, {format_bytes(self.bytes_sent + self.bytes_received)} '
+                f'over {self.streams} streams in {self.elapsed:.1f}s ({format_bytes(self.throughput)}/s)')
+
+
+def format_bytes(num: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num) < 1024:
+            return f'{num:.1f}{unit}'
+        num /= 1024
+    return f'{num:.1f}TB'
+
+
+def run_sync_tasks(tasks: list, max_workers: int = 4, dry_run: bool = False) -> TransferStats:
+    """Run RsyncTask / TarTask in a bounded thread pool.
+
+    All tasks run to completion even if some of them fail; the failures (of any kind) are raised together as
+    an OSError afterwards.
+    """
+    stats = TransferStats()
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(task.run, dry_run): task for task in tasks}
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            task = futures[future]
+            try:
+                task_stats = future.result()
+            except Exception as e:
+                logger.error(f'[{num_done}/{len(tasks)}] {task.label} failed')
+                failures.append((task, e if isinstance(e, OSError) else f'{type(e).__name__}: {e}'))
+                continue
+            stats.add(task_stats)
+            num_bytes = task_stats.get('bytes_sent', 0) + task_stats.get('bytes_received', 0)
+            rate = num_bytes / max(task_stats.get('elapsed', 0), 1e-6)
+            logger.info(f'[{num_done}/{len(tasks)}] {task.label} via {task.transport}: '
+                        f'{task_stats.get("files_transferred", 0)} files, {format_bytes(num_bytes)} ({format_bytes(rate)}/s)')
+    stats.end = time.time()
+    if failures:
+        msg = '\n\n'.join(f'{task.label}:\n{e}' for task, e in failures)
+        raise OSError(f'{len(failures)} of {len(tasks)} transfer streams failed.\n{msg}')
+    return stats
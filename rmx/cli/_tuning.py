@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Pick rsync compression per machine based on a one-off measurement of the link and the local CPU.
+
+Compression only pays off when the link is slower than we can compress.
+On a fast LAN, or for already-compressed files (checkpoints, images, .npz), it just burns CPU.
+"""
+from __future__ import annotations
+import os
+import json
+import time
+import subprocess
+from os.path import expandvars
+from pathlib import Path
+from rmx import logger
+
+PROFILE_PATH = expandvars('$HOME/.rmx/link-profiles.json')
+PROFILE_TTL = 7 * 24 * 60 * 60  # seconds
+PROBE_SIZE = 8 * 1024 * 1024  # bytes
+
+DEFAULT_COMPRESSION = 'zlib'
+
+# Files that are already compressed. Compressing them again wastes CPU for (almost) no gain.
+SKIP_COMPRESS_EXTS = [
+    # archives
+    '7z', 'bz2', 'gz', 'lz4', 'rar', 'tgz', 'xz', 'zip', 'zst',
+    # images, audio and video
+    'avi', 'gif', 'jpeg', 'jpg', 'mkv', 'mov', 'mp3', 'mp4', 'ogg', 'png', 'webm', 'webp',
+    # ML artifacts
+    'ckpt', 'h5', 'npz', 'parquet', 'pt', 'pth', 'safetensors', 'sif', 'tfevents',
+]
+
+
+def get_rsync_version() -> tuple[int, ...] | None:
+    """Version of the local rsync, e.g., (3, 2, 7) (None if unknown). Checked once per process."""
+    global _rsync_version
+    if _rsync_version is None:
+        import re
+        import shutil
+        version = ()
+        if shutil.which('rsync') is not None:
+            out = subprocess.run(['rsync', '--version'], capture_output=True).stdout.decode('utf-8', 'ignore')
+            match = re.search(r'version\s+(\d+)\.(\d+)(?:\.(\d+))?', out)
+            if match:
+                version = tuple(int(val) for val in match.groups() if val is not None)
+        _rsync_version = version
+    return _rsync_version or None
+
+
+_rsync_version = None
+
+
+def compression_options(compression: str, rsync_version: tuple[int, ...] | None = None) -> str:
+    """rsync options for a compression mode: "none", "zlib", "zstd" or "zstd:<level>".
+
+    rsync_version: the local rsync version (checked if not given). Old rsyncs (e.g., 2.6.9 on macOS) only get
+    the bare --compress, since --skip-compress needs rsync >= 3.0 and --compress-choice needs rsync >= 3.2.
+    """
+    if compression not in ['none', 'zlib'] and not compression.startswith('zstd'):
+        raise ValueError(f'Unrecognized compression: {compression}. Choose from "none", "zlib", "zstd" or "zstd:<level>".')
+    _, _, level = compression.partition(':')
+    level_opt = f' --compress-level={int(level)}' if level else ''
+    if compression == 'none':
+        return ''
+    rsync_version = rsync_version or get_rsync_version() or (0,)
+    if rsync_version < (3, 0):
+        return '--compress'
+    skip = f"--skip-compress={'/'.join(SKIP_COMPRESS_EXTS)}"
+    if compression == 'zlib' or rsync_version < (3, 2):
+        return f'--compress {skip}'
+    return f'--compress --compress-choice=zstd{level_opt} {skip}'
+
+
+def _supports_zstd(rsync_version_output: str) -> bool:
+    # rsync >= 3.2 prints e.g., "Compress list:\n    zstd lz4 zlibx zlib none"
+    return 'zstd' in rsync_version_output
+
+
+def measure_compress_rate(size: int = PROBE_SIZE) -> float:
+    """Bytes per second the local CPU compresses a mix of compressible and incompressible data at."""
+    import zlib
+    half = size // 2
+    words = b' '.join(str(i).encode() + b' def return self import' for i in range(half // 32))
+    sample = os.urandom(half) + words[:half]
+    start = time.time()
+    zlib.compress(sample, 6)
+    return len(sample) / max(time.time() - start, 1e-6)
+
+
+def probe_link(ssh_cmd: list[str], size: int = PROBE_SIZE) -> dict:
+    """Measure the link throughput to a machine by pushing random bytes through ssh.
+
+    ssh_cmd: the command to ssh into the machine (e.g., ['ssh', 'user@host'])
+    """
+    import shutil
+    # The first round trip measures the connection overhead and checks the remote rsync.
+    start = time.time()
+    out = subprocess.run(ssh_cmd + ['rsync --version'], capture_output=True)
+    overhead = time.time() - start
+    remote_version = out.stdout.decode('utf-8', 'ignore')
+
+    payload = os.urandom(size)
+    start = time.time()
+    subprocess.run(ssh_cmd + ['cat > /dev/null'], input=payload, capture_output=True, check=True)
+    elapsed = max(time.time() - start - overhead, 1e-6)
+
+    local_version = subprocess.run(['rsync', '--version'], capture_output=True).stdout.decode('utf-8', 'ignore') \
+        if shutil.which('rsync') else ''
+    return {
+        'link_rate': size / elapsed,
+        'compress_rate': measure_compress_rate(),
+        'zstd': _supports_zstd(local_version) and _supports_zstd(remote_version),
+        'timestamp': time.time(),
+    }
+
+
+def choose_compression(profile: dict) -> str:
+    """Compress only when the link is the bottleneck, and use zstd when both sides support it."""
+    link_rate, compress_rate = profile['link_rate'], profile['compress_rate']
+    if link_rate >= compress_rate:
+        return 'none'
+    if not profile.get('zstd'):
+        return 'zlib'
+    # zstd level 1 is several times faster than zlib; only spend more CPU when the link is much slower.
+    return 'zstd:1' if link_rate * 4 > compress_rate else 'zstd:3'
+
+
+def load_profile(key: str, path: str | Path = PROFILE_PATH) -> dict | None:
+    try:
+        with open(path, 'r') as f:
+            profile = json.load(f).get(key)
+    except (FileNotFoundError, ValueError):
+        return None
+    if profile is None or time.time() - profile.get('timestamp', 0) > PROFILE_TTL:
+        return None
+    return profile
+
+
+def save_profile(key: str, profile: dict, path: str | Path = PROFILE_PATH) -> None:
+    path = Path(path)
+    try:
+        with open(path, 'r') as f:
+            profiles = json.load(f)
+    except (FileNotFoundError, ValueError):
+        profiles = {}
+    profiles[key] = profile
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(profiles, f)
+    os.replace(tmp_path, path)
+
+
+def get_compression(machine, dry_run: bool = False) -> str:
+    """Compression mode for rsync to/from machine.
+
+    Reads "compression" from the machine config. With "auto" (default), the link is measured
+    once and the result is cached in ~/.rmx/link-profiles.json for a week.
+    """
+    compression = machine.parsed_conf.get('compression', 'auto')
+    if compression != 'auto':
+        compression_options(compression)  # validate
+        return compression
+    if dry_run:
+        return DEFAULT_COMPRESSION
+
+    profile = load_profile(machine.base_uri)
+    if profile is None:
+        logger.info(f'Measuring the link to {machine.base_uri} to tune compression (only once a week)...')
+        try:
+            profile = probe_link(['ssh', *machine.remote_conf.get_master().options, machine.base_uri])
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f'Failed to measure the link to {machine.base_uri}; using {DEFAULT_COMPRESSION} compression: {e}')
+            return DEFAULT_COMPRESSION
+        save_profile(machine.base_uri, profile)
+
+    compression = choose_compression(profile)
+    logger.debug(f'Link to {machine.base_uri}: {profile["link_rate"] / 1e6:.1f}MB/s, '
+                 f'local compression: {profile["compress_rate"] / 1e6:.1f}MB/s --> compression: {compression}')
+    return compression
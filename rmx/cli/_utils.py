@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
+import os
 import subprocess
 from rmx import logger
 
-def rsync(source_dir, target_dir, options='', exclude=None, dry_run=False, transfer_rootdir=True):
+def rsync(source_dir, target_dir, options='', exclude=None, dry_run=False, transfer_rootdir=True,
+          files_from=None, compression='zlib', ssh_command=None):
     """
     source_dir: hoge/fuga/source-dir/content-files
     target_dir: Hoge/Fuga/target-dir
@@ -12,6 +14,13 @@ def rsync(source_dir, target_dir, options='', exclude=None, dry_run=False, trans
 
     else:
       target_dir: Hoge/Fuga/target-dir/content-files
+
+    files_from: a list of paths (relative to source_dir) to transfer instead of the whole tree.
+      With transfer_rootdir=True, the paths are prefixed with the name of source_dir.
+
+    compression: "none", "zlib", "zstd" or "zstd:<level>" (see rmx.cli._tuning)
+
+    ssh_command: the remote shell for rsync to use (e.g., one that reuses a master connection. See SSHMaster)
     """
     # TODO: replace with https://github.com/laktak/rsyncy (?)
     # ^ This one supports visualizing progress bar
@@ -22,23 +31,47 @@ def rsync(source_dir, target_dir, options='', exclude=None, dry_run=False, trans
     if shutil.which("rsync") is None:
         raise RuntimeError("rsync binary is not found.")
     # ---
-    logger.info(f"Syncing code...")
+    logger.debug(f"Syncing {source_dir} to {target_dir}...")
     source_dir = str(source_dir).rstrip('/') + ('' if transfer_rootdir else '/')
     target_dir = str(target_dir).rstrip('/') + '/'
 
     exclude_str = ' '.join(f'--exclude \'{ex}\'' for ex in exclude)
 
+    files_from_path = None
+    if files_from is not None:
+        # NOTE: --files-from implies --relative, so paths must be relative to the source we pass to rsync.
+        # To keep the source directory itself in the destination, we sync from its parent instead.
+        import tempfile
+        if transfer_rootdir:
+            source_path = source_dir.rstrip('/')
+            prefix = os.path.basename(source_path) + '/'
+            source_dir = (os.path.dirname(source_path) or '.') + '/'
+            files_from = [prefix + path for path in files_from]
+        with tempfile.NamedTemporaryFile('w', prefix='rmx-files-from-', delete=False) as f:
+            f.write('\0'.join(files_from))
+            files_from_path = f.name
+        options = f'--from0 --files-from=\'{files_from_path}\' {options}'
+
+    if ssh_command is not None:
+        import shlex
+        options = f'-e {shlex.quote(ssh_command)} {options}'
+
     # cmd = f"rsync --info=progress2 --archive --compress {exclude_str} {options} {source_dir} {target_dir}"
-    cmd = f"rsync --progress --stats --archive --compress {exclude_str} {options} {source_dir} {target_dir}"
+    from rmx.cli._tuning import compression_options
+    cmd = f"rsync --progress --stats --archive {compression_options(compression)} {exclude_str} {options} {source_dir} {target_dir}"
     logger.debug(f'running command: {cmd}')
 
-    if not dry_run:
-        out = run_cmd(cmd, shell=True)
-        logger.info("Sync finished!")
+    try:
+        if not dry_run:
+            out = run_cmd(cmd, shell=True)
+            logger.debug("Sync finished!")
 
-        if out.returncode != 0:
-            raise OSError(f'The following rsync command failed:\n{out.args}\n\n{out.stderr.decode("utf-8")}')
-        return out
+            if out.returncode != 0:
+                raise OSError(f'The following rsync command failed:\n{out.args}\n\n{out.stderr.decode("utf-8")}')
+            return out
+    finally:
+        if files_from_path is not None:
+            os.remove(files_from_path)
 
 
 def run_cmd(cmd, get_output=False, shell=False) -> subprocess.CompletedProcess:
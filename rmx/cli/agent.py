@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from rmx import logger
+
+
+def _get_parser() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "action",
+        choices=["start", "stop", "restart", "status"],
+        help="start / stop the background agent that keeps rmx warm between commands",
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Be verbose"
+    )
+    return parser
+
+
+def handler(parsed: Namespace):
+    """Manage the rmx agent (see rmx.agent).
+
+    While the agent is running, every rmx command is forwarded to it. Set RMX_NO_AGENT=1 to bypass it.
+    """
+    from rmx import agent
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    if parsed.action in ['stop', 'restart']:
+        pid = agent.stop()
+        if pid is None:
+            logger.info('rmx agent is not running.')
+        else:
+            import time
+            while agent.is_running() == pid:
+                time.sleep(0.05)
+            logger.info(f'Stopped rmx agent (pid {pid}).')
+
+    if parsed.action in ['start', 'restart']:
+        pid = agent.is_running()
+        if pid is not None:
+            logger.info(f'rmx agent is already running (pid {pid}).')
+        else:
+            pid = agent.start()
+            logger.info(f'Started rmx agent (pid {pid}). Logs: {agent.AGENT_LOGFILE}')
+
+    if parsed.action == 'status':
+        pid = agent.is_running()
+        if pid is None:
+            logger.info('rmx agent is not running.')
+        else:
+            logger.info(f'rmx agent is running (pid {pid}) on {agent.AGENT_SOCKET}')
+
+
+name = 'agent'
+description = 'manage the background agent'
+parser = _get_parser()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from rmx import logger
+from rmx.cli._config_loader import Project, Machine
+from rmx.machine import SimpleSSHClient
+
+
+def _get_parser() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "machine",
+        action="store",
+        type=str,
+        help="Machine",
+    )
+    parser.add_argument(
+        "run",
+        action="store",
+        type=str,
+        nargs="?",
+        default=None,
+        help="Name of the run (--name of `rmx run`, or the timestamp shown at launch). Defaults to the latest run",
+    )
+    parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="Keep printing new output (until Ctrl-C)",
+    )
+    parser.add_argument(
+        "--interval",
+        action="store",
+        type=float,
+        default=2.,
+        help="Seconds between polls with --follow",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the runs with logs on the machine",
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Be verbose"
+    )
+    return parser
+
+
+def _list_runs(client: SimpleSSHClient, logdir: str) -> list[str]:
+    """Returns the runs in logdir, from the latest to the oldest"""
+    result = client.run(f'ls -t {logdir}', hide=True, warn=True)
+    if result is None or result.exited != 0:
+        return []
+    return result.stdout.split()
+
+
+def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
+    """Show the output of a disowned run that is kept on the remote (with -f, follow it).
+
+    Only the bytes appended since the last poll are fetched, for all the files of the run (e.g., sweep members) at once.
+    """
+    import time
+    from rmx.logstream import BatchedWriter, RemoteLogTail
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    client = SimpleSSHClient(machine.remote_conf)
+    logdir = str(machine.get_logdir(project.name))
+    if parsed.list or parsed.run is None:
+        runs = _list_runs(client, logdir)
+        if not runs:
+            logger.error(f'No logs are found in {machine.name}:{logdir}')
+            return
+        if parsed.list:
+            print('\n'.join(runs))
+            return
+        parsed.run = runs[0]
+        logger.info(f'Showing the latest run: {parsed.run}')
+
+    tail = RemoteLogTail(client, f'{logdir}/{parsed.run}', BatchedWriter())
+    try:
+        tail.poll()
+        while parsed.follow:
+            time.sleep(parsed.interval)
+            tail.poll()
+    except FileNotFoundError:
+        logger.error(f'No logs are found for {parsed.run} in {machine.name}:{logdir}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tail.close()
+
+
+name = 'logs'
+description = 'show the output of disowned runs'
+parser = _get_parser()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from rmx import logger
+from rmx.cli._config_loader import Project, Machine
+
+
+def _get_parser() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "machine",
+        action="store",
+        type=str,
+        nargs="?",
+        default=None,
+        help="Machine (or comma-separated machines). Defaults to all the machines in the configuration",
+    )
+    parser.add_argument(
+        "--ttl",
+        action="store",
+        type=float,
+        default=30.,
+        help="Reuse the results probed within TTL seconds (0 to probe again)",
+    )
+    parser.add_argument(
+        "--timeout",
+        action="store",
+        type=int,
+        default=10,
+        help="Give up on a machine after TIMEOUT seconds",
+    )
+    parser.add_argument(
+        "--gpus",
+        action="store_true",
+        help="Show each GPU rather than a summary per machine",
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Be verbose"
+    )
+    return parser
+
+
+def _format_memory(num_bytes: float | None) -> str:
+    if num_bytes is None:
+        return '-'
+    from rmx.cli._sync_engine import format_bytes
+    return format_bytes(num_bytes)
+
+
+def _summary_row(name: str, result: dict) -> tuple:
+    from ._probe import get_free_gpus
+    gpus = result['gpus']
+    free = get_free_gpus(result)
+    load = '-' if result['load'] is None else f"{result['load']:.1f}/{result['ncpus'] or '?'}"
+    mem = '-' if result['mem_total'] is None else \
+        f"{_format_memory(result['mem_available'])}/{_format_memory(result['mem_total'])}"
+    if not gpus:
+        return (name, '-', '-', '-', '-', load, mem)
+    util = sum(gpu['utilization'] or 0 for gpu in gpus) / len(gpus)
+    gpu_mem = f"{sum(gpu['memory_used'] or 0 for gpu in gpus) / 1024:.0f}/{sum(gpu['memory_total'] or 0 for gpu in gpus) / 1024:.0f}G"
+    return (name, f'{len(free)}/{len(gpus)}', ','.join(map(str, free)) or '-', f'{util:.0f}%', gpu_mem, load, mem)
+
+
+def _gpu_rows(name: str, result: dict) -> list[tuple]:
+    from ._probe import is_free_gpu
+    return [(name, gpu['index'], gpu['name'], 'free' if is_free_gpu(gpu) else f"{gpu['num_procs']} procs",
+             f"{gpu['utilization'] or 0:.0f}%", f"{gpu['memory_used'] or 0:.0f}/{gpu['memory_total'] or 0:.0f}M")
+            for gpu in result['gpus']]
+
+
+def _print_table(rows: list[tuple]):
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    print('\n'.join('  '.join(str(val).ljust(width) for val, width in zip(row, widths)).rstrip() for row in rows))
+
+
+def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
+    """Show the free GPUs, CPU load and memory of the machines."""
+    multi_handler([project], [machine], parsed, preset)
+
+
+def multi_handler(projects: list[Project], machines: list[Machine], parsed: Namespace, preset: dict):
+    from ._probe import probe_machines
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+    if parsed.dry_run:
+        return
+
+    results = probe_machines(machines, ttl=parsed.ttl, timeout=parsed.timeout)
+    if parsed.gpus:
+        rows = [('MACHINE', 'GPU', 'NAME', 'STATUS', 'UTIL', 'MEMORY')]
+        for name, result in results.items():
+            rows += _gpu_rows(name, result)
+    else:
+        rows = [('MACHINE', 'FREE/GPUS', 'FREE IDS', 'UTIL', 'GPU MEM', 'LOAD', 'MEM AVAIL')]
+        rows += [_summary_row(name, result) for name, result in results.items() if result['error'] is None]
+    if len(rows) > 1:
+        _print_table(rows)
+    for name, result in results.items():
+        if result['error'] is not None:
+            logger.error(f'Failed to probe {name}: {result["error"]}')
+
+
+name = 'nv'
+description = 'show free GPUs, load and memory of the machines'
+parser = _get_parser()
@@ -1,5 +1,4 @@
 from __future__ import annotations
-from copy import deepcopy
 import os
 from pathlib import Path
 from argparse import ArgumentParser
@@ -11,8 +10,14 @@ from rmx.helpers import replace_rmx_envvars
 from rmx.cli._config_loader import Project, Machine
 from rmx.machine import SimpleSSHClient
 
-from rmx.runner import SlurmRunner
-from .sync import _sync_output, _sync_code
+from rmx.runner import SlurmRunner, to_slurm_array
+from .sync import _sync_output, _sync_code, _sync_code_many, OutputWatcher
+
+# Maximum number of machines to run a command on at once in ssh mode
+FANOUT_WORKERS = 32
+
+# Maximum number of sweep containers to launch at once in docker mode (overridable with "launch_workers" under "docker")
+DOCKER_LAUNCH_WORKERS = 8
 
 
 def _get_parser() -> ArgumentParser:
@@ -21,7 +26,9 @@ def _get_parser() -> ArgumentParser:
         "machine",
         action="store",
         type=str,
-        help="Machine",
+        help="Machine (or comma-separated machines to run on all of them at once. Modes other than ssh require -d). "
+             "With a machine group (\"auto\" or one under \"groups\" in the config), the --sweep is spread over "
+             "the machines by their free GPUs and load, or the command runs on the least busy one.",
     )
     parser.add_argument(
         "--verbose",
@@ -81,10 +88,16 @@ def _get_parser() -> ArgumentParser:
         action="store_true",
         help="Do not perform rsync. This means your local files will not be synced with remote server.",
     )
+    parser.add_argument(
+        "--full-sync",
+        action="store_true",
+        help="Ignore the local sync manifest and let rsync compare the entire tree.",
+    )
     parser.add_argument(
         "--contain",
         action="store_true",
-        help="With this flag, rsync will copy the project directory to a new unique location on remote, rather than the predetermined one.",
+        help="With this flag, rsync will copy the project directory to a new unique location on remote, rather than the predetermined one. "
+             "Unchanged files are hardlinked from the previous contained run.",
     )
     parser.add_argument(
         "-n",
@@ -94,11 +107,27 @@ def _get_parser() -> ArgumentParser:
         default=1,
         help="number of sequence in Slurm sequential jobs"
     )
+    parser.add_argument(
+        "--pull-interval",
+        action="store",
+        type=float,
+        default=None,
+        help="Pull new output files every PULL_INTERVAL seconds while the job is running. "
+             "With -d, rmx keeps pulling until you press Ctrl-C.",
+    )
+    parser.add_argument(
+        "--log-file",
+        action="store",
+        type=str,
+        default=None,
+        help="Also write the container output that is shown in the terminal to this local file (docker mode)",
+    )
     parser.add_argument(
         "--sweep",
         action="store",
         type=str,
-        help="specify sweep range (e.g., --sweep 0-255) this changes the value of $RMX_RUN_SWEEP_IDX"
+        help="specify sweep range (e.g., --sweep 0-255) this changes the value of $RMX_RUN_SWEEP_IDX. "
+             "In slurm modes, the sweep is submitted as a job array and a throttle can be set (e.g., --sweep 0-255%%16)"
     )
     parser.add_argument(
         "remote_command",
@@ -118,6 +147,8 @@ def parse_sweep_idx(sweep_str):
     # format #0: 8 --> 8
     # format #1: 1-10 --> range(1, 10)
     # format #2: 1,2,7 --> [1, 2, 7]
+    # A throttle suffix (e.g., 1-10%4) is ignored here. See parse_sweep_throttle.
+    sweep_str = sweep_str.split('%')[0]
     if '-' in sweep_str:
         # format #1
         begin, end = [int(val) for val in sweep_str.split('-')]
@@ -133,22 +164,117 @@ def parse_sweep_idx(sweep_str):
     return sweep_ind
 
 
+def parse_sweep_throttle(sweep_str) -> int | None:
+    """Maximum number of sweep jobs to run at once: 0-255%16 --> 16 (only for slurm job arrays)"""
+    if '%' not in sweep_str:
+        return None
+    throttle = sweep_str.split('%')[1]
+    if not throttle.isnumeric() or int(throttle) < 1:
+        raise KeyError(f'Throttle for --sweep option must be a positive integer: {sweep_str}')
+    return int(throttle)
+
+
+def _report_slurm_jobs(jobs: list[Namespace]):
+    """Log the submitted job ids (SlurmRunner.exec in sbatch mode) and raise if any submission failed."""
+    # NOTE: The tasks of a job array (<jobid>_<task id>) are reported as a single job
+    jobids = list(dict.fromkeys(job.jobid.split('_')[0] for job in jobs if job.jobid is not None))
+    if jobids:
+        logger.info(f'Submitted {len(jobids)} slurm job(s): {" ".join(jobids)}')
+    failed = [job for job in jobs if job.error is not None]
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(jobs)} slurm jobs failed to submit.')
+
+
+def _record_launches(project: Project, machine: Machine, mode: str, runtime_options: Namespace,
+                     run_logdir: str | None, launches: list[dict]):
+    """Add the launched jobs (each a dict with name, and optionally sweep_idx and jobid) to the launch history."""
+    from rmx.store import LaunchHistory
+    if runtime_options.dry_run or not launches:
+        return
+    common = dict(project=project.name, machine=machine.name, mode=mode, cmd=runtime_options.cmd, logdir=run_logdir)
+    try:
+        LaunchHistory().log([{**common, **launch} for launch in launches])
+    except Exception as e:
+        logger.warning(f'Failed to record the launch: {e}')
+
+
+def _record_slurm_jobs(project: Project, machine: Machine, mode: str, runtime_options: Namespace,
+                       run_logdir: str | None, job_name: str, jobs: list[Namespace]):
+    _record_launches(project, machine, mode, runtime_options, run_logdir,
+                     [{'name': job_name, 'sweep_idx': job.sweep_idx, 'jobid': job.jobid} for job in jobs if job.jobid is not None])
+
+
 def print_conf(mode: str, machine: Machine, image: str | None = None):
     output = f'Running with [{mode}] mode on [{machine.remote_conf.base_uri}]'
     if image is not None:
         output += f' with image: [{image}]'
     logger.info(output)
 
-def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
+
+def _prefetch_image(machine: Machine, parsed: Namespace):
+    """In docker mode, start pulling the image on machine in the background so that it overlaps with the code sync.
+
+    Returns a future to pass to wait_prefetch (None if there is nothing to do).
     """
-    Args:
-    - project (Project): stores project-specific configurations
-    - machine (Machine): stores machine-specific configurations
-    - preset (dict)    : stores preset configurations for slurm or docker images
+    mode = parsed.mode or machine.parsed_conf.get('mode')
+    image = parsed.image or machine.parsed_conf.get('docker', {}).get('image')
+    if mode != 'docker' or image is None or parsed.dry_run:
+        return None
+    from ._docker import prefetch_images
+    return prefetch_images(machine, [image])
+
+
+def get_stage_key_cmd(var: str, src: str) -> str:
+    """Returns a shell command that exports ${var}_KEY, the checksum of the content of src, for stage_to_node.
+
+    It runs once on the login node when the jobs are submitted, so that each job doesn't read all of src to key it.
     """
-    logger.debug(f'handling command for {__file__}')
-    logger.debug(f'parsed: {parsed}')
+    return f'export {var}_KEY=$(cksum < "{src}" | tr " " -)'
+
+
+def stage_to_node(var: str, src: str, stage_dir: str) -> str:
+    """Returns a shell command that copies src into stage_dir (node-local storage) and sets $var to the copy.
+
+    The copy is keyed by the checksum of the content of src (${var}_KEY from get_stage_key_cmd, or computed here if
+    it is not set), so an updated file is staged again. Jobs on the same node take a lock and share a single copy.
+    If staging fails (e.g., out of space), $var is left pointing to src.
+    """
+    name = os.path.basename(src)
+    copy = ('[ -f "$0" ] || { cp "$1" "$0.tmp$$" && mv "$0.tmp$$" "$0" || { rm -f "$0.tmp$$"; exit 1; }; }')
+    return (f'{var}="{src}" && {{ '
+            f'rmx_key=${{{var}_KEY:-$(cksum < "{src}" | tr " " -)}} && [ -n "$rmx_key" ] && '
+            f'rmx_dst="{stage_dir}/$rmx_key-{name}" && '
+            f'{{ [ -f "$rmx_dst" ] || {{ mkdir -p "{stage_dir}" && flock "$rmx_dst.lock" sh -c \'{copy}\' "$rmx_dst" "{src}"; }}; }} && '
+            f'{var}="$rmx_dst" || echo "rmx: failed to stage {src} in {stage_dir}. Using it directly." >&2; }}')
+
+
+def _make_run_logdir(project: Project, machine: Machine, runtime_options: Namespace) -> str:
+    """Returns the directory on machine that keeps the output of this run.
+
+    The directory is created by the launch command itself (see SSHRunner.exec and SlurmRunner.submit).
+    Without --name, the run is named after the launch time with a random suffix, so that concurrent launches don't collide.
+    """
+    import time
+    import uuid
+    run = runtime_options.name or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    run_logdir = str(machine.get_logdir(project.name) / run)
+    logger.info(f'The output is kept in {machine.name}:{run_logdir}. See `rmx logs {machine.name} {run}`')
+    return run_logdir
+
+
+def get_docker_log_path(logdir: str, sweep_idx: int | None = None) -> str:
+    """The file in the run logdir that keeps the output of a container (one per sweep index)"""
+    return f'{logdir}/{"out" if sweep_idx is None else sweep_idx}.log'
 
+
+def _get_host_ids(machine: Machine) -> tuple[int, int]:
+    """Returns the uid and gid of the user on machine (for `"user_id": "host"` in docker mode)."""
+    result = SimpleSSHClient(machine.remote_conf).run('id -u && id -g', hide=True)
+    user_id, group_id = result.stdout.split()
+    return int(user_id), int(group_id)
+
+
+def _get_runtime_options(parsed: Namespace) -> Namespace:
     # Runtime info
     curr_dir = Path(os.getcwd()).resolve()
     proj_rootdir = find_project_root()
@@ -159,38 +285,63 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
     else:
         cmd = parsed.remote_command
 
-    runtime_options = Namespace(dry_run=parsed.dry_run,
-                                cmd=cmd,
-                                rel_workdir=rel_workdir,
-                                disown=parsed.disown,
-                                name=parsed.name,
-                                sweep=parsed.sweep,
-                                num_sequence=parsed.num_sequence,
-                                no_sync=parsed.no_sync,
-                                sconf=parsed.sconf,
-                                dconf=parsed.dconf,
-                                force=parsed.force)
-
-    # Sync code first
-    if parsed.no_sync:
-        logger.warning('--no-sync option is True, local files will not be synced.')
-
-    if not parsed.no_sync:
-        if parsed.contain:
-            # Generate a unique path and set it to machine.rmxdir
-            # BUG: This generates the same hash every time!! This stack overflow answer is obviously wrong: https://stackoverflow.com/a/6048639/19913466
-            # import hashlib
-            # import time
-            # hashlib.sha1().update(str(time.time()).encode("utf-8"))
-            # _hash = hashlib.sha1().hexdigest()
-            from rmx.helpers import get_timestamp
-            _hash = get_timestamp()
-            machine.rmxdir = Path(f'{machine.rmxdir}/{_hash}')
-            runtime_options.name = _hash
-            logger.warning(f'--contain flag is set.\n\tsetting the remote rmxdir to {machine.rmxdir}\n\tsetting jobs suffix to {_hash}')
-
-        _sync_code(project, machine, runtime_options.dry_run)
-
+    return Namespace(dry_run=parsed.dry_run,
+                     cmd=cmd,
+                     rel_workdir=rel_workdir,
+                     disown=parsed.disown,
+                     name=parsed.name,
+                     sweep=parsed.sweep,
+                     num_sequence=parsed.num_sequence,
+                     no_sync=parsed.no_sync,
+                     sconf=parsed.sconf,
+                     dconf=parsed.dconf,
+                     force=parsed.force,
+                     log_file=parsed.log_file,
+                     gpus=None,
+                     follow=True)
+
+
+def _prepare_contain(project: Project, machine: Machine, runtime_options: Namespace) -> Namespace:
+    """Point machine.rmxdir to a new unique location for --contain.
+
+    Returns the rmxdirs of the previous snapshot to hardlink unchanged files from (None if there is none),
+    and the key to record the new snapshot with once the sync succeeds.
+    """
+    # Generate a unique path and set it to machine.rmxdir
+    # BUG: This generates the same hash every time!! This stack overflow answer is obviously wrong: https://stackoverflow.com/a/6048639/19913466
+    # import hashlib
+    # import time
+    # hashlib.sha1().update(str(time.time()).encode("utf-8"))
+    # _hash = hashlib.sha1().hexdigest()
+    from rmx.helpers import get_timestamp
+    from rmx.manifest import load_latest_snapshot
+    from rmx.cli._config_loader import get_docker_rmxdirs
+
+    # Hardlink unchanged files from the previous contained run rather than uploading the whole project again.
+    link_dest = None
+    snapshot_key = machine.uri(machine.rmxdir / project.name)
+    prev_rmxdir = load_latest_snapshot(snapshot_key)
+    if prev_rmxdir is not None:
+        link_dest = get_docker_rmxdirs(prev_rmxdir, project.name)
+        logger.info(f'Hardlinking unchanged files from the previous snapshot: {prev_rmxdir}')
+
+    _hash = get_timestamp()
+    machine.rmxdir = Path(f'{machine.rmxdir}/{_hash}')
+    runtime_options.name = _hash
+    logger.warning(f'--contain flag is set.\n\tsetting the remote rmxdir to {machine.rmxdir}\n\tsetting jobs suffix to {_hash}')
+    return Namespace(link_dest=link_dest, snapshot_key=snapshot_key)
+
+
+def _save_snapshot(project: Project, machine: Machine, contain: Namespace) -> None:
+    """Record the snapshot synced by _prepare_contain as the latest one (and drop the manifests of the previous one)."""
+    from rmx.manifest import save_latest_snapshot
+    from .sync import _get_sources
+    save_latest_snapshot(contain.snapshot_key, str(machine.rmxdir),
+                         manifests=[source.manifest.path for source in _get_sources(project, machine)])
+
+
+def _launch(project: Project, machine: Machine, parsed: Namespace, preset: dict, runtime_options: Namespace):
+    """Execute the command on machine with the mode specified by parsed.mode or the config."""
     env = {**project.env, **machine.env}
     rmxdirs = machine.get_rmxdirs(project.name)
 
@@ -202,33 +353,38 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
         logger.warning('mode is not set. Setting it to SSH mode')
         mode = 'ssh'
 
+    # The output of disowned runs is kept on the remote (see `rmx logs`)
+    run_logdir = _make_run_logdir(project, machine, runtime_options) if runtime_options.disown else None
+
     if mode == 'ssh':
         from rmx.runner import SSHRunner
         ssh_client = SimpleSSHClient(machine.remote_conf)
         ssh_runner = SSHRunner(ssh_client, rmxdirs)
         print_conf(mode, machine)
+        _record_launches(project, machine, mode, runtime_options, run_logdir, [{'name': runtime_options.name}])
         ssh_runner.exec(runtime_options.cmd,
                         runtime_options.rel_workdir,
                         startup=startup,
                         env=env,
-                        dry_run=runtime_options.dry_run)
+                        dry_run=runtime_options.dry_run,
+                        disown=runtime_options.disown,
+                        log_path=None if run_logdir is None else f'{run_logdir}/out.log')
 
     elif mode == 'docker':
-        from docker import DockerClient
         from rmx.runner import DockerRunner
         from rmx.config import DockerContainerConfig
-        base_url = "ssh://" + machine.base_uri
-        # client = DockerClient(base_url=base_url, use_ssh_client=True)
-        client = DockerClient(base_url=base_url)  # dockerpty hangs with use_ssh_client=True
+        from ._docker import get_docker_client
+        if runtime_options.dry_run:
+            raise ValueError('dry run is not yet supported for Docker mode')
+
+        docker_pconf = machine.parsed_conf.get('docker', {})
+        client, base_url = get_docker_client(machine)
 
         # Specify job name
         name = f'{machine.user}-rmx-{project.name}'
         if runtime_options.name is not None:
             name = f'{name}--{runtime_options.name}'
 
-        if runtime_options.dry_run:
-            raise ValueError('dry run is not yet supported for Docker mode')
-
         from docker.types import Mount
         from rmx.cli._config_loader import DOCKER_ROOT_DIR, get_docker_rmxdirs
         docker_rmxdirs = get_docker_rmxdirs(DOCKER_ROOT_DIR, project.name)
@@ -240,14 +396,25 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
         else:
             mounts = []
         mounts += [Mount(target=tgt, source=src, type='bind') for src, tgt in project.mount_from_host.items()]
+        container_logdir = None
+        if run_logdir is not None:
+            # NOTE: The source of a bind mount has to exist before the container is created
+            SimpleSSHClient(machine.remote_conf).run(f'mkdir -p {run_logdir}', hide=True)
+            container_logdir = f'{DOCKER_ROOT_DIR}/{project.name}/logs'
+            mounts.append(Mount(target=container_logdir, source=run_logdir, type='bind'))
 
-        docker_runner = DockerRunner(client, docker_rmxdirs)
+        docker_runner = DockerRunner(client, docker_rmxdirs, docker_host=base_url)
 
         # Docker specific configurations
-        docker_pconf = machine.parsed_conf.get('docker', {})
         image = parsed.image or docker_pconf.get('image')
         user_id = docker_pconf.get('user_id', 0)
-        group_id = docker_pconf.get('group_id', 0)
+        group_id = docker_pconf.get('group_id', 'host' if user_id == 'host' else 0)
+        if 'host' in (user_id, group_id):
+            host_user_id, host_group_id = _get_host_ids(machine)
+            user_id = host_user_id if user_id == 'host' else user_id
+            group_id = host_group_id if group_id == 'host' else group_id
+        # Files created by the host user are already theirs; otherwise let everyone write them (e.g., root in the container)
+        umask = docker_pconf.get('umask', None if docker_pconf.get('user_id') == 'host' else '000')
 
         if 'mount_from_host' in docker_pconf:
             logger.warn('''
@@ -257,10 +424,10 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
 
 
         if not isinstance(user_id, int):
-            raise ValueError('user_id must be an integer')
+            raise ValueError('user_id must be an integer or "host"')
 
         if not isinstance(group_id, int):
-            raise ValueError('group_id must be an integer')
+            raise ValueError('group_id must be an integer or "host"')
 
 
         if image is None:
@@ -270,28 +437,46 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
         if runtime_options.sweep:
             assert runtime_options.disown, "You must set -d option to use sweep functionality."
             sweep_ind = parse_sweep_idx(runtime_options.sweep)
+            if parse_sweep_throttle(runtime_options.sweep) is not None:
+                logger.warning('The throttle of --sweep is ignored in docker mode.')
 
-            single_sweep = (len(sweep_ind) == 1)
+            # NOTE: A share of a sweep spread over machines is never followed, even if it is a single index
+            single_sweep = (len(sweep_ind) == 1) and runtime_options.follow
 
-            for sweep_idx in sweep_ind:
+            docker_confs = []
+            for i, sweep_idx in enumerate(sweep_ind):
                 _name = f'{name}-{sweep_idx}'
-                logger.info(f'Launching sweep {sweep_idx}: {_name}')
-                env.update({'RMX_RUN_SWEEP_IDX': sweep_idx})
-                docker_conf = DockerContainerConfig(
+                # Spread the containers over the free GPUs when they are known (see _plan_group)
+                gpu_env = {'CUDA_VISIBLE_DEVICES': str(runtime_options.gpus[i % len(runtime_options.gpus)])} \
+                    if runtime_options.gpus and 'CUDA_VISIBLE_DEVICES' not in env else {}
+                docker_confs.append(DockerContainerConfig(
                     image=image,
                     name=_name,
                     mounts=mounts,
                     startup=startup,
-                    env=env,
+                    env={**env, **gpu_env, 'RMX_RUN_SWEEP_IDX': sweep_idx},
                     user_id=user_id,
-                    group_id=group_id
-                )
-                docker_runner.exec(runtime_options.cmd,
-                                   runtime_options.rel_workdir,
-                                   docker_conf,
-                                   interactive=False,
-                                   kill_existing_container=runtime_options.force,
-                                   quiet=not single_sweep)
+                    group_id=group_id,
+                    umask=umask,
+                    log_path=None if container_logdir is None else get_docker_log_path(container_logdir, sweep_idx),
+                ))
+            # Launch the containers concurrently
+            logger.info(f'Launching {len(docker_confs)} sweep containers: {name}-{{{runtime_options.sweep}}}')
+            results = docker_runner.exec_sweep(runtime_options.cmd,
+                                               runtime_options.rel_workdir,
+                                               docker_confs,
+                                               kill_existing_container=runtime_options.force,
+                                               max_workers=docker_pconf.get('launch_workers', DOCKER_LAUNCH_WORKERS),
+                                               quiet=not single_sweep,
+                                               log_file=runtime_options.log_file)
+            _record_launches(project, machine, mode, runtime_options, run_logdir,
+                             [{'name': result.name, 'sweep_idx': sweep_idx, 'jobid': result.name}
+                              for sweep_idx, result in zip(sweep_ind, results) if result.error is None])
+            failed = [(sweep_idx, result) for sweep_idx, result in zip(sweep_ind, results) if result.error is not None]
+            if failed:
+                for sweep_idx, result in failed:
+                    logger.error(f'  sweep {sweep_idx} ({result.name}): {result.error}')
+                raise RuntimeError(f'{len(failed)} of {len(results)} sweep containers failed to launch.')
             # import time
             # logger.warning('Sleeping for 5 seconds to see if the container fails...')
             # logger.warning('You can safely exit anytime')
@@ -305,12 +490,16 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
                 env=env,
                 user_id=user_id,
                 group_id=group_id,
+                umask=umask,
+                log_path=None if container_logdir is None else get_docker_log_path(container_logdir),
             )
             docker_runner.exec(runtime_options.cmd,
                                runtime_options.rel_workdir,
                                docker_conf,
                                interactive=not runtime_options.disown,
-                               kill_existing_container=runtime_options.force)
+                               kill_existing_container=runtime_options.force,
+                               log_file=runtime_options.log_file)
+            _record_launches(project, machine, mode, runtime_options, run_logdir, [{'name': name, 'jobid': name}])
 
 
     elif mode in ['slurm', 'slurm-sing', 'sing-slurm']:
@@ -347,7 +536,12 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
         if runtime_options.name is not None:
             name = f'{name}--{run_opt.name}'
         slurm_conf.job_name = name
+        if run_logdir is not None and slurm_conf.output is None:
+            # %a: the index in the job array, %j: the job id
+            slurm_conf.output = f'{run_logdir}/%a-%j.log' if run_opt.sweep else f'{run_logdir}/%j.log'
 
+        # Commands to run on the login node at submission (see get_stage_key_cmd)
+        stage_keys = []
         if mode in ['slurm-sing', 'sing-slurm']:
             # Decorate run_opt.cmd for Singularity
 
@@ -358,6 +552,21 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
             image = machine.parsed_conf.get('singularity', {}).get('sif_file')
             overlay = machine.parsed_conf.get('singularity', {}).get('overlay')
             writable_tmpfs = machine.parsed_conf.get('singularity', {}).get('writable_tmpfs', False)
+            stage_dir = machine.parsed_conf.get('singularity', {}).get('stage_dir')
+
+            # Copy the images to node-local storage first, so that the jobs don't all read them from shared storage
+            staging = []
+            sif_path = image
+            if stage_dir:
+                staging.append(stage_to_node('RMX_SIF', image, stage_dir))
+                stage_keys.append(get_stage_key_cmd('RMX_SIF', image))
+                sif_path = '"$RMX_SIF"'
+                if overlay:
+                    # NOTE: The overlay may come with options (e.g., overlay.img:ro)
+                    overlay, *overlay_opts = overlay.split(':')
+                    staging.append(stage_to_node('RMX_OVERLAY', overlay, stage_dir))
+                    stage_keys.append(get_stage_key_cmd('RMX_OVERLAY', overlay))
+                    overlay = ':'.join(['"$RMX_OVERLAY"', *overlay_opts])
 
             # Overwrite rmx envvars.  Hmm I don't like this...
             from rmx.cli._config_loader import DOCKER_ROOT_DIR, get_docker_rmxdirs
@@ -413,43 +622,255 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
             escaped_cmd = run_opt.cmd.encode('unicode-escape').replace(b'"', b'\\"').decode('utf-8')
             logger.debug(f'run_opt.cmd after escape: {escaped_cmd}')
 
-            run_opt.cmd = sing_cmd.format(options=options, sif_file=image, cmd=escaped_cmd)
+            run_opt.cmd = sing_cmd.format(options=options, sif_file=sif_path, cmd=escaped_cmd)
+            if staging:
+                run_opt.cmd = ' && '.join([*staging, run_opt.cmd])
 
         print_conf(mode, machine, image=image if mode in ['slurm-sing', 'sing-slurm'] else None)
         if run_opt.sweep:
             assert run_opt.disown, "You must set -d option to use sweep functionality."
             sweep_ind = parse_sweep_idx(run_opt.sweep)
 
-            _slurm_conf = deepcopy(slurm_conf)
-            for sweep_idx in sweep_ind:
-                # NOTE: This special prefix "SINGULARITYENV_" is stripped and the rest is passed to singularity container,
-                # even with --containall or --cleanenv !!
-                # Example: (https://docs.sylabs.io/guides/3.1/user-guide/environment_and_metadata.html?highlight=environment%20variable)
-                #     $ SINGULARITYENV_HELLO=world singularity exec centos7.img env | grep HELLO
-                #     HELLO=world
-                env.update({'SINGULARITYENV_RMX_RUN_SWEEP_IDX': sweep_idx})
-
-                # Oftentimes, a user specifies $RMX_RUN_SWEEP_IDX as an argument to the command, and that will be evaluated right before singularity launches
-                env.update({'RMX_RUN_SWEEP_IDX': sweep_idx})
-
-                _name = f'{slurm_conf.job_name}-{sweep_idx}'
-                logger.info(f'Launching sweep {sweep_idx}: {_name}')
-                _slurm_conf.job_name = _name
-                slurm_runner.exec(run_opt.cmd, run_opt.rel_workdir, slurm_conf=_slurm_conf,
-                                  startup=startup,
-                                  interactive=False, num_sequence=run_opt.num_sequence,
-                                  env=env, dry_run=run_opt.dry_run)
+            # Submit the whole sweep as a single job array; each task reads its index from $SLURM_ARRAY_TASK_ID
+            throttle = parse_sweep_throttle(run_opt.sweep)
+            logger.info(f'Launching sweep as a job array: {slurm_conf.job_name} (--array={to_slurm_array(sweep_ind, throttle)})')
+            jobs = slurm_runner.exec(run_opt.cmd, run_opt.rel_workdir, slurm_conf=slurm_conf,
+                                     startup=startup,
+                                     interactive=False, num_sequence=run_opt.num_sequence,
+                                     env=env, dry_run=run_opt.dry_run, sweep_ind=list(sweep_ind), throttle=throttle,
+                                     setup=stage_keys)
+            _record_slurm_jobs(project, machine, mode, run_opt, run_logdir, slurm_conf.job_name, jobs)
+            _report_slurm_jobs(jobs)
         else:
-            slurm_runner.exec(run_opt.cmd, run_opt.rel_workdir, slurm_conf=slurm_conf,
-                              startup=startup, interactive=not run_opt.disown, num_sequence=run_opt.num_sequence,
-                              env=env, dry_run=run_opt.dry_run)
+            jobs = slurm_runner.exec(run_opt.cmd, run_opt.rel_workdir, slurm_conf=slurm_conf,
+                                     startup=startup, interactive=not run_opt.disown, num_sequence=run_opt.num_sequence,
+                                     env=env, dry_run=run_opt.dry_run, setup=stage_keys)
+            if isinstance(jobs, list):
+                _record_slurm_jobs(project, machine, mode, run_opt, run_logdir, slurm_conf.job_name, jobs)
+                _report_slurm_jobs(jobs)
     else:
         raise ValueError(f'Unrecognized mode: {mode}')
 
+
+def _get_done_check(project: Project, machine: Machine):
+    """Returns a function that tells if the jobs of the latest launch on machine have finished (see `rmx wait`).
+
+    Returns None if they cannot be checked (e.g., ssh mode).
+    """
+    from .wait import _get_waiter, wait
+    try:
+        waiter = _get_waiter(project, machine, Namespace(jobs=None))
+    except Exception as e:
+        logger.debug(f'Cannot check the status of the jobs on {machine.name}: {e}')
+        return None
+    if waiter is None:
+        return None
+    return lambda: wait([waiter], timeout=0)
+
+
+def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
+    """
+    Args:
+    - project (Project): stores project-specific configurations
+    - machine (Machine): stores machine-specific configurations
+    - preset (dict)    : stores preset configurations for slurm or docker images
+    """
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    runtime_options = _get_runtime_options(parsed)
+
+    # Pull the docker image (if missing) while syncing code
+    from ._docker import wait_prefetch
+    prefetch = _prefetch_image(machine, parsed)
+
+    # Sync code first
+    if parsed.no_sync:
+        logger.warning('--no-sync option is True, local files will not be synced.')
+
+    if not parsed.no_sync:
+        contain = _prepare_contain(project, machine, runtime_options) if parsed.contain else None
+
+        _sync_code(project, machine, runtime_options.dry_run, full=parsed.full_sync,
+                   link_dest=contain.link_dest if contain else None)
+
+        if contain and not runtime_options.dry_run:
+            _save_snapshot(project, machine, contain)
+
+    watcher = None
+    if parsed.pull_interval is not None:
+        if runtime_options.no_sync:
+            logger.warning('--pull-interval is ignored with --no-sync.')
+        else:
+            watcher = OutputWatcher(project, machine, parsed.pull_interval, dry_run=runtime_options.dry_run)
+            watcher.start()
+
+    wait_prefetch(prefetch)
+    _launch(project, machine, parsed, preset, runtime_options)
+
+    if watcher is not None:
+        if runtime_options.disown and not runtime_options.dry_run:
+            watcher.wait(done=_get_done_check(project, machine))
+        else:
+            watcher.stop()
+
     # Sync output files
     if not runtime_options.no_sync:
         _sync_output(project, machine, dry_run=parsed.dry_run)
 
+
+def _fanout_ssh(projects: list[Project], machines: list[Machine], runtime_options: list[Namespace]) -> list[str]:
+    """Run the command on all machines concurrently over ssh and print a summary.
+
+    Returns the names of the machines where the command failed.
+    """
+    from rmx.runner import SSHRunner, MultiHostRunner, format_host_summary
+    runners, envs, startups = {}, {}, {}
+    for project, machine in zip(projects, machines):
+        runners[machine.name] = SSHRunner(SimpleSSHClient(machine.remote_conf), machine.get_rmxdirs(project.name))
+        envs[machine.name] = {**project.env, **machine.env}
+        startups[machine.name] = ' && '.join([e for e in [project.startup, machine.startup] if e.strip()])
+        print_conf('ssh', machine)
+
+    run_opt = runtime_options[0]
+    for project, machine in zip(projects, machines):
+        _record_launches(project, machine, 'ssh', run_opt, None, [{'name': run_opt.name}])
+    results = MultiHostRunner(runners, max_workers=FANOUT_WORKERS).exec(
+        run_opt.cmd, run_opt.rel_workdir, envs=envs, startups=startups, dry_run=run_opt.dry_run
+    )
+    logger.info(f'Finished on {len(results)} machines:\n{format_host_summary(results)}')
+    return [result.name for result in results if result.exit_code != 0]
+
+
+def _plan_group(projects: list[Project], machines: list[Machine], parsed: Namespace) -> list[tuple]:
+    """Decide what each machine of the group runs, from their free GPUs and load (see rmx.cli._probe).
+
+    The docker machines are probed and take the sweep indices up to their free capacity. The rest go to the
+    slurm machines (that queue them), or over the docker machines if there is none.
+    Without --sweep, the command runs on the machine with the most free capacity.
+    Returns (project, machine, share) for the machines that run anything, where share is Namespace(sweep, gpus).
+    """
+    from ._probe import probe_machines, get_capacity, get_free_gpus, distribute_sweep
+    modes = {machine.name: parsed.mode or machine.parsed_conf.get('mode') or 'ssh' for machine in machines}
+    for name, mode in modes.items():
+        if mode not in ['docker', 'slurm', 'slurm-sing', 'sing-slurm']:
+            logger.warning(f'{name} is skipped since machine groups only run in docker or slurm modes.')
+    slurm_machines = [machine.name for machine in machines if modes[machine.name] in ['slurm', 'slurm-sing', 'sing-slurm']]
+    probed = probe_machines([machine for machine in machines if modes[machine.name] == 'docker'])
+    for name, result in probed.items():
+        if result['error'] is not None:
+            logger.warning(f'{name} is skipped since it cannot be probed: {result["error"]}')
+    capacities = {name: get_capacity(result) for name, result in probed.items() if result['error'] is None}
+    logger.info('Free capacity: ' + ', '.join([*(f'{name} {capacity}' for name, capacity in capacities.items()),
+                                               *(f'{name} (slurm)' for name in slurm_machines)]))
+
+    if parsed.sweep:
+        throttle = parse_sweep_throttle(parsed.sweep)
+        shares = distribute_sweep(parse_sweep_idx(parsed.sweep), capacities, overflow=slurm_machines)
+    else:
+        best = max(capacities, key=capacities.get, default=None)
+        if (best is None or capacities[best] == 0) and slurm_machines:
+            best = slurm_machines[0]
+        shares = {} if best is None else {best: None}
+    if not shares:
+        raise RuntimeError(f'None of the machines in {parsed.group} is available.')
+
+    plan = []
+    for project, machine in zip(projects, machines):
+        if machine.name not in shares:
+            continue
+        sweep = shares[machine.name]
+        if sweep is not None:
+            sweep = ','.join(map(str, sweep))
+            if throttle is not None and machine.name in slurm_machines:
+                sweep += f'%{throttle}'
+            logger.info(f'{machine.name}: --sweep {sweep}')
+        gpus = get_free_gpus(probed[machine.name]) if machine.name in probed else None
+        plan.append((project, machine, Namespace(sweep=sweep, gpus=gpus or None)))
+    return plan
+
+
+def multi_handler(projects: list[Project], machines: list[Machine], parsed: Namespace, preset: dict):
+    """Sync the project to all machines at once (scanning it only once), and then launch the command on each of them."""
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    shares = None
+    if getattr(parsed, 'group', None) is not None:
+        plan = _plan_group(projects, machines, parsed)
+        if parsed.sweep is None:
+            project, machine, _ = plan[0]
+            handler(project, machine, parsed, preset)
+            return
+        projects, machines, shares = [list(val) for val in zip(*plan)]
+
+    modes = [parsed.mode or machine.parsed_conf.get('mode') or 'ssh' for machine in machines]
+    if not parsed.disown and any(mode != 'ssh' for mode in modes):
+        raise ValueError('You must set -d option to run on multiple machines (unless all of them are in ssh mode).')
+    if parsed.pull_interval is not None:
+        logger.warning('--pull-interval is ignored when running on multiple machines.')
+
+    runtime_options = [_get_runtime_options(parsed) for _ in machines]
+    if shares is not None:
+        for run_opt, share in zip(runtime_options, shares):
+            run_opt.sweep, run_opt.gpus, run_opt.follow = share.sweep, share.gpus, False
+
+    # Pull the docker images (if missing) while syncing code
+    from ._docker import wait_prefetch
+    prefetches = [_prefetch_image(machine, parsed) for machine in machines]
+
+    if parsed.no_sync:
+        logger.warning('--no-sync option is True, local files will not be synced.')
+    else:
+        contains = [_prepare_contain(project, machine, run_opt) if parsed.contain else None
+                    for project, machine, run_opt in zip(projects, machines, runtime_options)]
+        try:
+            _sync_code_many(projects, machines, dry_run=parsed.dry_run, full=parsed.full_sync,
+                            link_dests=[contain.link_dest if contain else None for contain in contains])
+        except OSError:
+            import traceback
+            import sys
+            print(traceback.format_exc(0), file=sys.stderr)
+            sys.exit(1)
+
+        if parsed.contain and not parsed.dry_run:
+            for project, machine, contain in zip(projects, machines, contains):
+                _save_snapshot(project, machine, contain)
+
+    for prefetch in prefetches:
+        wait_prefetch(prefetch)
+
+    # Launch on every machine concurrently
+    from concurrent.futures import ThreadPoolExecutor
+    others = [(project, machine, run_opt) for project, machine, run_opt, mode in zip(projects, machines, runtime_options, modes)
+              if mode != 'ssh']
+    failed = []
+    if others:
+        with ThreadPoolExecutor(max_workers=len(others)) as executor:
+            futures = {machine.name: executor.submit(_launch, project, machine, parsed, preset, run_opt)
+                       for project, machine, run_opt in others}
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f'{name}: failed to launch: {e}')
+                    failed.append(name)
+
+    # Commands in ssh mode stream their output back, prefixed with the machine name
+    ssh_targets = [(project, machine, run_opt) for project, machine, run_opt, mode in zip(projects, machines, runtime_options, modes)
+                   if mode == 'ssh']
+    if ssh_targets:
+        failed += _fanout_ssh(*zip(*ssh_targets))
+
+    if not parsed.no_sync:
+        for project, machine in zip(projects, machines):
+            _sync_output(project, machine, dry_run=parsed.dry_run)
+
+    if failed:
+        import sys
+        sys.exit(1)
+
+
 name = 'run'
 description = 'run command'
 parser = _get_parser()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from rmx import logger
+from rmx.cli._config_loader import Project, Machine
+from rmx.machine import SimpleSSHClient
+
+
+def _get_parser() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "machine",
+        action="store",
+        type=str,
+        help="Machine (or comma-separated machines)",
+    )
+    parser.add_argument(
+        "--name",
+        action="store",
+        type=str,
+        default=None,
+        help="Only show the jobs whose name starts with NAME (default: the jobs of this project; '' for all jobs)",
+    )
+    parser.add_argument(
+        "--state",
+        action="store",
+        type=str,
+        default=None,
+        help="Only show the jobs in these states (comma-separated, e.g., RUNNING,PENDING)",
+    )
+    parser.add_argument(
+        "--limit",
+        action="store",
+        type=int,
+        default=50,
+        help="Show at most LIMIT jobs (the newest ones)",
+    )
+    parser.add_argument(
+        "--cached",
+        action="store_true",
+        help="Don't query the machine, only show what is in the local cache",
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Be verbose"
+    )
+    return parser
+
+
+def _format_memory(num_bytes: int | None) -> str:
+    if not num_bytes:
+        return '-'
+    from rmx.cli._sync_engine import format_bytes
+    return format_bytes(num_bytes)
+
+
+def _show(store, project: Project, machine: Machine, parsed: Namespace):
+    name = f'{machine.user}-rmx-{project.name}' if parsed.name is None else (parsed.name or None)
+    counts = store.count_states(machine.name, name=name)
+    logger.info(f'{machine.name}: ' + (', '.join(f'{state} {num}' for state, num in sorted(counts.items())) or 'no jobs'))
+
+    states = [state.strip().upper() for state in parsed.state.split(',')] if parsed.state else None
+    jobs = store.query(machine.name, name=name, states=states, limit=parsed.limit)
+    if not jobs:
+        return
+    rows = [('JOBID', 'NAME', 'STATE', 'EXIT', 'ELAPSED', 'MAXRSS', 'NODELIST')]
+    rows += [(job['jobid'], job['name'], job['state'], job['exit_code'], job['elapsed'], _format_memory(job['max_rss']),
+              job['nodelist']) for job in reversed(jobs)]
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    print('\n'.join('  '.join(str(val).ljust(width) for val, width in zip(row, widths)).rstrip() for row in rows))
+
+
+def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
+    """Show the slurm jobs on machine.
+
+    The jobs are kept in a local store (see rmx.store.JobStore); each call only asks sacct for the jobs
+    that changed since the last call.
+    """
+    multi_handler([project], [machine], parsed, preset)
+
+
+def multi_handler(projects: list[Project], machines: list[Machine], parsed: Namespace, preset: dict):
+    from rmx.store import JobStore
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    store = JobStore()
+    if not parsed.cached and not parsed.dry_run:
+        from concurrent.futures import ThreadPoolExecutor
+
+        # NOTE: sqlite connections cannot be shared across threads, thus only the queries run in parallel
+        cmds = {machine.name: store.get_refresh_cmd(machine.name) for machine in machines}
+
+        def _refresh(machine):
+            client = SimpleSSHClient(machine.remote_conf)
+            return machine, client.run(cmds[machine.name], hide=True, warn=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(machines))) as executor:
+            for machine, result in executor.map(_refresh, machines):
+                if result.exited != 0:
+                    logger.error(f'Failed to query the jobs on {machine.name}:\n{result.stderr}')
+                    continue
+                store.update(machine.name, result.stdout.splitlines())
+
+    for project, machine in zip(projects, machines):
+        _show(store, project, machine, parsed)
+
+
+name = 'status'
+description = 'show the status of slurm jobs'
+parser = _get_parser()
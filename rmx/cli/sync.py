@@ -1,12 +1,28 @@
+from __future__ import annotations
 from argparse import ArgumentParser, Namespace
+from pathlib import Path
 from rmx import logger
 from rmx.cli._utils import rsync
 from rmx.cli._config_loader import Project, Machine
 from rmx.machine import SimpleSSHClient
+from rmx.cli._sync_engine import (RsyncTask, TarTask, TransferStats, format_bytes, get_tar_compression,
+                                  num_shards_for, parse_rsync_stats, run_sync_tasks, shard_files)
+from rmx.cli._tuning import get_compression
+from rmx.manifest import SyncManifest, scan_tree
+from rmx.filelist import build_file_list
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 
 
 RSYNC_DESTINATION_PATH = "/tmp/".rstrip('/')
 
+# Maximum number of concurrent transfer streams per machine (overridable with "sync_workers" in the config)
+DEFAULT_SYNC_WORKERS = 4
+
+# With "transport": "auto", cold targets with at least this many files are sent as a tar stream instead of rsync
+TAR_MIN_FILES = 1000
+
 
 def _get_parser() -> ArgumentParser:
     parser = ArgumentParser()
@@ -14,7 +30,7 @@ def _get_parser() -> ArgumentParser:
         "machine",
         action="store",
         type=str,
-        help="Machine",
+        help="Machine (or comma-separated machines to sync to all of them at once)",
     )
     parser.add_argument(
         "--verbose",
@@ -22,23 +38,250 @@ def _get_parser() -> ArgumentParser:
         action="store_true",
         help="Be verbose"
     )
+    parser.add_argument(
+        "--full-sync",
+        action="store_true",
+        help="Ignore the local sync manifest and let rsync compare the entire tree.",
+    )
+    parser.add_argument(
+        "--prefetch-images",
+        action="store_true",
+        help="Also pull the images listed under \"docker-images\" (and the docker image of each machine) while syncing.",
+    )
     return parser
 
-def _sync_code(project: Project, machine: Machine, dry_run: bool = False):
-    # rsync_options = f"--rsync-path='mkdir -p {project.remote_dir} && mkdir -p {project.remote_outdir} && mkdir -p {project.remote_mountdir} && rsync'"
 
+def _scan_source(source_dir, exclude=None, use_gitignore: bool = False, manifests: list[SyncManifest] = ()) -> Namespace:
+    """List and hash the files under source_dir. Hashes recorded in any of the manifests are reused."""
+    cache = {}
+    for manifest in manifests:
+        cache.update(manifest.entries)
+    # NOTE: As every transfer gets an explicit file list, rsync does not need --exclude flags anymore.
+    files = build_file_list(source_dir, exclude=exclude, use_gitignore=use_gitignore)
+    entries = scan_tree(source_dir, files=files, cache=cache)
+    return Namespace(files=[path for path in files if path in entries], entries=entries)
+
+
+def _plan_sync(machine: Machine, source: Namespace, scan: Namespace, options: str = '', full: bool = False,
+               max_streams: int = 1, transport: str = 'auto', client: SimpleSSHClient | None = None,
+               compression: str = 'zlib', ssh_command: str | None = None, remote_dirs: list[str] = (),
+               dry_run: bool = False) -> Namespace:
+    """Compare the scan of a source directory with its manifest and return the transfer tasks needed to bring
+    the target up to date.
+
+    The returned plan holds the scan, which should be saved to the manifest only once all of its tasks succeed.
+    With source.link_dest (a remote directory with the previous content of the target), rsync hardlinks unchanged
+    files from there instead of transferring them.
+    """
+    manifest, entries = source.manifest, scan.entries
+    target_dir = machine.uri(source.target_path)
+    plan = Namespace(manifest=manifest, entries=entries, tasks=[])
+
+    if manifest.exists and not full:
+        changed, removed = manifest.diff(entries)
+        if not changed:
+            logger.info(f'{source.label}: no changes since the last sync. Skipping rsync.')
+            return plan
+        logger.info(f'{source.label}: {len(changed)} files changed since the last sync.')
+        files = changed
+    else:
+        files = scan.files
+
+    # rsync has to negotiate every file with the remote, which is slow for a cold target with many small files.
+    # A tar stream is just a pipe, so we use it for cold targets.
+    cold = not manifest.exists
+    if source.link_dest is not None:
+        # Only rsync can hardlink against the previous snapshot
+        transport = 'rsync'
+        options = f"{options} --link-dest='{source.link_dest}'"
+    elif transport == 'auto':
+        transport = 'tar' if cold and len(entries) >= TAR_MIN_FILES else 'rsync'
+
+    tar_compression = None
+    if transport == 'tar' and dry_run:
+        tar_compression = machine.parsed_conf.get('tar_compression') or 'zstd'
+    elif transport == 'tar':
+        # NOTE: Both sides need the compressor. Without one on the remote, we fall back to rsync.
+        tar_compression = get_tar_compression(client, machine.parsed_conf.get('tar_compression'))
+        if tar_compression is None:
+            logger.warning(f'{source.label}: neither zstd nor gzip is found on the remote. Falling back to rsync.')
+            transport = 'rsync'
+
+    # Split large transfers into shards that run as parallel streams.
+    sizes = {path: entry[0] for path, entry in entries.items()}
+    num_shards = num_shards_for(files, sizes, max_streams)
+    shards = shard_files(files, sizes, num_shards) if num_shards > 1 else [files]
+
+    for idx, shard in enumerate(shards):
+        label = f'{source.label} (shard {idx + 1}/{len(shards)})' if len(shards) > 1 else source.label
+        if transport == 'tar':
+            task = TarTask(client, source.source_dir, source.target_path, label, files=shard,
+                           transfer_rootdir=source.transfer_rootdir, compression=tar_compression,
+                           remote_dirs=remote_dirs)
+        else:
+            task = RsyncTask(source.source_dir, target_dir, label, options=options,
+                             transfer_rootdir=source.transfer_rootdir, files_from=shard, compression=compression,
+                             ssh_command=ssh_command)
+        plan.tasks.append(task)
+    return plan
+
+
+def _get_sources(project: Project, machine: Machine, link_dest: Namespace | None = None) -> list[Namespace]:
+    """The local directories to sync to machine: the project directory and the directories to mount."""
+    rmxdirs = machine.get_rmxdirs(project.name)
+    sources = [Namespace(source_dir=project.rootdir, target_path=rmxdirs.codedir, label=f'{machine.name}: code',
+                         transfer_rootdir=False, link_dest=link_dest.codedir if link_dest else None)]
+    sources += [Namespace(source_dir=mount_dir, target_path=rmxdirs.mountdir,
+                          label=f'{machine.name}: mount {mount_dir}', transfer_rootdir=True,
+                          link_dest=link_dest.mountdir if link_dest else None)
+                for mount_dir in project.mount_dirs]
+    for source in sources:
+        source.manifest = SyncManifest.for_target(source.source_dir, machine.uri(source.target_path))
+        source.scan_key = (str(Path(source.source_dir).resolve()), tuple(project.exclude or []), project.use_gitignore)
+    return sources
+
+
+def _sentinel_path(source: Namespace) -> str:
+    return f'{source.target_path}/{source.manifest.sentinel_name}'
+
+
+def _check_sentinels(client: SimpleSSHClient, sources: list[Namespace]) -> list[Namespace]:
+    """Return the sources whose manifest does not describe the remote anymore (e.g., the target was wiped).
+
+    The sync id of the last sync is compared with the sentinel file in each target, in a single ssh call.
+    """
+    import shlex
+    paths = {_sentinel_path(source): source for source in sources if source.manifest.exists}
+    if not paths:
+        return []
+    # NOTE: grep -H prints <path>:<content>, and skips the missing files
+    result = client.run(f"grep -H '' {' '.join(shlex.quote(path) for path in paths)} 2>/dev/null ; true",
+                        hide=True, warn=True)
+    remote_ids = {}
+    for line in result.stdout.splitlines():
+        path, _, sync_id = line.rpartition(':')
+        remote_ids[path] = sync_id.strip()
+    return [source for path, source in paths.items()
+            if source.manifest.sync_id is None or remote_ids.get(path) != source.manifest.sync_id]
+
+
+def _write_sentinels(client: SimpleSSHClient, sources: list[Namespace]) -> None:
+    """Record the sync id of the manifests in the targets, in a single ssh call."""
+    import shlex
+    if not sources:
+        return
+    cmd = ' && '.join(f'echo {shlex.quote(source.manifest.sync_id)} > {shlex.quote(_sentinel_path(source))}'
+                      for source in sources)
+    result = client.run(cmd, hide=True, warn=True)
+    if result.exited != 0:
+        # Not fatal: the next sync just transfers everything again
+        logger.warning(f'Failed to record the sync in the remote targets: {result.stderr.strip()}')
+
+
+def _push(project: Project, machine: Machine, sources: list[Namespace], scans: dict, dry_run: bool = False,
+          full: bool = False) -> TransferStats:
+    """Transfer what changed in the (already scanned) sources to machine."""
     # A trick to create directories right before performing rsync
+    # NOTE: Every stream creates the directories, as we don't know which one reaches the remote first.
     rmxdirs = machine.get_rmxdirs(project.name)
     rsync_options = f"--rsync-path='mkdir -p {rmxdirs.codedir} && mkdir -p {rmxdirs.outdir} && mkdir -p {rmxdirs.mountdir} && rsync'"
+    max_workers = machine.parsed_conf.get('sync_workers', DEFAULT_SYNC_WORKERS)
+
+    transport = machine.parsed_conf.get('transport', 'auto')
+    if transport not in ['auto', 'rsync', 'tar']:
+        raise ValueError(f'Unrecognized transport: {transport}. Choose from "auto", "rsync" or "tar".')
+    client = SimpleSSHClient(machine.remote_conf)
+    master = machine.remote_conf.get_master()
+    if not dry_run:
+        master.start()
+        # The manifests are local: make sure the remote still has what they describe before skipping anything
+        for source in _check_sentinels(client, sources):
+            if source.manifest.exists and not full:
+                logger.info(f'{source.label}: the remote copy does not match the last sync. Transferring everything.')
+            source.manifest.invalidate()
+    compression = get_compression(machine, dry_run=dry_run)
 
+    plans = [_plan_sync(machine, source, scans[source.scan_key], options=rsync_options, full=full,
+                        max_streams=max_workers, transport=transport, client=client, compression=compression,
+                        ssh_command=master.ssh_command,
+                        remote_dirs=[rmxdirs.codedir, rmxdirs.outdir, rmxdirs.mountdir], dry_run=dry_run)
+             for source in sources]
+    tasks = [task for plan in plans for task in plan.tasks]
     try:
-        rsync(source_dir=project.rootdir, target_dir=machine.uri(rmxdirs.codedir),
-                        exclude=project.exclude, options=rsync_options, dry_run=dry_run, transfer_rootdir=False)
+        if not tasks:
+            return TransferStats()
+        logger.info(f'{machine.name}: syncing code with {len(tasks)} streams (rsync compression: {compression})...')
+        stats = run_sync_tasks(tasks, max_workers=max_workers, dry_run=dry_run)
+        logger.info(f'{machine.name}: sync finished: {stats.summary()}')
+        return stats
+    finally:
+        # Only record the directories whose streams all succeeded
+        if not dry_run:
+            synced = []
+            for source, plan in zip(sources, plans):
+                if all(task.done for task in plan.tasks):
+                    # NOTE: The sync id (and thus the sentinel) only changes when something was transferred
+                    plan.manifest.save(plan.entries, sync_id=None if plan.tasks else plan.manifest.sync_id)
+                    if plan.tasks:
+                        synced.append(source)
+            _write_sentinels(client, synced)
+
+
+def _sync_code_many(projects: list[Project], machines: list[Machine], dry_run: bool = False, full: bool = False,
+                    link_dests: list[Namespace | None] | None = None) -> dict:
+    """Sync the project to multiple machines.
 
-        # rsync the directories to mount
-        for mount_dir in project.mount_dirs:
-            rsync(source_dir=mount_dir, target_dir=machine.uri(rmxdirs.mountdir),
-                                exclude=project.exclude, dry_run=dry_run)
+    The local directories are listed and hashed once, and then pushed to all machines concurrently.
+    Returns {machine name: TransferStats}. Raises OSError once all pushes are done if any of them failed.
+    """
+    link_dests = [None] * len(machines) if link_dests is None else link_dests
+    sources = [_get_sources(project, machine, link_dest)
+               for project, machine, link_dest in zip(projects, machines, link_dests)]
+
+    # Scan each distinct source directory once, reusing the hashes from the manifests of every target.
+    unique_sources = {}
+    for source in (source for _sources in sources for source in _sources):
+        unique_sources.setdefault(source.scan_key, []).append(source)
+    max_workers = max(machine.parsed_conf.get('sync_workers', DEFAULT_SYNC_WORKERS) for machine in machines)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        scans = dict(zip(unique_sources, executor.map(
+            lambda key: _scan_source(unique_sources[key][0].source_dir, exclude=list(key[1]), use_gitignore=key[2],
+                                     manifests=[source.manifest for source in unique_sources[key]]),
+            unique_sources
+        )))
+
+    results, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+        futures = {machine.name: executor.submit(_push, project, machine, _sources, scans, dry_run=dry_run, full=full)
+                   for project, machine, _sources in zip(projects, machines, sources)}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except OSError as e:
+                failures[name] = e
+
+    if len(machines) > 1:
+        logger.info('Sync summary:')
+        for machine in machines:
+            if machine.name in results:
+                logger.info(f'  {machine.name:<20} {results[machine.name].summary()}')
+            else:
+                logger.error(f'  {machine.name:<20} FAILED')
+    if failures:
+        msg = '\n\n'.join(f'{name}:\n{e}' for name, e in failures.items())
+        raise OSError(f'Sync failed on {len(failures)} of {len(machines)} machines.\n{msg}')
+    return results
+
+
+def _sync_code(project: Project, machine: Machine, dry_run: bool = False, full: bool = False,
+               link_dest: Namespace | None = None):
+    """Sync the project directory and the directories to mount to the machine.
+
+    link_dest: rmxdirs of a previous snapshot on the remote to hardlink unchanged files from (used by --contain)
+    """
+    # rsync_options = f"--rsync-path='mkdir -p {project.remote_dir} && mkdir -p {project.remote_outdir} && mkdir -p {project.remote_mountdir} && rsync'"
+    try:
+        _sync_code_many([project], [machine], dry_run=dry_run, full=full, link_dests=[link_dest])
     except OSError:
         import traceback
         import sys
@@ -46,23 +289,34 @@ def _sync_code(project: Project, machine: Machine, dry_run: bool = False):
         sys.exit(1)
 
 
+def _pull_output(project: Project, machine: Machine, dry_run: bool = False) -> dict:
+    """rsync the remote outdir into the local outdir. rsync only transfers new or changed files."""
+    rmxdirs = machine.get_rmxdirs(project.name)
+    start = time.time()
+    # NOTE: The remote outdir may not exist yet (e.g., the job has not written anything).
+    # Create it right before rsync (the same trick as _push) so that this just pulls zero files.
+    out = rsync(source_dir=machine.uri(rmxdirs.outdir), target_dir=project.outdir, dry_run=dry_run,
+                options=f"--rsync-path='mkdir -p {rmxdirs.outdir} && rsync'",
+                compression=get_compression(machine, dry_run=dry_run),
+                ssh_command=machine.remote_conf.get_master().ssh_command)
+    stats = parse_rsync_stats(out.stdout.decode('utf-8', 'ignore')) if out is not None else {}
+    stats['elapsed'] = time.time() - start
+    return stats
+
 
 def _sync_output(project: Project, machine: Machine, dry_run: bool = False):
     # Rsync remote outdir with the local outdir.
     if project.outdir:
         try:
-            rmxdirs = machine.get_rmxdirs(project.name)
-            # Check if there's any output file (the first line is always 'total [num-files]')
-            ssh_client = SimpleSSHClient(machine.remote_conf)
-
-            result = ssh_client.run(f'ls -l {rmxdirs.outdir} | grep -v "^total" | wc -l', hide=True)
-            num_output_files = int(result.stdout)
-
-            msg = f'{num_output_files} files are in the output directory'
-            logger.info(msg)
-            if num_output_files > 0:
-                rsync(source_dir=machine.uri(rmxdirs.outdir), target_dir=project.outdir,
-                    dry_run=dry_run)
+            # NOTE: We used to count the remote output files with a separate `ls` before rsync,
+            # but rsync already skips unchanged files and reports what it transferred.
+            stats = _pull_output(project, machine, dry_run=dry_run)
+            num_files = stats.get('files_transferred', 0)
+            num_bytes = stats.get('bytes_sent', 0) + stats.get('bytes_received', 0)
+            logger.info(f'{num_files} new or updated output files '
+                        f'({format_bytes(num_bytes)} in {stats["elapsed"]:.1f}s, '
+                        f'{format_bytes(num_bytes / max(stats["elapsed"], 1e-6))}/s)')
+            if num_files > 0:
                 logger.info(f'The output files are copied to {str(project.outdir)}')
 
         except OSError:
@@ -75,6 +329,74 @@ def _sync_output(project: Project, machine: Machine, dry_run: bool = False):
         logger.warning('project.outdir is set to None. Doing nothing here.')
 
 
+class OutputWatcher:
+    """Pull new and changed output files in a background thread while a job is running."""
+    def __init__(self, project: Project, machine: Machine, interval: float, dry_run: bool = False) -> None:
+        self.project = project
+        self.machine = machine
+        self.interval = interval
+        self.dry_run = dry_run
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stats = _pull_output(self.project, self.machine, dry_run=self.dry_run)
+            except OSError as e:
+                logger.warning(f'Failed to pull output files: {e}')
+                continue
+            if stats.get('files_transferred', 0) > 0:
+                logger.info(f'Pulled {stats["files_transferred"]} new or updated output files')
+
+    def start(self):
+        if self.project.outdir is None:
+            logger.warning('project.outdir is set to None. Output files are not pulled.')
+            return
+        logger.info(f'Pulling output files every {self.interval} seconds')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def wait(self, done=None):
+        """Keep pulling while a disowned job is running.
+
+        done: a function that returns True once the job has finished (checked every interval).
+          Without it, this keeps pulling until interrupted.
+        The caller is expected to pull one last time afterwards (e.g., _sync_output).
+        """
+        if done is None:
+            logger.info('Press Ctrl-C to stop pulling output files')
+        try:
+            while self._thread.is_alive():
+                self._thread.join(timeout=self.interval)
+                if done is not None and done():
+                    logger.info('The job has finished.')
+                    break
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+
+def _prefetch_images(machines: list[Machine], parsed: Namespace, preset: dict) -> list:
+    """Start pulling the docker images on each machine in the background (for --prefetch-images)."""
+    from ._docker import get_preset_images, prefetch_images
+    if not parsed.prefetch_images or parsed.dry_run:
+        return []
+    futures = []
+    for machine in machines:
+        images = get_preset_images(preset)
+        image = machine.parsed_conf.get('docker', {}).get('image')
+        if image is not None:
+            images.append(image)
+        if images:
+            futures.append(prefetch_images(machine, images))
+    return futures
+
+
 def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
     """Deploy the local repository and execute the command on a machine.
 
@@ -85,8 +407,33 @@ def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict)
     logger.debug(f'handling command for {__file__}')
     logger.debug(f'parsed: {parsed}')
 
-    _sync_code(project, machine, dry_run=parsed.dry_run)
+    from ._docker import wait_prefetch
+    prefetches = _prefetch_images([machine], parsed, preset)
+    _sync_code(project, machine, dry_run=parsed.dry_run, full=parsed.full_sync)
     _sync_output(project, machine, dry_run=parsed.dry_run)
+    for prefetch in prefetches:
+        wait_prefetch(prefetch)
+
+
+def multi_handler(projects: list[Project], machines: list[Machine], parsed: Namespace, preset: dict):
+    """Scan the local project once and push it to all machines concurrently."""
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    from ._docker import wait_prefetch
+    prefetches = _prefetch_images(machines, parsed, preset)
+    try:
+        _sync_code_many(projects, machines, dry_run=parsed.dry_run, full=parsed.full_sync)
+    except OSError:
+        import traceback
+        import sys
+        print(traceback.format_exc(0), file=sys.stderr)
+        sys.exit(1)
+
+    for project, machine in zip(projects, machines):
+        _sync_output(project, machine, dry_run=parsed.dry_run)
+    for prefetch in prefetches:
+        wait_prefetch(prefetch)
 
 
 name = 'sync'
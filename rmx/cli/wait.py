@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+from argparse import ArgumentParser, Namespace
+from rmx import logger
+from rmx.cli._config_loader import Project, Machine
+from rmx.machine import SimpleSSHClient
+
+# Slurm states of the jobs that are not done yet
+SLURM_ACTIVE_STATES = {'PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'REQUEUED', 'RESIZING', 'SUSPENDED',
+                       'STAGE_OUT', 'SIGNALING', 'REQUEUE_HOLD', 'REQUEUE_FED'}
+DOCKER_ACTIVE_STATES = {'created', 'running', 'restarting', 'paused', 'removing'}
+# States that count as a success in the aggregate status
+SUCCESS_STATES = {'COMPLETED'}
+
+SQUEUE_CMD = "squeue --noheader --user $(whoami) --format '%i|%T'"
+
+# sacct may not know about a job right after it leaves the queue; give up on its final state after this many polls
+MAX_SACCT_MISSES = 3
+
+
+def _get_parser() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument(
+        "machine",
+        action="store",
+        type=str,
+        help="Machine (or comma-separated machines)",
+    )
+    parser.add_argument(
+        "--jobs",
+        action="store",
+        type=str,
+        default=None,
+        help="Comma-separated slurm job ids or container names to wait for (default: the latest launch on the machine)",
+    )
+    parser.add_argument(
+        "--interval",
+        action="store",
+        type=float,
+        default=5.,
+        help="Initial seconds between polls. It grows up to MAX_INTERVAL while nothing changes.",
+    )
+    parser.add_argument(
+        "--max-interval",
+        action="store",
+        type=float,
+        default=60.,
+        help="Maximum seconds between polls",
+    )
+    parser.add_argument(
+        "--timeout",
+        action="store",
+        type=float,
+        default=None,
+        help="Give up after TIMEOUT seconds (exit code 2)",
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Be verbose"
+    )
+    return parser
+
+
+def expand_array(jobid: str) -> list[str]:
+    """The tasks of a pending job array in squeue: 123_[0-3,7%2] --> [123_0, 123_1, 123_2, 123_3, 123_7]"""
+    if '_[' not in jobid:
+        return [jobid]
+    base, ranges = jobid.rstrip(']').split('_[')
+    tasks = []
+    for part in ranges.split('%')[0].split(','):
+        begin, _, end = part.partition('-')
+        tasks += [f'{base}_{idx}' for idx in range(int(begin), int(end or begin) + 1)]
+    return tasks
+
+
+def parse_squeue(stdout: str) -> dict[str, str]:
+    """{jobid: state} of the jobs in the queue"""
+    states = {}
+    for line in stdout.splitlines():
+        if '|' not in line:
+            continue
+        jobid, state = line.strip().split('|', 1)
+        for task in expand_array(jobid):
+            states[task] = state
+    return states
+
+
+class SlurmWaiter:
+    """Checks all the jobs on a machine with a single squeue call per poll.
+
+    The final state of the jobs that left the queue is read from sacct (through JobStore), in one call per poll.
+    """
+    def __init__(self, machine: Machine, jobids: list[str], client: SimpleSSHClient | None = None) -> None:
+        self.machine = machine
+        self.client = client or SimpleSSHClient(machine.remote_conf)
+        self.pending = set(jobids)
+        self.states = {}
+        self._misses = {}
+
+    def prepare(self, store) -> str:
+        return store.get_refresh_cmd(self.machine.name)
+
+    def check(self, refresh_cmd: str) -> Namespace:
+        """Runs in a worker thread (without touching the store)"""
+        result = self.client.run(SQUEUE_CMD, hide=True, warn=True)
+        if result.exited != 0:
+            logger.warning(f'{self.machine.name}: squeue failed: {result.stderr.strip()}')
+            return Namespace(gone=[], sacct=None)
+        queued = parse_squeue(result.stdout)
+        gone = [jobid for jobid in self.pending if jobid not in queued]
+        sacct = None
+        if gone:
+            result = self.client.run(refresh_cmd, hide=True, warn=True)
+            sacct = result.stdout.splitlines() if result.exited == 0 else None
+        return Namespace(gone=gone, sacct=sacct)
+
+    def update(self, data: Namespace, store) -> bool:
+        """Returns True if any of the jobs finished"""
+        if data.sacct is not None:
+            store.update(self.machine.name, data.sacct)
+        jobs = store.get(self.machine.name, data.gone)
+        changed = False
+        for jobid in data.gone:
+            job = jobs.get(jobid)
+            if job is not None and job['state'] not in SLURM_ACTIVE_STATES:
+                self.states[jobid] = job['state']
+            else:
+                self._misses[jobid] = self._misses.get(jobid, 0) + 1
+                if self._misses[jobid] < MAX_SACCT_MISSES:
+                    continue
+                self.states[jobid] = 'UNKNOWN'
+            self.pending.discard(jobid)
+            changed = True
+        return changed
+
+
+class DockerWaiter:
+    """Checks all the containers on a machine with a single `docker ps` (containers.list) call per poll.
+
+    The containers are removed once they exit (auto_remove), so the exit codes of the ones that are gone are read
+    from the files they write next to their logs (see rmx.runner.get_exit_path), in a single ssh call.
+    """
+    def __init__(self, machine: Machine, names: list[str], exit_paths: dict[str, str] | None = None,
+                 runner=None, client: SimpleSSHClient | None = None) -> None:
+        """exit_paths: {container name: the file on the host with its exit code}"""
+        self.machine = machine
+        if runner is None:
+            from rmx.runner import DockerRunner
+            from ._docker import get_docker_client
+            runner = DockerRunner(get_docker_client(machine)[0], rmxdirs=None)
+        self.runner = runner
+        self.client = client or SimpleSSHClient(machine.remote_conf)
+        self.exit_paths = exit_paths or {}
+        self.pending = set(names)
+        self.states = {}
+
+    def prepare(self, store) -> None:
+        return None
+
+    def _read_exit_codes(self, names: list[str]) -> dict[str, int]:
+        import shlex
+        paths = {self.exit_paths[name]: name for name in names if name in self.exit_paths}
+        if not paths:
+            return {}
+        # NOTE: grep -H prints <path>:<content>, and skips the missing files
+        result = self.client.run(f"grep -H '' {' '.join(shlex.quote(path) for path in paths)} 2>/dev/null ; true",
+                                 hide=True, warn=True)
+        exit_codes = {}
+        for line in result.stdout.splitlines():
+            path, _, code = line.rpartition(':')
+            if path in paths and code.strip().lstrip('-').isdigit():
+                exit_codes[paths[path]] = int(code)
+        return exit_codes
+
+    def check(self, _) -> Namespace:
+        """Runs in a worker thread"""
+        import os
+        containers = self.runner.find_containers(os.path.commonprefix(sorted(self.pending)))
+        containers = {name: (container.status, container.attrs.get('State', {}).get('ExitCode'))
+                      for name, container in containers.items()}
+        done = [name for name in self.pending if containers.get(name, (None,))[0] not in DOCKER_ACTIVE_STATES]
+        return Namespace(containers=containers, exit_codes=self._read_exit_codes(done))
+
+    def update(self, data: Namespace, store) -> bool:
+        changed = False
+        for name in list(self.pending):
+            status, exit_code = data.containers.get(name, (None, None))
+            if status in DOCKER_ACTIVE_STATES:
+                continue
+            exit_code = data.exit_codes.get(name, exit_code)
+            if exit_code is None:
+                # Removed without leaving its exit code (e.g., killed, or launched without a log directory)
+                self.states[name] = 'UNKNOWN'
+            else:
+                self.states[name] = 'COMPLETED' if exit_code == 0 else f'FAILED ({exit_code})'
+            self.pending.discard(name)
+            changed = True
+        return changed
+
+
+def _get_waiter(project: Project, machine: Machine, parsed: Namespace):
+    from rmx.runner import get_exit_path
+    from .run import get_docker_log_path
+    from rmx.store import LaunchHistory
+    mode = machine.parsed_conf.get('mode') or 'ssh'
+    if parsed.jobs:
+        jobids = [jobid.strip() for jobid in parsed.jobs.split(',') if jobid.strip()]
+        # NOTE: The containers are gone once they exit, so their exit codes are found via the launch history
+        launches = list(LaunchHistory().get(machine.name, jobids).values())
+    else:
+        launches = [launch for launch in LaunchHistory().latest(project=project.name, machine=machine.name)
+                    if launch['jobid'] is not None]
+        if not launches:
+            logger.warning(f'{machine.name}: no slurm jobs or containers of {project.name} were launched recently')
+            return None
+        mode = launches[0]['mode']
+        jobids = [launch['jobid'] for launch in launches]
+    exit_paths = {launch['jobid']: get_exit_path(get_docker_log_path(launch['logdir'], launch['sweep_idx']))
+                  for launch in launches if launch['logdir'] is not None}
+
+    if mode in ['slurm', 'slurm-sing', 'sing-slurm']:
+        return SlurmWaiter(machine, jobids)
+    elif mode == 'docker':
+        return DockerWaiter(machine, jobids, exit_paths=exit_paths)
+    logger.warning(f'{machine.name}: cannot wait for jobs in {mode} mode')
+    return None
+
+
+def wait(waiters: list, interval: float = 5., max_interval: float = 60., timeout: float | None = None,
+         store=None) -> bool:
+    """Poll all the machines until every job finishes (or timeout). Returns False on timeout.
+
+    Each poll checks all the jobs on a machine at once, and the machines in parallel. The interval between polls
+    grows by 1.5x while nothing changes (up to max_interval), and goes back to interval when some jobs finish.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    if store is None:
+        from rmx.store import JobStore
+        store = JobStore()
+    total = sum(len(waiter.pending) for waiter in waiters)
+    start = time.time()
+    delay = interval
+    with ThreadPoolExecutor(max_workers=max(1, len(waiters))) as executor:
+        while True:
+            active = [waiter for waiter in waiters if waiter.pending]
+            if not active:
+                return True
+            # NOTE: sqlite connections cannot be shared across threads, thus only the remote calls run in parallel
+            args = [waiter.prepare(store) for waiter in active]
+            results = list(executor.map(lambda waiter, arg: waiter.check(arg), active, args))
+            changed = False
+            for waiter, data in zip(active, results):
+                changed |= waiter.update(data, store)
+
+            num_done = total - sum(len(waiter.pending) for waiter in waiters)
+            if changed:
+                num_failed = sum(state not in SUCCESS_STATES for waiter in waiters for state in waiter.states.values())
+                logger.info(f'{num_done}/{total} jobs finished ({num_failed} failed)')
+            if num_done == total:
+                return True
+            if timeout is not None and time.time() - start + delay > timeout:
+                return False
+            delay = interval if changed else min(delay * 1.5, max_interval)
+            time.sleep(delay)
+
+
+def handler(project: Project, machine: Machine, parsed: Namespace, preset: dict):
+    """Wait until the jobs launched with -d finish. Exits with 1 if any of them failed, or 2 on timeout."""
+    multi_handler([project], [machine], parsed, preset)
+
+
+def multi_handler(projects: list[Project], machines: list[Machine], parsed: Namespace, preset: dict):
+    import sys
+    logger.debug(f'handling command for {__file__}')
+    logger.debug(f'parsed: {parsed}')
+
+    waiters = [_get_waiter(project, machine, parsed) for project, machine in zip(projects, machines)]
+    waiters = [waiter for waiter in waiters if waiter is not None]
+    if not waiters or parsed.dry_run:
+        return
+    for waiter in waiters:
+        logger.info(f'{waiter.machine.name}: waiting for {len(waiter.pending)} jobs')
+
+    finished = wait(waiters, interval=parsed.interval, max_interval=parsed.max_interval, timeout=parsed.timeout)
+
+    failed = [(waiter.machine.name, jobid, state) for waiter in waiters for jobid, state in sorted(waiter.states.items())
+              if state not in SUCCESS_STATES]
+    for name, jobid, state in failed:
+        logger.error(f'  {name}: {jobid} {state}')
+    if not finished:
+        logger.error(f'Timed out with {sum(len(waiter.pending) for waiter in waiters)} jobs still running.')
+        sys.exit(2)
+    if failed:
+        sys.exit(1)
+    logger.info('All jobs finished successfully.')
+
+
+name = 'wait'
+description = 'wait for launched jobs to finish'
+parser = _get_parser()
@@ -7,9 +7,13 @@ from rmx import logger
 
 class DockerContainerConfig:
     def __init__(self, image, name, env: dict | None = None, remove=True, network='host', ipc_mode='host', mounts=None,
-                 startup: str | None = None, tty=True, use_gpus=True, user_id: int = 0, group_id: int = 0, runtime='docker') -> None:
+                 startup: str | None = None, tty=True, use_gpus=True, user_id: int = 0, group_id: int = 0, runtime='docker',
+                 umask: str | None = '000', log_path: str | None = None) -> None:
         """
         user_id (int | str): The format is either 2003 for user_id or 2003:4000 to specify user id and group id.
+        umask: applied before the command, so that the files it creates in the mounted directories are writable by
+          the user on the host even when the container runs as root (None to keep the image default)
+        log_path: also write the output of the command to this file in the container (e.g., a mounted log directory)
         """
         self.image = image
         self.name = name
@@ -25,6 +29,8 @@ class DockerContainerConfig:
         self.use_gpus = use_gpus
         self.user_id = user_id
         self.group_id = group_id
+        self.umask = umask
+        self.log_path = log_path
 
         if use_gpus:
             self.add_gpus()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Build the list of files to sync, honoring .rmxignore, project.exclude and (with use_gitignore) .gitignore.
+
+The listing of each directory is cached together with its mtime (and the mtimes of its ignore files),
+so unchanged directories are not listed again on the next sync.
+"""
+from __future__ import annotations
+import os
+import re
+import json
+import hashlib
+from os.path import expandvars
+from pathlib import Path
+
+FILELIST_CACHE_DIR = expandvars('$HOME/.rmx/filelists')
+FILELIST_CACHE_VERSION = 1
+
+IGNORE_FILES = ['.gitignore', '.rmxignore']
+
+
+def _translate(pattern: str) -> str:
+    """Translate a glob pattern (with gitignore's ** semantics) into a regex."""
+    regex = ''
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/') and i + 2 == n:
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[':
+            j = pattern.find(']', i + 2)
+            if j == -1:
+                regex += re.escape('[')
+                i += 1
+                continue
+            body = pattern[i + 1:j]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex += f'[{body}]'
+            i = j + 1
+        elif pattern[i] == '\\' and i + 1 < n:
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class IgnoreRule:
+    """A single compiled ignore pattern.
+
+    style='gitignore': patterns with a slash (other than a trailing one) are relative to the ignore file's directory
+    style='rsync'    : only a leading slash anchors the pattern (rsync --exclude semantics)
+    """
+    def __init__(self, pattern: str, base: str = '', style: str = 'gitignore') -> None:
+        self.negate = False
+        if style == 'gitignore' and pattern.startswith('!'):
+            self.negate = True
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if style == 'gitignore':
+            anchored = '/' in pattern
+        else:
+            anchored = pattern.startswith('/')
+        pattern = pattern.lstrip('/')
+
+        prefix = '' if anchored else '(?:.*/)?'
+        self.regex = re.compile(f'^{prefix}{_translate(pattern)}$')
+        self.base = base
+
+    def match(self, relpath: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        if not relpath.startswith(self.base):
+            return False
+        return self.regex.match(relpath[len(self.base):]) is not None
+
+
+def parse_ignore_lines(lines: list[str], base: str = '') -> list[IgnoreRule]:
+    """Compile the lines of a .gitignore-style file located at base (a relative directory path ending with '/')."""
+    rules = []
+    for line in lines:
+        line = re.sub(r'(?<!\\) +$', '', line.rstrip('\r\n'))
+        if not line or line.startswith('#') or line in ['!', '/']:
+            continue
+        rules.append(IgnoreRule(line, base=base))
+    return rules
+
+
+def is_ignored(relpath: str, is_dir: bool, rules: list[IgnoreRule]) -> bool:
+    """The last matching rule wins, as in git."""
+    ignored = False
+    for rule in rules:
+        if rule.match(relpath, is_dir):
+            ignored = not rule.negate
+    return ignored
+
+
+def is_excluded(relpath: str, patterns: list[str], is_dir: bool = False) -> bool:
+    """Whether relpath matches any of the rsync-style --exclude patterns.
+
+    - 'foo'    : matches any file or directory named foo at any depth
+    - 'a/b'    : matches 'a/b' at any depth
+    - '/foo'   : anchored to the source root
+    - 'foo/'   : only matches directories
+    """
+    return any(IgnoreRule(pattern, style='rsync').match(relpath, is_dir) for pattern in patterns)
+
+
+class FileListBuilder:
+    """Walk a directory tree with os.scandir and list every file (and symlink) that should be synced."""
+    def __init__(self, rootdir: str | Path, exclude: list[str] | None = None, use_gitignore: bool = False,
+                 cache_dir: str | Path | None = FILELIST_CACHE_DIR) -> None:
+        self.rootdir = str(Path(rootdir).resolve())
+        self.exclude_rules = [IgnoreRule(pattern, style='rsync') for pattern in (exclude or [])]
+        self.ignore_files = IGNORE_FILES if use_gitignore else [f for f in IGNORE_FILES if f != '.gitignore']
+
+        # Cached listings are only valid for the same set of rules
+        signature = json.dumps([self.rootdir, exclude or [], self.ignore_files, FILELIST_CACHE_VERSION])
+        self.signature = hashlib.sha1(signature.encode('utf-8')).hexdigest()
+        self.cache_path = None if cache_dir is None else Path(cache_dir) / f'{self.signature}.json'
+        self._cache = self._load_cache()
+        self._new_cache = {}
+
+    def _load_cache(self) -> dict:
+        from rmx.helpers import load_json_cached
+        if self.cache_path is None:
+            return {}
+        try:
+            return load_json_cached(self.cache_path)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_cache(self) -> None:
+        if self.cache_path is None:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._new_cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _ignore_file_stamps(self, dirpath: str) -> list:
+        stamps = []
+        for name in self.ignore_files:
+            try:
+                stamps.append(os.stat(os.path.join(dirpath, name)).st_mtime_ns)
+            except FileNotFoundError:
+                stamps.append(None)
+        return stamps
+
+    def _read_ignore_lines(self, dirpath: str) -> list[str]:
+        lines = []
+        for name in self.ignore_files:
+            try:
+                with open(os.path.join(dirpath, name), 'r') as f:
+                    lines += f.readlines()
+            except (FileNotFoundError, UnicodeDecodeError):
+                continue
+        return lines
+
+    def _list_dir(self, dirpath: str, reldir: str, rules: list[IgnoreRule], rules_key: str) -> dict:
+        """Return {'files': [...], 'dirs': [...], 'ignore': [...]} for a directory, from the cache when possible.
+
+        rules_key identifies the rules inherited from the parent directories, as the listing depends on them too.
+        """
+        stamp = [os.stat(dirpath).st_mtime_ns, self._ignore_file_stamps(dirpath)]
+        cached = self._cache.get(reldir)
+        if cached is not None and cached['stamp'] == stamp and cached['rules_key'] == rules_key:
+            self._new_cache[reldir] = cached
+            return cached
+
+        ignore_lines = self._read_ignore_lines(dirpath)
+        local_rules = rules + parse_ignore_lines(ignore_lines, base=reldir)
+        files, dirs = [], []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                relpath = reldir + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_ignored(relpath, is_dir, local_rules) or \
+                   any(rule.match(relpath, is_dir) for rule in self.exclude_rules):
+                    continue
+                (dirs if is_dir else files).append(entry.name)
+        listing = {'stamp': stamp, 'rules_key': rules_key, 'ignore': ignore_lines,
+                   'files': sorted(files), 'dirs': sorted(dirs)}
+        self._new_cache[reldir] = listing
+        return listing
+
+    def build(self) -> list[str]:
+        """List the files relative to rootdir.
+
+        Directories are only listed (with a trailing slash) when they have nothing else to sync, so that
+        the empty directories are created on the remote too.
+        """
+        files = []
+        root_lines = []
+        git_exclude = os.path.join(self.rootdir, '.git', 'info', 'exclude')
+        if '.gitignore' in self.ignore_files and os.path.isfile(git_exclude):
+            with open(git_exclude, 'r') as f:
+                root_lines = f.readlines()
+
+        stack = [('', parse_ignore_lines(root_lines), _chain_key('', '', root_lines))]
+        while stack:
+            reldir, rules, rules_key = stack.pop()
+            listing = self._list_dir(os.path.join(self.rootdir, reldir), reldir, rules, rules_key)
+            files += [reldir + name for name in listing['files']]
+            if reldir and not listing['files'] and not listing['dirs']:
+                files.append(reldir)
+            if listing['ignore']:
+                rules = rules + parse_ignore_lines(listing['ignore'], base=reldir)
+                rules_key = _chain_key(rules_key, reldir, listing['ignore'])
+            stack += [(f'{reldir}{name}/', rules, rules_key) for name in listing['dirs']]
+
+        self._save_cache()
+        return sorted(files)
+
+
+def _chain_key(parent_key: str, reldir: str, ignore_lines: list[str]) -> str:
+    return hashlib.sha1(json.dumps([parent_key, reldir, ignore_lines]).encode('utf-8')).hexdigest()
+
+
+def build_file_list(rootdir: str | Path, exclude: list[str] | None = None, use_gitignore: bool = False,
+                    cache_dir: str | Path | None = FILELIST_CACHE_DIR) -> list[str]:
+    return FileListBuilder(rootdir, exclude=exclude, use_gitignore=use_gitignore, cache_dir=cache_dir).build()
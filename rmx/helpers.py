@@ -2,7 +2,7 @@
 from __future__ import annotations
 import os
 from pathlib import Path
-from typing import Iterator
+from typing import Iterable, Iterator
 
 def is_system_root(directory: Path):
     return directory == directory.parent
@@ -44,47 +44,88 @@ def merge_nested_dict(a, b, path=None, conflict='use_b'):
     return a
 
 
-def parse_config(project_root, global_conf_paths=['${HOME}/.rmx.config', '${HOME}/.config/rmx']):
+_json_cache = {}
+_config_cache = {}
+def load_json_cached(path, loads=None):
+    """Load a json file, reusing the parsed content as long as the file is unchanged (same size and mtime).
+
+    Parsed files stay in memory for the lifetime of the process, so that the processes forked by the rmx agent
+    start with configs and manifests already parsed. The returned object is shared: do not mutate it.
+    """
+    if loads is None:
+        import json
+        loads = json.loads
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    cached = _json_cache.get(str(path))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with open(path, 'r') as f:
+        data = loads(f.read())
+    _json_cache[str(path)] = (stamp, data)
+    return data
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def parse_config(project_root, global_conf_paths=['${HOME}/.rmx.config', '${HOME}/.config/rmx'], env=None):
     """ Parse rmx config (json file)
 
     It looks for config file in this order:
     1. {project_root}/.rmx.config
     2. $HOME/.rmx.config
     3. $HOME/.config/rmx
+
+    env: the environment variables to expand global_conf_paths with (default: os.environ)
+    The merged config is reused as long as the files are unchanged (e.g., by the processes forked by the rmx agent).
     """
     import pyjson5 as json
+    from copy import deepcopy
+    from string import Template
 
-    from os.path import expandvars, isfile
+    from os.path import isfile
     from rmx import logger
 
     def _maybe_load(path):
         if isfile(path):
-            with open(path, 'r') as f:
-                return json.load(f)
+            # NOTE: The configs are modified in place below
+            return deepcopy(load_json_cached(path, loads=json.loads))
         return {}
 
     # TODO: Hmmm... a better way to write this config search algorithm?
+    env = os.environ if env is None else env
     path_found = False
     for path in global_conf_paths:
-        path = expandvars(path)
+        path = Template(path).safe_substitute(env)
         if isfile(path):
             path_found = True
             break
 
-    if path_found:
-        with open(path, 'r') as f:
-            global_conf = json.load(f)
-    else:
+    if not path_found:
         logger.warning('rmx global config file cannot be located.')
-        global_conf = {}
+        path = None
+    local_path = f'{project_root}/.rmx.config'
+    key = (path, local_path)
+    stamp = (path and _file_stamp(path), _file_stamp(local_path))
+    cached = _config_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return deepcopy(cached[1])
 
-    local_conf = _maybe_load(f'{project_root}/.rmx.config')
+    global_conf = _maybe_load(path) if path_found else {}
+    local_conf = _maybe_load(local_path)
 
     global_conf = remove_recursively(global_conf, key='__help')
     local_conf = remove_recursively(local_conf, key='__help')
 
     merged_conf = merge_nested_dict(global_conf, local_conf)
-    return merged_conf
+    _config_cache[key] = (stamp, merged_conf)
+    return deepcopy(merged_conf)
 
 def remove_recursively(config_dict, key='__help'):
     """remove entry with the specified key recursively."""
@@ -98,10 +139,10 @@ def remove_recursively(config_dict, key='__help'):
     return config_dict
 
 
-def find_project_root():
+def find_project_root(cwd=None):
     """Find a project root (which is rsync-ed with the remote server).
 
-    It first goes up in the directory tree to find ".git" or ".rmx.config" file.
+    It first goes up in the directory tree from cwd (default: the current directory) to find ".git" or ".rmx.config" file.
     If not found, print warning and just use the current directory
     """
     from rmx import logger
@@ -112,7 +153,7 @@ def find_project_root():
             return True
         return False
 
-    current_dir = Path(os.getcwd()).resolve()
+    current_dir = Path(os.getcwd() if cwd is None else cwd).resolve()
     if is_proj_root(current_dir):
         return current_dir
 
@@ -144,18 +185,57 @@ def wrap_shebang(command, shell='bash'):
 
 sacct_cmd = "sacct --starttime $(date -d '40 hours ago' +%D-%R) --endtime now --format JobID,JobName%-100,NodeList,Elapsed,State,ExitCode --parsable2"
 
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'ExitCode', 'NodeList', 'Elapsed', 'Submit', 'Start', 'End', 'MaxRSS']
+
+
+def get_sacct_cmd(starttime: str | None = None) -> str:
+    """sacct command that lists the jobs that were pending, running or finished at or after starttime
+    (e.g., 2024-01-01T00:00:00; 40 hours ago by default)."""
+    starttime = starttime or "$(date -d '40 hours ago' +%Y-%m-%dT%H:%M:%S)"
+    return f"sacct --starttime {starttime} --endtime now --format {','.join(SACCT_FIELDS)} --parsable2"
+
+
+def iter_sacct(lines: Iterable[str], keys: list[str] | None = None) -> Iterator[dict]:
+    """Parse the output of `sacct --parsable2` line by line.
+
+    NOTE: For a batch job, sacct shows an entry for each step of one job submission:
+    {'JobID': '8231686', 'JobName': 'rmx-iti-coped-chief-97', ... 'MaxRSS': ''},
+    {'JobID': '8231686.batch', 'JobName': 'batch', ... 'MaxRSS': '64844148K'}
+    The steps (which come right after their job) are merged into the job, keeping the largest MaxRSS.
+    keys: the fields, if the output has no header (--noheader)
+    """
+    entry = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        if keys is None:
+            keys = line.split('|')
+            continue
+        row = dict(zip(keys, line.split('|')))
+        if '.' in row['JobID']:
+            if entry is not None and row['JobID'].split('.')[0] == entry['JobID'] and 'MaxRSS' in row:
+                entry['MaxRSS'] = max(entry.get('MaxRSS') or '', row['MaxRSS'] or '', key=parse_memory)
+            continue
+        if entry is not None:
+            yield entry
+        entry = row
+    if entry is not None:
+        yield entry
+
+
+def parse_memory(mem: str) -> int:
+    """'64844148K' --> the number of bytes"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if not mem:
+        return 0
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(float(mem))
+
 
 def parse_sacct(sacct_output):
-    lines = sacct_output.strip().split('\n')
-    keys = lines[0].split('|')
-    entries = [{key: entry for key, entry in zip(keys, line.split('|'))} for line in lines[1:]]
-    # NOTE: For a batch job, sacct shows two entries for one job submission:
-    # {'JobID': '8231686', 'JobName': 'rmx-iti-coped-chief-97', ... 'MaxRSS': ''},
-    # {'JobID': '8231686.batch', 'JobName': 'batch', ... 'MaxRSS': '64844148K'}
-    # We should merge these into one.
-    # TEMP: Forget about MaxRSS, and just remove all entries with *.batch
-    entries = [entry for entry in entries if not entry['JobID'].endswith('.batch')]
-    return entries
+    return list(iter_sacct(sacct_output.split('\n')))
 
 
 def posixpath2str(obj):
@@ -202,39 +282,3 @@ def replace_rmx_envvars(query: str, rmxenvs: dict):
 #         target = str(env[original])
 #         env = {key: re.sub(regex, target, str(val)) for key, val in env.items()}
 #     return env
-
-
-from os.path import expandvars
-class LaunchLogManager:
-    def __init__(self, path=expandvars('$HOME/.rmx/launched.jsonl')) -> None:
-        self.path = path
-
-    def _refresh(self):
-        import pyjson5 as json
-        from datetime import datetime
-        # Read entries from the top (oldest) to bottom (newest)
-        with open(self.path, 'r') as f:
-            entries = f.read().strip().split('\n')
-        cutoff_idx = -1
-        for idx, entry in enumerate(entries):
-            timestamp = json.loads(entry).get('timestamp')
-            dt = (datetime.now() - read_timestamp(timestamp)).seconds
-            if dt <= 60 * 60 * 30:
-                cutoff_idx = idx
-                break
-        refreshed_entries = entries[cutoff_idx:]
-
-        # Write in jsonl format
-        # NOTE: Make sure to add \n in the end!!
-        with open(self.path, 'w') as f:
-            f.write('\n'.join(refreshed_entries) + '\n')
-
-    def log(self, entry):
-        import json
-        # Prepare jsonification
-        entry = posixpath2str(entry)
-        with open(self.path, 'a') as f:
-            f.write(json.dumps(entry) + '\n')
-
-    def read(self):
-        pass
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Stream the output of containers and jobs to the terminal.
+
+Chunks are decoded incrementally (a multi-byte char may be split across chunks), assembled into lines,
+and written to the terminal in batches rather than one `print` per chunk.
+A LogMux follows any number of streams in a single thread, prefixing each line with the name of its source.
+"""
+from __future__ import annotations
+import os
+import sys
+import codecs
+import struct
+import threading
+import time
+
+from rmx import logger
+
+# Write out the buffered output at least this often (seconds), or as soon as this many chars are buffered
+FLUSH_INTERVAL = 0.05
+FLUSH_SIZE = 1 << 16
+READ_SIZE = 1 << 16
+
+# Header of each frame in the (non-tty) docker attach stream: stream type (1: stdout, 2: stderr), 3 bytes of padding, size
+_FRAME_HEADER = struct.Struct('>BxxxL')
+
+
+class LineBuffer:
+    """Decode the byte chunks of a stream incrementally.
+
+    With a prefix, only complete lines are emitted (each starting with the prefix) so that lines from different
+    streams don't interleave. Without a prefix, whatever has been decoded is emitted right away (e.g., progress bars).
+    """
+    def __init__(self, prefix: str = '') -> None:
+        self.prefix = prefix
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial = ''
+
+    def feed(self, data: bytes, final: bool = False) -> str:
+        text = self._decoder.decode(data, final=final)
+        if not self.prefix:
+            return text
+
+        text = self._partial + text
+        if final:
+            self._partial = ''
+            if text and not text.endswith('\n'):
+                text += '\n'
+        else:
+            cut = text.rfind('\n') + 1
+            text, self._partial = text[:cut], text[cut:]
+        if not text:
+            return ''
+        return ''.join(self.prefix + line for line in text.splitlines(keepends=True))
+
+
+class FrameParser:
+    """Split the multiplexed docker attach stream (used when the container has no tty) into stdout and stderr."""
+    def __init__(self) -> None:
+        self._buffer = b''
+
+    def feed(self, data: bytes) -> list[tuple[int, bytes]]:
+        """Returns a list of (stream type, payload) for the frames (or parts of them) received so far."""
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= _FRAME_HEADER.size:
+            stream_type, size = _FRAME_HEADER.unpack_from(self._buffer)
+            if len(self._buffer) < _FRAME_HEADER.size + size:
+                break
+            frames.append((stream_type, self._buffer[_FRAME_HEADER.size:_FRAME_HEADER.size + size]))
+            self._buffer = self._buffer[_FRAME_HEADER.size + size:]
+        return frames
+
+
+class BatchedWriter:
+    """Buffer the text and write it out in batches. Optionally tee everything to a local log file."""
+    def __init__(self, out=None, tee: str | None = None) -> None:
+        self.out = sys.stdout if out is None else out
+        self.tee = None
+        if tee is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(tee)), exist_ok=True)
+            self.tee = open(tee, 'a', encoding='utf-8')
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        with self._lock:
+            self._buffer.append(text)
+            self._size += len(text)
+            flush = self._size >= FLUSH_SIZE
+        if flush:
+            self.flush()
+
+    def maybe_flush(self) -> None:
+        if self._buffer and time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            text = ''.join(self._buffer)
+            self._buffer, self._size = [], 0
+            self._last_flush = time.monotonic()
+            if not text:
+                return
+            self.out.write(text)
+            self.out.flush()
+            if self.tee is not None:
+                self.tee.write(text)
+                self.tee.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.tee is not None:
+            self.tee.close()
+            self.tee = None
+
+
+class _Source:
+    def __init__(self, fileobj, prefix: str, framed: bool, streams: tuple[int, ...]) -> None:
+        self.fileobj = fileobj
+        self.framed = FrameParser() if framed else None
+        self.streams = streams
+        # NOTE: stdout and stderr need their own buffers, or a partial line of one would be glued to the other
+        self.lines = {stream_type: LineBuffer(prefix) for stream_type in (1, 2)}
+
+    def read(self) -> bytes:
+        if hasattr(self.fileobj, 'recv'):
+            return self.fileobj.recv(READ_SIZE)
+        return os.read(self.fileobj.fileno(), READ_SIZE)
+
+    def decode(self, data: bytes, final: bool = False) -> str:
+        if self.framed is None:
+            return self.lines[1].feed(data, final=final)
+        texts = [self.lines[stream_type].feed(payload) for stream_type, payload in self.framed.feed(data)
+                 if stream_type in self.streams]
+        if final:
+            texts += [self.lines[stream_type].feed(b'', final=True) for stream_type in self.streams]
+        return ''.join(texts)
+
+
+class LogMux:
+    """Follow many streams (sockets, pipes, ...) in a single thread until all of them are closed.
+
+    Add all the streams first, then either `run()` (blocks) or `start()` (in a background thread).
+    """
+    def __init__(self, out=None, tee: str | None = None) -> None:
+        import selectors
+        self.writer = BatchedWriter(out, tee=tee)
+        self.selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self.selector.get_map())
+
+    def add(self, fileobj, prefix: str = '', framed: bool = False, stdout: bool = True, stderr: bool = True) -> None:
+        """
+        framed: fileobj is a multiplexed docker attach stream (see FrameParser)
+        stdout / stderr: which of the streams to show (only for framed streams)
+        """
+        import selectors
+        streams = tuple(stream_type for stream_type, show in [(1, stdout), (2, stderr)] if show)
+        with self._lock:
+            self.selector.register(fileobj, selectors.EVENT_READ, _Source(fileobj, prefix, framed, streams))
+
+    def add_container(self, container, prefix: str = '', stdout: bool = True, stderr: bool = True) -> None:
+        """Attach to the output of a docker container.
+
+        The attach request is sent right away (and also replays the output so far), so this can be called before
+        starting the container to not miss anything.
+        """
+        sock = container.attach_socket(params={'stdout': int(stdout), 'stderr': int(stderr), 'stream': 1, 'logs': 1})
+        # NOTE: With a tty, the container has a single raw output stream
+        framed = not container.attrs.get('Config', {}).get('Tty', False)
+        self.add(sock, prefix=prefix, framed=framed, stdout=stdout, stderr=stderr)
+
+    def run(self) -> None:
+        try:
+            while self.selector.get_map():
+                for key, _ in self.selector.select(timeout=FLUSH_INTERVAL):
+                    source = key.data
+                    try:
+                        data = source.read()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        logger.debug(f'Failed to read a log stream: {e}')
+                        data = b''
+                    if data:
+                        self.writer.write(source.decode(data))
+                    else:
+                        self.writer.write(source.decode(b'', final=True))
+                        self._remove(source)
+                self.writer.maybe_flush()
+        finally:
+            self.writer.close()
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def join(self, timeout: float | None = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _remove(self, source: _Source) -> None:
+        with self._lock:
+            self.selector.unregister(source.fileobj)
+        try:
+            source.fileobj.close()
+        except OSError:
+            pass
+
+
+class RemoteLogTail:
+    """Follow the *.log files in a directory on a remote machine by byte offset.
+
+    Each poll is a single command that sends back only the bytes appended to each file since the last poll
+    (and picks up new files, e.g., sweep members that started later), rather than re-reading whole files.
+    """
+    MARKER = b'rmx-log'
+
+    def __init__(self, client, logdir: str, writer: BatchedWriter, max_bytes: int = 8 << 20) -> None:
+        """max_bytes: the maximum number of bytes to fetch per file per poll"""
+        self.client = client
+        self.logdir = str(logdir)
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.offsets = {}
+        self.lines = {}
+
+    def get_script(self) -> str:
+        """The command that prints a frame for each *.log file: a header line and the new bytes of the file.
+
+        The header is `<marker> <offset> <size> <file name>`, where size is that of the bytes actually sent
+        (the file may change between measuring it and reading it), and the name goes last as it may contain spaces.
+        """
+        import shlex
+        cases = ''.join(f'{shlex.quote(name)}) off={offset};; ' for name, offset in self.offsets.items())
+        return (f'cd {shlex.quote(self.logdir)} 2>/dev/null || exit 3; '
+                'tmp=$(mktemp "${TMPDIR:-/tmp}/rmx-log.XXXXXX") || exit 4; trap \'rm -f "$tmp"\' EXIT; '
+                'for f in *.log; do [ -f "$f" ] || continue; '
+                'size=$(wc -c < "$f"); '
+                f'case "$f" in {cases}*) off=0;; esac; '
+                '[ "$size" -lt "$off" ] && off=0; '  # truncated (e.g., a new run with the same name)
+                f'n=$((size - off)); [ "$n" -gt {self.max_bytes} ] && n={self.max_bytes}; '
+                ': > "$tmp"; [ "$n" -gt 0 ] && tail -c +$((off + 1)) "$f" | head -c "$n" > "$tmp"; '
+                f'printf \'%s %s %s %s\\n\' {self.MARKER.decode()} "$off" $(($(wc -c < "$tmp"))) "$f"; '
+                'cat "$tmp"; '
+                'done; true')
+
+    @classmethod
+    def parse(cls, data: bytes) -> list[tuple[str, int, bytes]]:
+        """Parse the output of the script into a list of (file name, offset, new bytes)"""
+        chunks = []
+        pos = 0
+        while pos < len(data):
+            end = data.index(b'\n', pos)
+            header = data[pos:end].split(b' ', 3)
+            if len(header) != 4 or header[0] != cls.MARKER:
+                raise ValueError(f'Unexpected output while polling the logs: {data[pos:end]}')
+            _, offset, size, name = header
+            pos = end + 1 + int(size)
+            chunks.append((name.decode('utf-8'), int(offset), data[end + 1:pos]))
+        return chunks
+
+    def poll(self) -> int:
+        """Fetch and write out the new output. Returns the number of new bytes."""
+        status, stdout, stderr = self.client.capture(self.get_script())
+        if status == 3:
+            raise FileNotFoundError(f'{self.logdir} is not found')
+        if status != 0:
+            raise OSError(f'Failed to poll the logs in {self.logdir}:\n{stderr}')
+
+        chunks = self.parse(stdout)
+        for name, offset, _ in chunks:
+            if name not in self.lines or offset < self.offsets.get(name, 0):
+                self.lines[name] = LineBuffer()
+        # Once there is more than one file, prefix each line with the file name (e.g., the sweep index)
+        if len(self.lines) > 1:
+            for name, lines in self.lines.items():
+                lines.prefix = f'[{name[:-len(".log")]}] '
+
+        num_bytes = 0
+        for name, offset, data in chunks:
+            self.offsets[name] = offset + len(data)
+            self.writer.write(self.lines[name].feed(data))
+            num_bytes += len(data)
+        self.writer.flush()
+        return num_bytes
+
+    def close(self) -> None:
+        for lines in self.lines.values():
+            self.writer.write(lines.feed(b'', final=True))
+        self.writer.close()
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
+from __future__ import annotations
 import os
+import threading
 from os.path import expandvars
 from rmx.helpers import posixpath2str, replace_rmx_envvars
-import invoke
 
 from rmx import logger
 
 RMX_DOCKER_ROOTDIR = '/rmx'
 
+# OpenSSH control sockets shared by every ssh subprocess (commands, rsync, link probe, docker socket forwarding)
+# NOTE: unix socket paths are limited to ~100 chars, thus hashed file names.
+SSH_CONTROL_DIR = expandvars('$HOME/.rmx/ssh')
+# Keep the master alive for a while after the last client leaves, so that consecutive rmx commands skip the handshake as well
+SSH_CONTROL_PERSIST = '10m'
+
 # NOTE: Should I have ssh-conf, slurm-conf and docker-conf separately??
 # I guess RemoteConfig should ONLY store the info on how to login to the host?
 # docker info and slurm info should really reside in project.
@@ -16,7 +23,6 @@ class RemoteConfig:
     This is used by SimpleSSHClient.
     """
 
-    from fabric import Connection
     def __init__(self, user, host, port=22, slurm_node=False) -> None:
         self.user = user
         self.host = host
@@ -27,70 +33,289 @@ class RemoteConfig:
     def base_uri(self) -> str:
         return f'{self.user}@{self.host}'
 
-    def get_connection(self) -> Connection:
-        from fabric import Connection
-        from fabric.config import Config
-        config = Config()
-        config.user = self.user
-        conn = Connection(host=self.host, config=config, inline_ssh_env=True)
-        return conn
+    def get_master(self) -> SSHMaster:
+        """Returns the OpenSSH ControlMaster connection to the host, shared within the process."""
+        with _pool_lock:
+            master = _masters.get(self.base_uri)
+            if master is None:
+                master = SSHMaster(self.base_uri)
+                _masters[self.base_uri] = master
+        return master
 
     def get_dict(self):
         return {key: val for key, val in vars(self).items() if not (key.startswith('__') or callable(val))}
 
 
+class SSHMaster:
+    """A multiplexed OpenSSH connection (ControlMaster) to a host.
+
+    ssh subprocesses started with `options` reuse the master connection rather than performing their own handshake.
+    """
+    def __init__(self, base_uri: str, control_dir: str = SSH_CONTROL_DIR, persist: str = SSH_CONTROL_PERSIST) -> None:
+        import hashlib
+        self.base_uri = base_uri
+        self.control_dir = control_dir
+        self.control_path = os.path.join(control_dir, hashlib.sha1(base_uri.encode('utf-8')).hexdigest()[:16])
+        self.persist = persist
+        self._lock = threading.Lock()
+
+    @property
+    def options(self) -> list[str]:
+        return ['-o', 'ControlMaster=auto', '-o', f'ControlPath={self.control_path}',
+                '-o', f'ControlPersist={self.persist}']
+
+    @property
+    def ssh_command(self) -> str:
+        """The ssh command to pass to `rsync -e`"""
+        import shlex
+        return ' '.join(shlex.quote(arg) for arg in ['ssh', *self.options])
+
+    def is_alive(self) -> bool:
+        import subprocess
+        out = subprocess.run(['ssh', '-o', f'ControlPath={self.control_path}', '-O', 'check', self.base_uri],
+                             stdin=subprocess.DEVNULL, capture_output=True)
+        return out.returncode == 0
+
+    def start(self, timeout: float | None = None) -> None:
+        """Open the master connection unless it is already running.
+
+        Starting it upfront prevents concurrent ssh subprocesses from each racing to become the master.
+        timeout: seconds to wait for the handshake
+        """
+        import subprocess
+        with self._lock:
+            if self.is_alive():
+                return
+            os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+            logger.debug(f'Opening a master ssh connection to {self.base_uri}')
+            # NOTE: With ControlPersist, the master goes to the background once `true` finishes.
+            # If another process became the master in the meantime, this is just a one-off command (unlike `-f -N`).
+            # The backgrounded master inherits stdout/stderr; capturing them would block until it exits.
+            connect_timeout = [] if timeout is None else ['-o', f'ConnectTimeout={max(1, int(timeout))}']
+            out = subprocess.run(['ssh', *self.options, *connect_timeout, self.base_uri, 'true'],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if out.returncode != 0:
+                raise OSError(f'Failed to open an ssh connection to {self.base_uri}')
+
+    def forward_unix_socket(self, remote_path: str) -> str:
+        """Forward a unix socket on the host (e.g., the docker daemon) to a local one over the master connection.
+
+        Returns the path to the local socket.
+        """
+        import hashlib
+        import socket
+        import subprocess
+        self.start()
+        local_path = f'{self.control_path}-{hashlib.sha1(remote_path.encode("utf-8")).hexdigest()[:8]}.sock'
+        with self._lock:
+            if os.path.exists(local_path):
+                # Reuse the forwarding if it is still served by a live master
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(local_path)
+                    return local_path
+                except OSError:
+                    os.remove(local_path)
+                finally:
+                    sock.close()
+            out = subprocess.run(['ssh', '-o', f'ControlPath={self.control_path}', '-O', 'forward',
+                                  '-L', f'{local_path}:{remote_path}', self.base_uri],
+                                 stdin=subprocess.DEVNULL, capture_output=True)
+            if out.returncode != 0:
+                raise OSError(f'Failed to forward {remote_path} on {self.base_uri}:\n{out.stderr.decode("utf-8", "ignore")}')
+        return local_path
+
+
+
+
+def _read_in_background(stream, echo=None):
+    """Read stream until EOF in a thread. Returns a function that waits for it and returns the content.
+
+    echo: a text stream to write the content to as it arrives (e.g., sys.stdout)
+    """
+    import codecs
+    chunks = []
+
+    def _read():
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for chunk in iter(lambda: stream.read1(1 << 16), b''):
+            chunks.append(chunk)
+            if echo is not None:
+                echo.write(decoder.decode(chunk))
+                echo.flush()
+
+    thread = threading.Thread(target=_read, daemon=True)
+    thread.start()
+
+    def _result() -> bytes:
+        thread.join()
+        return b''.join(chunks)
+    return _result
+
+
+def _write_in_background(stream, in_stream, chunk_size=1 << 16):
+    """Copy in_stream (text or binary) to stream in a thread, and close stream at the end."""
+    import contextlib
+
+    def _write():
+        try:
+            for chunk in iter(lambda: in_stream.read(chunk_size), in_stream.read(0)):
+                stream.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                stream.flush()
+        except BrokenPipeError:
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                stream.close()
+
+    threading.Thread(target=_write, daemon=True).start()
+
+
+_pool_lock = threading.Lock()
+_masters = {}
+
+
 class SimpleSSHClient:
     """Given a remote config, this provides an interface to ssh into a remote machine.
+
+    Every command runs in an ssh subprocess on the OpenSSH master connection of the host (see SSHMaster),
+    the same one that rsync and the docker socket forwarding use.
     """
     def __init__(self, remote_conf: RemoteConfig) -> None:
         self.remote_conf = remote_conf
-        self.conn = self.remote_conf.get_connection()
+        self.master = self.remote_conf.get_master()
 
     def uri(self, path):
         return f'{self.remote_conf.base_uri}:{path}'
 
-    def run(self, cmd, directory='$HOME', disown=False, hide=False, env=None, pty=False, dry_run=False):
-        import re
-        
+    def open(self, timeout=None):
+        """Open the master connection unless it is already running (only one thread performs the handshake).
+
+        timeout: seconds to wait for the handshake
+        """
+        self.master.start(timeout=timeout)
+
+    def ssh_args(self, cmd: str, pty: bool = False) -> list[str]:
+        """The ssh command line that runs cmd on the remote over the master connection."""
+        # NOTE: -tt allocates a tty even if the local stdin is not a terminal (as Fabric's pty=True did).
+        # LogLevel=ERROR hides "Connection to ... closed." that ssh prints when a tty session ends.
+        tty = ['-tt', '-o', 'LogLevel=ERROR'] if pty else ['-T']
+        return ['ssh', *self.master.options, *tty, self.remote_conf.base_uri, cmd]
+
+    def run(self, cmd, directory='$HOME', disown=False, hide=False, env=None, pty=False, dry_run=False,
+            out_stream=None, err_stream=None, in_stream=None, warn=False, timeout=None):
+        """
+        hide: True (or 'both'), 'stdout' (or 'out') or 'stderr' (or 'err') not to echo the output
+        out_stream / err_stream / in_stream: file-like objects to use instead of sys.stdout / sys.stderr / sys.stdin
+          (in_stream=False disables stdin)
+        warn: return the result even when the command fails, rather than exiting
+        timeout: seconds to wait for the connection and for the command (raises TimeoutError)
+        Returns Namespace(command, stdout, stderr, exited), or None for dry_run and disown.
+        """
+        import shlex
+        import subprocess
+        import sys
+        from argparse import Namespace
+
         # TODO: Check if $HOME would work or not!!
         env = {} if env is None else env
 
         # Perform shell escaping for envvars
-        # NOTE: Fabric seems to have an issue to handle envvar that contains spaces...
-        # This is the issue of using "inline_ssh_env" that essentially sets envvars by putting bunch of export KEY=VAL before running shells.
-        # The documentation clearly says developers need to handle shell escaping for non-trivial values.
+        # NOTE: The envvars are set by putting `export KEY=VAL` before the command (as Fabric's inline_ssh_env did),
+        # since sshd only accepts the few envvars listed in its AcceptEnv.
         # TEMP: shell escaping only when env contains space
-        import shlex
         env = {key: shlex.quote(str(val)) if " " in str(val) else str(val) for key, val in env.items()}
 
         if dry_run:
             logger.info('--- dry run ---')
             logger.info(f'cmd: {cmd}')
             logger.debug(locals())
-        else:
-            with self.conn.cd(directory):
-                # promise = self.conn.run(cmd, asynchronous=True)
-                if disown:
-                    # NOTE: asynchronous=True --> disown=True
-                    # asynchronous=True returns a Promise to which you can attach and listen to stdio.
-                    # disown=True completely disowns the process.
-                    self.conn.run(cmd, disown=True, hide=hide, env=env, pty=pty)
-                    return
-
-                # NOTE: if you use asynchronous=True, stdout/stderr does not show up
-                # when you use it on slurm. I have no idea why, tho.
-                logger.debug(f'ssh client env: {env}')
-                try:
-                    result = self.conn.run(cmd, asynchronous=False, hide=hide, env=env, pty=pty)
-                except invoke.exceptions.UnexpectedExit as e:
-                    logger.info(f'Caught an exception!!:\n{str(e)}')
-                    import sys
-                    sys.exit(1)
+            return
+
+        exports = f'export {" ".join(f"{key}={val}" for key, val in env.items())} && ' if env else ''
+        cmd = f'{exports}cd {directory} && {cmd}'
+        self.open(timeout=timeout)
+        if disown:
+            # NOTE: The ssh client gets its own session, so that it outlives this process (and its Ctrl-C).
+            subprocess.Popen(self.ssh_args(cmd, pty=pty), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+            return
 
-            return result
+        logger.debug(f'ssh client env: {env}')
+        hide_out = hide in (True, 'both', 'stdout', 'out')
+        hide_err = hide in (True, 'both', 'stderr', 'err')
+        stdin = subprocess.DEVNULL if in_stream is False else (None if in_stream is None else subprocess.PIPE)
+        proc = subprocess.Popen(self.ssh_args(cmd, pty=pty), stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if stdin == subprocess.PIPE:
+            _write_in_background(proc.stdin, in_stream)
+        stdout = _read_in_background(proc.stdout, echo=None if hide_out else (out_stream or sys.stdout))
+        stderr = _read_in_background(proc.stderr, echo=None if hide_err else (err_stream or sys.stderr))
+        try:
+            exited = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise TimeoutError(f'The command on {self.remote_conf.base_uri} timed out after {timeout} seconds')
+        result = Namespace(command=cmd, stdout=stdout().decode('utf-8', 'replace'),
+                           stderr=stderr().decode('utf-8', 'replace'), exited=exited)
+        if exited != 0 and not warn:
+            stderr = f'\n\nStderr:\n{result.stderr}' if hide_err else ''
+            logger.info(f'Encountered a bad command exit code!\n\nCommand: {cmd!r}\n\nExit code: {exited}{stderr}')
+            sys.exit(1)
+        return result
 
     def put(self, file_like, target_path=None):
-        self.conn.put(file_like, str(target_path))
+        """Write the content of file_like (a file object or a local path) to target_path on the remote."""
+        import io
+        import shlex
+        if isinstance(file_like, (str, os.PathLike)):
+            with open(file_like, 'rb') as f:
+                content = f.read()
+        else:
+            content = file_like.read()
+        content = content.encode('utf-8') if isinstance(content, str) else content
+        status, _, stderr = self.pipe(f'cat > {shlex.quote(str(target_path))}', io.BytesIO(content))
+        if status != 0:
+            raise OSError(f'Failed to put {target_path} on {self.remote_conf.base_uri}:\n{stderr}')
+
+    def pipe(self, cmd, in_stream, chunk_size=1 << 20):
+        """Run cmd on the remote and stream the binary content of in_stream into its stdin.
+
+        Returns (exit status, number of bytes sent, stderr).
+        """
+        import contextlib
+        import subprocess
+        self.open()
+        # NOTE: Drain stderr while sending. Unread output fills the pipe and blocks the remote.
+        proc = subprocess.Popen(self.ssh_args(cmd), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+        stderr = _read_in_background(proc.stderr)
+        num_bytes = 0
+        try:
+            for chunk in iter(lambda: in_stream.read(chunk_size), b''):
+                proc.stdin.write(chunk)
+                num_bytes += len(chunk)
+        except BrokenPipeError:
+            # The remote command (or the connection) ended early; its exit status and stderr tell why
+            pass
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                proc.stdin.close()
+        status = proc.wait()
+        return status, num_bytes, stderr().decode('utf-8', 'ignore')
+
+    def capture(self, cmd) -> tuple[int, bytes, str]:
+        """Run cmd on the remote and return (exit status, stdout, stderr).
+
+        NOTE: Unlike `run`, stdout is returned as bytes (not decoded), so that byte counts in it are exact.
+        """
+        import subprocess
+        self.open()
+        out = subprocess.run(self.ssh_args(cmd), stdin=subprocess.DEVNULL, capture_output=True)
+        return out.returncode, out.stdout, out.stderr.decode('utf-8', 'ignore')
 
     def port_forward(self):
         raise NotImplementedError
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Local manifests of what has been synced to each remote target.
+
+A manifest maps every synced file (relative to the source directory) to its
+(size, mtime_ns, content hash, permission bits). Comparing a fresh scan against the manifest of the
+last successful sync tells us whether rsync needs to run at all, and if so, which paths to hand it.
+
+Each save gets a new sync id, which is also written to a sentinel file in the remote target (see sentinel_name).
+If the sentinel on the remote does not match (e.g., /tmp was cleaned), the manifest no longer describes the remote.
+"""
+from __future__ import annotations
+import os
+import json
+import stat
+import hashlib
+from os.path import expandvars
+from pathlib import Path
+
+MANIFEST_DIR = expandvars('$HOME/.rmx/manifests')
+MANIFEST_VERSION = 2
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path: str | Path) -> str:
+    """Content hash of a file (or of the link target for symlinks)."""
+    h = hashlib.blake2b(digest_size=16)
+    if os.path.islink(path):
+        h.update(os.readlink(path).encode('utf-8', 'surrogateescape'))
+        return h.hexdigest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_tree(rootdir: str | Path, exclude: list[str] | None = None, cache: dict | None = None,
+              files: list[str] | None = None) -> dict:
+    """Return {relpath: [size, mtime_ns, digest, mode]} for every file and symlink under rootdir.
+
+    files: paths (relative to rootdir) to scan. If None, the tree is listed with rmx.filelist (honoring exclude only).
+    Files whose size and mtime match the entry in `cache` are not re-hashed.
+    Directories (the paths with a trailing slash, see FileListBuilder.build) are recorded as [0, 0, 'dir', mode].
+    mode holds the permission bits, so that a chmod alone is synced too (as `rsync --archive` does).
+    """
+    rootdir = str(rootdir)
+    cache = {} if cache is None else cache
+    if files is None:
+        from rmx.filelist import build_file_list
+        files = build_file_list(rootdir, exclude=exclude, use_gitignore=False, cache_dir=None)
+
+    entries = {}
+    for relpath in files:
+        fullpath = os.path.join(rootdir, relpath)
+        if relpath.endswith('/'):
+            if os.path.isdir(fullpath):
+                entries[relpath] = [0, 0, 'dir', stat.S_IMODE(os.stat(fullpath).st_mode)]
+            continue
+        try:
+            st = os.lstat(fullpath)
+        except FileNotFoundError:
+            # Removed after the file list was built
+            continue
+        prev = cache.get(relpath)
+        if prev is not None and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+            digest = prev[2]
+        else:
+            digest = hash_file(fullpath)
+        entries[relpath] = [st.st_size, st.st_mtime_ns, digest, stat.S_IMODE(st.st_mode)]
+    return entries
+
+
+class SyncManifest:
+    """Record of the files last synced from a local directory to a remote target."""
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.sync_id = None
+        self.entries = self._load()
+
+    @classmethod
+    def for_target(cls, source_dir: str | Path, target: str, manifest_dir: str | Path = MANIFEST_DIR) -> SyncManifest:
+        """Manifest for syncing source_dir to target (i.e., user@host:path)."""
+        key = hashlib.sha1(f'{Path(source_dir).resolve()}|{target}'.encode('utf-8')).hexdigest()
+        return cls(Path(manifest_dir) / f'{key}.json')
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.entries)
+
+    @property
+    def sentinel_name(self) -> str:
+        """Name of the file in the remote target that holds the sync id of the last sync"""
+        return f'.rmx-sync-{self.path.stem[:16]}'
+
+    def invalidate(self) -> None:
+        """Forget the entries (e.g., the remote copy is gone), so that the next sync transfers everything"""
+        self.entries = {}
+
+    def _load(self) -> dict:
+        from rmx.helpers import load_json_cached
+        try:
+            data = load_json_cached(self.path)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if data.get('version') != MANIFEST_VERSION:
+            return {}
+        self.sync_id = data.get('sync_id')
+        return data.get('entries', {})
+
+    def diff(self, entries: dict) -> tuple[list[str], list[str]]:
+        """Compare a fresh scan with the manifest.
+
+        Returns (changed, removed): paths that are new or whose content or permissions differ, and paths that are gone.
+        """
+        changed = [path for path, entry in entries.items()
+                   if path not in self.entries or self.entries[path][2:] != entry[2:]]
+        removed = [path for path in self.entries if path not in entries]
+        return sorted(changed), sorted(removed)
+
+    def save(self, entries: dict, sync_id: str | None = None) -> None:
+        """Atomically overwrite the manifest with entries. A new sync id is generated unless sync_id is given."""
+        import uuid
+        sync_id = sync_id or uuid.uuid4().hex
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'sync_id': sync_id, 'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.sync_id = sync_id
+
+
+SNAPSHOT_INDEX = Path(MANIFEST_DIR) / 'snapshots.json'
+
+
+def load_latest_snapshot(target: str, index_path: str | Path = SNAPSHOT_INDEX) -> str | None:
+    """The remote rmxdir of the latest contained (--contain) run synced to target (i.e., user@host:rmxdir/project)."""
+    try:
+        with open(index_path, 'r') as f:
+            snapshot = json.load(f).get(target)
+    except (FileNotFoundError, ValueError):
+        return None
+    # NOTE: Older indices only hold the rmxdir
+    return snapshot['rmxdir'] if isinstance(snapshot, dict) else snapshot
+
+
+def save_latest_snapshot(target: str, snapshot_rmxdir: str, manifests: list[str | Path] = (),
+                         index_path: str | Path = SNAPSHOT_INDEX) -> None:
+    """Record the latest snapshot synced to target.
+
+    manifests: the sync manifests of the snapshot. The ones of the snapshot it replaces are removed, since a snapshot
+    is never synced again. The manifests left untouched for the retention of LaunchHistory are pruned as well.
+    """
+    from rmx.store import LAUNCH_RETENTION
+    index_path = Path(index_path)
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+    prev = index.get(target)
+    manifests = [str(path) for path in manifests]
+    index[target] = {'rmxdir': str(snapshot_rmxdir), 'manifests': manifests}
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    stale = [path for path in (prev.get('manifests', []) if isinstance(prev, dict) else []) if path not in manifests]
+    for path in stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    prune_manifests(LAUNCH_RETENTION, manifest_dir=index_path.parent)
+
+
+def prune_manifests(max_age: float, manifest_dir: str | Path = MANIFEST_DIR) -> int:
+    """Remove the manifests that have not been saved for max_age seconds (the next sync just compares everything).
+    Returns the number of removed manifests."""
+    import time
+    before = time.time() - max_age
+    num_removed = 0
+    try:
+        entries = list(os.scandir(manifest_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.name.endswith('.json') and entry.name != SNAPSHOT_INDEX.name:
+            try:
+                if entry.stat().st_mtime < before:
+                    os.remove(entry.path)
+                    num_removed += 1
+            except FileNotFoundError:
+                pass
+    return num_removed
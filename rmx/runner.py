@@ -7,6 +7,7 @@ from docker import DockerClient
 from rmx.config import DockerContainerConfig
 from rmx.machine import SimpleSSHClient
 from rmx.helpers import replace_rmx_envvars
+from rmx.logstream import LogMux
 
 def get_rmxenvs(cmd: str, rmxdirs: Namespace):
     return {'RMX_CODE_DIR': rmxdirs.codedir, 
@@ -21,31 +22,192 @@ class SSHRunner:
         self.rmxdirs = rmxdirs
 
     def exec(self, cmd: str, relative_workdir, env: dict | None = None, startup: str = "", dry_run: bool = False,
-             disown: bool = False):
+             disown: bool = False, log_path: str | None = None, **run_kwargs):
+        """
+        log_path: write the output of the command to this file on the remote (instead of the terminal).
+          Its directory is created if missing.
+        run_kwargs: passed to SimpleSSHClient.run (e.g., out_stream, err_stream, warn, pty)
+        """
+        import os
         env = {} if env is None else env
         # if isinstance(cmd, list):
         #     cmd = ' '.join(cmd) if len(cmd) > 1 else cmd[0]
 
         if startup:
             cmd = f'{startup} && {cmd}'
+        # NOTE: RMX_USER_COMMAND is the command itself, not the redirection around it
+        rmxenv = get_rmxenvs(cmd, self.rmxdirs)
+        if log_path is not None:
+            cmd = f'mkdir -p {os.path.dirname(log_path)} && {{ {cmd} ; }} >> {log_path} 2>&1'
 
         logger.debug(f'ssh run with command: {cmd}')
         logger.debug(f'cd to {self.rmxdirs.codedir / relative_workdir}')
-        rmxenv = get_rmxenvs(cmd, self.rmxdirs)
         allenv = {**env, **rmxenv}
         allenv = {key: replace_rmx_envvars(val, rmxenv) for key, val in allenv.items()}
+        # NOTE: A disowned command on a pty would be hung up as soon as the session is closed
+        run_kwargs = {'pty': not disown, **run_kwargs}
         return self.client.run(cmd, directory=(self.rmxdirs.codedir / relative_workdir),
-                               disown=disown, env=allenv, dry_run=dry_run, pty=True)
+                               disown=disown, env=allenv, dry_run=dry_run, **run_kwargs)
+
+
+class PrefixedStream:
+    """A file-like object that writes complete lines to stream, each prefixed with a label.
+
+    Used to multiplex the output of many hosts into a single terminal. The lock is shared by all the
+    streams writing to the same terminal so that lines are never interleaved.
+    """
+    def __init__(self, prefix: str, stream, lock: threading.Lock) -> None:
+        self.prefix = prefix
+        self.stream = stream
+        self.lock = lock
+        self._buffer = ''
+
+    def write(self, data: str) -> int:
+        self._buffer += data.replace('\r\n', '\n')
+        if '\n' in self._buffer:
+            *lines, self._buffer = self._buffer.split('\n')
+            with self.lock:
+                self.stream.write(''.join(f'{self.prefix}{line}\n' for line in lines))
+                self.stream.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buffer:
+            with self.lock:
+                self.stream.write(f'{self.prefix}{self._buffer}\n')
+                self.stream.flush()
+            self._buffer = ''
+
+
+class MultiHostRunner:
+    """Run a command on many hosts at once.
+
+    The output of each host is streamed line by line with a [host] prefix, so running on N hosts
+    takes as long as the slowest one.
+    """
+    def __init__(self, runners: dict[str, SSHRunner], max_workers: int = 32) -> None:
+        self.runners = runners
+        self.max_workers = max_workers
+
+    def exec(self, cmd: str, relative_workdir, envs: dict[str, dict] | None = None,
+             startups: dict[str, str] | None = None, dry_run: bool = False, out=None, err=None) -> list[Namespace]:
+        """Returns a Namespace(name, exit_code, elapsed, error) for each host, in the order of self.runners.
+
+        envs / startups: per-host env vars and startup commands
+        exit_code is None if the command could not be run (e.g., the host is unreachable).
+        """
+        import sys
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        envs = {} if envs is None else envs
+        startups = {} if startups is None else startups
+        out = sys.stdout if out is None else out
+        err = sys.stderr if err is None else err
+        lock = threading.Lock()
+        width = max(len(name) for name in self.runners)
+
+        def _exec(name: str) -> Namespace:
+            prefix = f'[{name:<{width}}] '
+            out_stream, err_stream = PrefixedStream(prefix, out, lock), PrefixedStream(prefix, err, lock)
+            start = time.time()
+            try:
+                # NOTE: No pty (it would merge stderr into stdout) and no stdin, which cannot be shared among hosts.
+                result = self.runners[name].exec(cmd, relative_workdir, env=envs.get(name), startup=startups.get(name, ''),
+                                                 dry_run=dry_run, pty=False, warn=True, in_stream=False,
+                                                 out_stream=out_stream, err_stream=err_stream)
+                exit_code, error = (0 if result is None else result.exited), None
+            except Exception as e:
+                exit_code, error = None, e
+                err_stream.write(f'{type(e).__name__}: {e}\n')
+            finally:
+                out_stream.flush()
+                err_stream.flush()
+            return Namespace(name=name, exit_code=exit_code, elapsed=time.time() - start, error=error)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.runners)))) as executor:
+            return list(executor.map(_exec, self.runners))
+
+
+def format_host_summary(results: list[Namespace]) -> str:
+    width = max(len(result.name) for result in results)
+    lines = []
+    for result in results:
+        status = 'ERROR' if result.exit_code is None else f'exit {result.exit_code}'
+        lines.append(f'  {result.name:<{width}}  {status:<8}  {result.elapsed:7.2f}s')
+    return '\n'.join(lines)
+
+
+def get_exit_path(log_path: str) -> str:
+    """The file that keeps the exit code of a docker run whose output goes to log_path"""
+    return f'{log_path}.exit'
 
 
 class DockerRunner:
-    def __init__(self, client: DockerClient, rmxdirs: Namespace) -> None:
+    def __init__(self, client: DockerClient, rmxdirs: Namespace, docker_host: str | None = None) -> None:
+        """docker_host: the daemon that the docker cli talks to (defaults to ssh://<the host of client>)"""
         self.client = client
         self.rmxdirs = rmxdirs
+        self.docker_host = docker_host
+
+    def find_containers(self, name_prefix: str) -> dict:
+        """Returns {name: Container} for all containers (including stopped ones) whose name starts with name_prefix.
+
+        A single query, rather than one `containers.get` per name.
+        """
+        import re
+        # NOTE: The name filter of the docker API is a regex search, and container names have a leading "/"
+        containers = self.client.containers.list(all=True, filters={'name': f'^/?{re.escape(name_prefix)}'})
+        return {container.name: container for container in containers if container.name.startswith(name_prefix)}
+
+    def exec_sweep(self, cmd: str, relative_workdir, docker_confs: list[DockerContainerConfig],
+                   kill_existing_container: bool = True, max_workers: int = 8, quiet: bool = True,
+                   log_file: str | None = None) -> list[Namespace]:
+        """Launch a (detached) container for each of docker_confs concurrently.
+
+        The existing containers are looked up once for all the confs, which must share a name prefix
+        (e.g., <name>-<sweep_idx>). A failure to launch one container does not stop the others.
+        Unless quiet, this then follows the output of all the containers (each line prefixed with the container name)
+        until they exit.
+        Returns a Namespace(name, error) for each of docker_confs, in order (error is None on success).
+        """
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+        existing = self.find_containers(os.path.commonprefix([d.name for d in docker_confs]))
+        mux = None if quiet else LogMux(tee=log_file)
+
+        def _launch(docker_conf: DockerContainerConfig) -> Namespace:
+            try:
+                container = existing.get(docker_conf.name)
+                if container is not None:
+                    if not kill_existing_container:
+                        raise RuntimeError(f'Container {docker_conf.name} already exists (use --force to replace it)')
+                    logger.warning(f'Removing the existing container: {docker_conf.name}')
+                    container.remove(force=True)
+                self.exec(cmd, relative_workdir, docker_conf, kill_existing_container=False, interactive=False,
+                          quiet=quiet, mux=mux, prefix=f'[{docker_conf.name}] ' if len(docker_confs) > 1 else '')
+                return Namespace(name=docker_conf.name, error=None)
+            except Exception as e:
+                logger.debug(f'Failed to launch {docker_conf.name}: {e}')
+                return Namespace(name=docker_conf.name, error=e)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(docker_confs)))) as executor:
+            results = list(executor.map(_launch, docker_confs))
+
+        if mux is not None and len(mux):
+            logger.info(f'--- listening stdout/stderr of {len(mux)} containers ---\n')
+            mux.run()
+        return results
 
     def exec(self, cmd: str, relative_workdir, docker_conf: DockerContainerConfig,
              kill_existing_container: bool = True, interactive: bool = True, quiet: bool = False,
-             log_stderr_background: bool = False, use_cli: bool = True) -> None:
+             log_stderr_background: bool = False, use_cli: bool = True, log_file: str | None = None,
+             mux: LogMux | None = None, prefix: str = '') -> None:
+        """
+        log_file: also write the output of the container to this local file
+        mux: attach the output of the (non-interactive) container to mux, rather than following it here.
+          The caller is responsible for running mux.
+        prefix: prefix of each output line
+        """
         if log_stderr_background:
             assert not interactive, 'log_stderr_background=True cannot be used with interactive=True'
 
@@ -79,17 +241,18 @@ class DockerRunner:
         # NOTE: Intentionally being super verbose to make arguments explicit.
         d = docker_conf
 
-        # TEMP: When running in non-interactive mode and command fails, container disappears before we attach to its log stream,
-        # and thus we cannot observe its error message. A naive way to avoid it is to wait for a bit before command execution.
-        if not interactive:
-            if docker_conf.startup:
-                docker_conf.startup = ' && '.join((docker_conf.startup, 'sleep 2'))
-            else:
-                docker_conf.startup = 'sleep 2'
-
         if docker_conf.startup:
             cmd = ' && '.join((docker_conf.startup, cmd))
-        cmd = f'{cmd} && chmod -R a+rw {str(self.rmxdirs.outdir)}'
+        # NOTE: Rather than `chmod -R` on the output directory after the command (which walks the entire tree,
+        # and is skipped when the command fails), files are created with the right permissions in the first place.
+        if docker_conf.umask is not None:
+            cmd = f'umask {docker_conf.umask} && {cmd}'
+        if docker_conf.log_path is not None:
+            # NOTE: The container is gone once it exits (auto_remove), so keep its output and exit code
+            # in (mounted) files as well. `rmx wait` reads the exit code from there.
+            log_path = docker_conf.log_path
+            cmd = (f'set -o pipefail ; {{ {cmd} ; }} 2>&1 | tee -a {log_path} ; '
+                   f'rmx_status=$? ; echo $rmx_status > {get_exit_path(log_path)} ; exit $rmx_status')
 
         if interactive:
             assert d.tty
@@ -97,7 +260,8 @@ class DockerRunner:
             if use_cli:
                 # Use python-on-whales (i.e., docker cli)
                 import python_on_whales
-                whale_client = python_on_whales.DockerClient(host=f'ssh://{self.client.api._custom_adapter.ssh_host}')
+                docker_host = self.docker_host or f'ssh://{self.client.api._custom_adapter.ssh_host}'
+                whale_client = python_on_whales.DockerClient(host=docker_host)
                 logger.debug(f'docker run with command: {cmd}')
 
                 # NOTE: dockerpy is stupid enough that it cannot attach remote pty.
@@ -186,46 +350,64 @@ class DockerRunner:
 
         else:
             cmd = f'/bin/bash -c \'{cmd}\''
-            container = self.client.containers.run(d.image,
-                                                   cmd,
-                                                   name=d.name,
-                                                   remove=d.remove,  # Keep it running as we need to change
-                                                   network=d.network,
-                                                   ipc_mode=d.ipc_mode,
-                                                   detach=True,
-                                                   tty=(not log_stderr_background),  # If True, stdout/stderr are mixed, but I observed sometimes some stdout are not showing up when tty=False
-                                                   stdin_open=True,  # It's useful to keep it open, as you may manually attach the container later
-                                                   mounts=d.mounts,
-                                                   environment=allenv,
-                                                   device_requests=d.device_requests,
-                                                   working_dir=str(self.rmxdirs.codedir / relative_workdir),
-                                                   user=f'{d.user_id}:{d.group_id}',
-                                                )
+            # NOTE: When the command fails right away, the container may be gone (remove=True) before we attach to its log stream,
+            # and we cannot observe its error message. Thus we create the container, attach to its output and only then start it.
+            # This is what `containers.run(detach=True)` does, minus the attach.
+            create_kwargs = dict(name=d.name,
+                                 auto_remove=d.remove,
+                                 network=d.network,
+                                 ipc_mode=d.ipc_mode,
+                                 detach=True,
+                                 tty=(not log_stderr_background),  # If True, stdout/stderr are mixed, but I observed sometimes some stdout are not showing up when tty=False
+                                 stdin_open=True,  # It's useful to keep it open, as you may manually attach the container later
+                                 mounts=d.mounts,
+                                 environment=allenv,
+                                 device_requests=d.device_requests,
+                                 working_dir=str(self.rmxdirs.codedir / relative_workdir),
+                                 user=f'{d.user_id}:{d.group_id}')
+            from docker.errors import ImageNotFound
+            try:
+                container = self.client.containers.create(d.image, cmd, **create_kwargs)
+            except ImageNotFound:
+                self.client.images.pull(d.image)
+                container = self.client.containers.create(d.image, cmd, **create_kwargs)
             logger.debug(f'container: {container}')
 
-            def log_stream(stream: Iterable):
-                """print out log stream"""
-                for char in stream:
-                    # logger.info(char.decode('utf-8'))
-                    # 'ignore' ignores decode error that happens when multi-byte char is passed.
-                    print(char.decode('utf-8', 'ignore'), end='')
-
-
+            own_mux = False
             if not quiet:
+                if mux is None:
+                    mux, own_mux = LogMux(tee=log_file), True
+                # NOTE: The attach request is sent right here (the stream is only read later), and
+                # it also replays anything written before that.
+                mux.add_container(container, prefix=prefix, stdout=not log_stderr_background)
+            container.start()
+
+            if own_mux:
                 if log_stderr_background:
-                    # Attach log stream in a separate thread, and only output stderr
-                    stream = container.logs(stdout=False, stderr=True, stream=True, follow=True)
+                    # Listen to the log stream in a separate thread, and only output stderr
                     logger.info('quiet is True, only listening to stderr.')
                     logger.info('--- listening container stderr ---\n')
-                    thr = threading.Thread(target=log_stream, args=(stream, ))
-                    thr.start()
-                    # thr.join()  # This blocks forever ;P
+                    mux.start()
+                    # mux.join()  # This blocks forever ;P
 
                 else:
                     # Block and listen to the stream from container
-                    stream = container.logs(stream=True, follow=True)
                     logger.info('--- listening container stdout/stderr ---\n')
-                    log_stream(stream)
+                    mux.run()
+
+
+def to_slurm_array(sweep_ind, throttle: int | None = None) -> str:
+    """Format sweep indices for sbatch --array: [0, 1, 2, 5, 7, 8] --> 0-2,5,7-8"""
+    ranges = []
+    for idx in sorted(set(sweep_ind)):
+        if ranges and ranges[-1][1] == idx - 1:
+            ranges[-1][1] = idx
+        else:
+            ranges.append([idx, idx])
+    array = ','.join(str(begin) if begin == end else f'{begin}-{end}' for begin, end in ranges)
+    if throttle is not None:
+        array += f'%{throttle}'
+    return array
 
 
 class SlurmRunner:
@@ -239,7 +421,17 @@ class SlurmRunner:
 
     def exec(self, cmd: str, relative_workdir, slurm_conf, env: dict | None = None,
              startup: str = "", num_sequence: int = 1,
-             interactive: bool = None, dry_run: bool = False):
+             interactive: bool = None, dry_run: bool = False, sweep_ind: list[int] | None = None,
+             throttle: int | None = None, setup: list[str] = ()):
+        """
+        sweep_ind: submit a job array with these indices (sbatch --array). Each task sets $RMX_RUN_SWEEP_IDX
+          to its $SLURM_ARRAY_TASK_ID, and at most `throttle` tasks run at once.
+        setup: shell commands to run on the login node right before submitting (the jobs inherit what they export)
+
+        In sbatch mode, all the jobs are submitted in a single round trip and a list of
+        Namespace(jobid, sweep_idx, seq_idx, error) is returned, one for each sweep index and sequence position.
+        """
+        import os
         from simple_slurm_command import SlurmCommand
         env = {} if env is None else env
 
@@ -264,6 +456,11 @@ class SlurmRunner:
                                      dependency=s.dependency,
                                      output=s.output,
                                      error=s.error)
+        if sweep_ind is not None:
+            if interactive:
+                logger.warning('A job array cannot be interactive. Force disabling interactive mode')
+                interactive = False
+            slurm_command.add_arguments(array=to_slurm_array(sweep_ind, throttle=throttle))
 
         if interactive and (s.output is not None):
             # User may expect stdout shown on the console.
@@ -276,6 +473,16 @@ class SlurmRunner:
         if startup:
             cmd = f'{startup} && {cmd}'
 
+        if sweep_ind is not None:
+            # NOTE: This special prefix "SINGULARITYENV_" is stripped and the rest is passed to singularity container,
+            # even with --containall or --cleanenv !!
+            # Example: (https://docs.sylabs.io/guides/3.1/user-guide/environment_and_metadata.html?highlight=environment%20variable)
+            #     $ SINGULARITYENV_HELLO=world singularity exec centos7.img env | grep HELLO
+            #     HELLO=world
+            # NOTE: sbatch escapes "$", so $SLURM_ARRAY_TASK_ID is evaluated on the node.
+            cmd = ('export RMX_RUN_SWEEP_IDX=$SLURM_ARRAY_TASK_ID SINGULARITYENV_RMX_RUN_SWEEP_IDX=$SLURM_ARRAY_TASK_ID'
+                   f' && {cmd}')
+
         if interactive:
             # cmd = f'{shell} -i -c \'{cmd}\''
             # Create a temp bash file and put it on the remote server.
@@ -286,21 +493,75 @@ class SlurmRunner:
             # file_obj = StringIO(f"#!/usr/bin/env {s.shell}\n{cmd}\n{s.shell}")
             file_obj = StringIO(exec_file)
             self.client.put(file_obj, workdir / '.srun-script.sh')
-            cmd = slurm_command.srun('.srun-script.sh', pty=s.shell)
+            cmd = ' && '.join([*setup, slurm_command.srun('.srun-script.sh', pty=s.shell)])
 
             logger.debug(f'srun mode:\n{cmd}')
             logger.debug(f'cd to {workdir}')
             return self.client.run(cmd, directory=workdir,
                                    disown=False, env=allenv, pty=True, dry_run=dry_run)
         else:
-            cmd = slurm_command.sbatch(cmd, shell=f'/usr/bin/env {s.shell}')
-            logger.debug(f'sbatch mode:\n{cmd}')
-            logger.debug(f'cd to {self.rmxdirs.codedir / relative_workdir}')
-
-            cmd = '\n'.join([cmd] * num_sequence)
-            result = self.client.run(cmd, directory=(self.rmxdirs.codedir / relative_workdir),
-                                     disown=False, env=allenv, dry_run=dry_run)
-            if result.stderr:
-                logger.warning('sbatch job submission failed:', result.stderr)
-            jobid = result.stdout.strip().split()[-1]  # stdout format: Submitted batch job 8156833
-            logger.debug(f'jobid {jobid}')
+            # The sequential jobs are identical; the singleton dependency makes them run one after another.
+            batch = [Namespace(slurm_command=slurm_command, cmd=cmd, shell=s.shell, seq_idx=seq_idx)
+                     for seq_idx in range(num_sequence)]
+            # NOTE: slurm does not create the directory of --output / --error (the job fails without any output)
+            mkdirs = sorted({os.path.dirname(path) for path in [s.output, s.error] if path and os.path.dirname(path)})
+            setup = [f'mkdir -p {" ".join(mkdirs)}', *setup] if mkdirs else list(setup)
+            submitted = self.submit(batch, relative_workdir, env=allenv, dry_run=dry_run, setup=setup)
+
+            # NOTE: The tasks of a job array have ids of the form <jobid>_<task id>
+            jobs = []
+            for job in submitted:
+                for sweep_idx in (sweep_ind if sweep_ind is not None else [None]):
+                    jobid = job.jobid if (sweep_idx is None or job.jobid is None) else f'{job.jobid}_{sweep_idx}'
+                    jobs.append(Namespace(jobid=jobid, sweep_idx=sweep_idx, seq_idx=job.seq_idx, error=job.error))
+            return jobs
+
+    def submit(self, batch: list[Namespace], relative_workdir, env: dict | None = None,
+               dry_run: bool = False, setup: list[str] = ()) -> list[Namespace]:
+        """Submit (possibly heterogeneous) sbatch jobs in order, in a single ssh round trip.
+
+        batch: Namespace(slurm_command, cmd, shell, ...) for each job; the other attributes are kept in the result.
+        setup: shell commands to run before the submissions (e.g., to create the directories for the output)
+        Returns Namespace(jobid, error, ...) for each job in batch. jobid is None if the submission failed.
+        """
+        # Each submission prints a marker line with its position in the batch, so that a failed sbatch
+        # does not shift the job ids of the others.
+        script = list(setup)
+        for idx, job in enumerate(batch):
+            sbatch = job.slurm_command.sbatch(job.cmd, shell=f'/usr/bin/env {job.shell}', sbatch_cmd='sbatch --parsable')
+            script.append(f'rmx_jobid=$({sbatch}\n) && echo "{SBATCH_MARKER} {idx} $rmx_jobid" || echo "{SBATCH_MARKER} {idx} FAILED"')
+        script = '\n'.join(script)
+        logger.debug(f'sbatch mode:\n{script}')
+        logger.debug(f'cd to {self.rmxdirs.codedir / relative_workdir}')
+
+        result = self.client.run(script, directory=(self.rmxdirs.codedir / relative_workdir),
+                                 disown=False, env=env, dry_run=dry_run, hide='stdout')
+        if result is None:  # dry run
+            return [Namespace(**{**vars(job), 'jobid': None, 'error': None}) for job in batch]
+
+        jobids = parse_sbatch_output(result.stdout)
+        submitted = []
+        for idx, job in enumerate(batch):
+            info = {key: val for key, val in vars(job).items() if key not in ['slurm_command', 'cmd', 'shell']}
+            jobid = jobids.get(idx)
+            error = None if jobid is not None else 'sbatch job submission failed'
+            submitted.append(Namespace(**info, jobid=jobid, error=error))
+        if result.stderr:
+            logger.warning(f'sbatch job submission failed:\n{result.stderr}')
+        logger.debug(f'jobids {[job.jobid for job in submitted]}')
+        return submitted
+
+
+SBATCH_MARKER = 'rmx-sbatch'
+
+
+def parse_sbatch_output(stdout: str) -> dict:
+    """Parse the marker lines printed by SlurmRunner.submit: {position in the batch: jobid}"""
+    jobids = {}
+    for line in stdout.splitlines():
+        tokens = line.strip().split()
+        if len(tokens) != 3 or tokens[0] != SBATCH_MARKER or tokens[2] == 'FAILED':
+            continue
+        # sbatch --parsable prints <jobid> or <jobid>;<cluster>
+        jobids[int(tokens[1])] = tokens[2].split(';')[0]
+    return jobids
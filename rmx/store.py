@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Local SQLite stores that keep what rmx knows about the jobs on each machine."""
+from __future__ import annotations
+import sqlite3
+from os.path import expandvars
+from typing import Iterable
+
+from rmx import logger
+from rmx.helpers import get_sacct_cmd, iter_sacct, parse_memory
+
+JOB_STORE = expandvars('$HOME/.rmx/jobs.sqlite')
+LAUNCH_HISTORY = expandvars('$HOME/.rmx/launches.sqlite')
+PROBE_CACHE = expandvars('$HOME/.rmx/probes.sqlite')
+
+# How long the launch history is kept (seconds)
+LAUNCH_RETENTION = 60 * 60 * 24 * 30
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open the database at path. WAL lets concurrent rmx processes read while one of them writes."""
+    import os
+    if path != ':memory:':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def _normalize_time(value: str) -> str | None:
+    return None if value in ('', 'Unknown', 'None') else value
+
+
+class JobStore:
+    """Slurm job records of each machine, updated incrementally from sacct.
+
+    Each refresh only asks sacct for the jobs that were pending, running or finished since the previous refresh
+    (on the clock of the machine), and upserts them. Queries are then answered from the local store.
+    """
+    _SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        machine TEXT NOT NULL,
+        jobid TEXT NOT NULL,
+        name TEXT,
+        state TEXT,
+        exit_code TEXT,
+        nodelist TEXT,
+        elapsed TEXT,
+        submit TEXT,
+        start TEXT,
+        end TEXT,
+        max_rss INTEGER,
+        PRIMARY KEY (machine, jobid)
+    );
+    CREATE INDEX IF NOT EXISTS jobs_name ON jobs (machine, name);
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs (machine, state);
+    CREATE INDEX IF NOT EXISTS jobs_submit ON jobs (machine, submit);
+    CREATE TABLE IF NOT EXISTS polls (
+        machine TEXT PRIMARY KEY,
+        polled_at TEXT NOT NULL
+    );
+    '''
+    # Printed by the remote before running sacct, so that the next refresh starts from the clock of the remote
+    _NOW_MARKER = 'rmx-now'
+
+    def __init__(self, path: str = JOB_STORE) -> None:
+        self.conn = connect(path)
+        self.conn.executescript(self._SCHEMA)
+
+    def get_refresh_cmd(self, machine: str) -> str:
+        row = self.conn.execute('SELECT polled_at FROM polls WHERE machine = ?', (machine,)).fetchone()
+        starttime = None if row is None else row['polled_at']
+        return f'echo "{self._NOW_MARKER} $(date +%Y-%m-%dT%H:%M:%S)" && {get_sacct_cmd(starttime)}'
+
+    def update(self, machine: str, lines: Iterable[str]) -> int:
+        """Store the output of the command from get_refresh_cmd. Returns the number of jobs updated."""
+        lines = iter(lines)
+        polled_at = None
+        for line in lines:
+            if line.startswith(self._NOW_MARKER):
+                polled_at = line.split()[1]
+                break
+
+        def _records():
+            for entry in iter_sacct(lines):
+                yield (machine, entry['JobID'], entry.get('JobName'), entry.get('State', '').split(' ')[0],
+                       entry.get('ExitCode'), entry.get('NodeList'), entry.get('Elapsed'),
+                       _normalize_time(entry.get('Submit', '')), _normalize_time(entry.get('Start', '')),
+                       _normalize_time(entry.get('End', '')), parse_memory(entry.get('MaxRSS', '')) or None)
+
+        with self.conn:
+            records = list(_records())
+            # The pending tasks of a job array show up as a single row (e.g., 1234_[5-255%16]) that shrinks as
+            # tasks start. Drop the stale ones of the arrays in this update; the current one is in the records.
+            arrays = {jobid.split('_')[0] for _, jobid, *_ in records if '_' in jobid}
+            self.conn.executemany("DELETE FROM jobs WHERE machine = ? AND jobid GLOB ?",
+                                  [(machine, f'{array}_[[]*') for array in arrays])
+            self.conn.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+            if polled_at is not None:
+                self.conn.execute('INSERT OR REPLACE INTO polls VALUES (?, ?)', (machine, polled_at))
+        return len(records)
+
+    def refresh(self, machine: str, client) -> int:
+        """Query the jobs that changed since the last refresh on machine (via client, a SimpleSSHClient)."""
+        result = client.run(self.get_refresh_cmd(machine), hide=True, warn=True)
+        if result.exited != 0:
+            raise OSError(f'sacct failed on {machine}:\n{result.stderr}')
+        num_jobs = self.update(machine, result.stdout.splitlines())
+        logger.debug(f'{num_jobs} jobs are updated on {machine}')
+        return num_jobs
+
+    def query(self, machine: str, name: str | None = None, states: list[str] | None = None,
+              limit: int | None = None) -> list[sqlite3.Row]:
+        """Jobs on machine from the newest, optionally filtered by name (prefix) and states."""
+        conditions, params = ['machine = ?'], [machine]
+        if name is not None:
+            conditions.append("name GLOB ?")
+            params.append(f'{name}*')
+        if states:
+            conditions.append(f"state IN ({', '.join('?' * len(states))})")
+            params += states
+        sql = f"SELECT * FROM jobs WHERE {' AND '.join(conditions)} ORDER BY submit DESC, jobid DESC"
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return self.conn.execute(sql, params).fetchall()
+
+    def get(self, machine: str, jobids: list[str]) -> dict[str, sqlite3.Row]:
+        """{jobid: job} for the jobids that are in the store"""
+        jobs = {}
+        jobids = list(jobids)
+        # NOTE: sqlite limits the number of parameters in a query
+        for i in range(0, len(jobids), 500):
+            chunk = jobids[i:i + 500]
+            sql = f"SELECT * FROM jobs WHERE machine = ? AND jobid IN ({', '.join('?' * len(chunk))})"
+            jobs.update({row['jobid']: row for row in self.conn.execute(sql, [machine, *chunk])})
+        return jobs
+
+    def count_states(self, machine: str, name: str | None = None) -> dict[str, int]:
+        sql = 'SELECT state, COUNT(*) AS num FROM jobs WHERE machine = ?'
+        params = [machine]
+        if name is not None:
+            sql += ' AND name GLOB ?'
+            params.append(f'{name}*')
+        return {row['state']: row['num'] for row in self.conn.execute(sql + ' GROUP BY state', params)}
+
+
+class LaunchHistory:
+    """Every job launched by `rmx run` (one entry per container, slurm job or array task, ...).
+
+    Concurrent rmx processes can append safely (each write is a transaction), and the entries are indexed by time,
+    so that pruning old entries and range queries don't read the entire history.
+    """
+    FIELDS = ['launch_id', 'timestamp', 'project', 'machine', 'mode', 'name', 'sweep_idx', 'jobid', 'cmd', 'logdir']
+    _SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS launches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        launch_id TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        project TEXT,
+        machine TEXT,
+        mode TEXT,
+        name TEXT,
+        sweep_idx INTEGER,
+        jobid TEXT,
+        cmd TEXT,
+        logdir TEXT
+    );
+    CREATE INDEX IF NOT EXISTS launches_timestamp ON launches (timestamp);
+    CREATE INDEX IF NOT EXISTS launches_project ON launches (project, timestamp);
+    CREATE INDEX IF NOT EXISTS launches_machine ON launches (machine, timestamp);
+    CREATE INDEX IF NOT EXISTS launches_launch_id ON launches (launch_id);
+    '''
+
+    def __init__(self, path: str = LAUNCH_HISTORY, retention: float | None = LAUNCH_RETENTION) -> None:
+        """retention: entries older than this (seconds) are dropped when new ones are logged (None to keep everything)"""
+        self.conn = connect(path)
+        self.conn.executescript(self._SCHEMA)
+        self.retention = retention
+
+    def log(self, entries: list[dict]) -> str:
+        """Record the entries of a single launch. Returns its launch_id."""
+        import time
+        import uuid
+        launch_id = uuid.uuid4().hex
+        timestamp = time.time()
+        records = [tuple({**entry, 'launch_id': launch_id, 'timestamp': entry.get('timestamp', timestamp)}.get(field)
+                         for field in self.FIELDS)
+                   for entry in entries]
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO launches ({', '.join(self.FIELDS)}) "
+                                  f"VALUES ({', '.join('?' * len(self.FIELDS))})", records)
+            if self.retention is not None:
+                self.prune(timestamp - self.retention)
+        return launch_id
+
+    def prune(self, before: float) -> int:
+        """Drop the entries launched before the timestamp"""
+        with self.conn:
+            return self.conn.execute('DELETE FROM launches WHERE timestamp < ?', (before,)).rowcount
+
+    def query(self, project: str | None = None, machine: str | None = None, mode: str | None = None,
+              name: str | None = None, sweep_idx: int | None = None, launch_id: str | None = None,
+              since: float | None = None, until: float | None = None, limit: int | None = None) -> list[dict]:
+        """Entries that match all the given conditions, from the newest"""
+        conditions, params = [], []
+        for field, value in [('project', project), ('machine', machine), ('mode', mode), ('name', name),
+                             ('sweep_idx', sweep_idx), ('launch_id', launch_id)]:
+            if value is not None:
+                conditions.append(f'{field} = ?')
+                params.append(value)
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('timestamp < ?')
+            params.append(until)
+        sql = f"SELECT {', '.join(self.FIELDS)} FROM launches"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        sql += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def get(self, machine: str, jobids: list[str]) -> dict[str, dict]:
+        """{jobid: the latest entry with the jobid} for the jobids (e.g., container names) launched on machine"""
+        launches = {}
+        jobids = list(jobids)
+        # NOTE: sqlite limits the number of parameters in a query
+        for i in range(0, len(jobids), 500):
+            chunk = jobids[i:i + 500]
+            sql = (f"SELECT {', '.join(self.FIELDS)} FROM launches "
+                   f"WHERE machine = ? AND jobid IN ({', '.join('?' * len(chunk))}) ORDER BY timestamp, id")
+            launches.update({row['jobid']: dict(row) for row in self.conn.execute(sql, [machine, *chunk])})
+        return launches
+
+    def latest(self, project: str | None = None, machine: str | None = None) -> list[dict]:
+        """All the entries of the latest launch (e.g., every task of the latest sweep)"""
+        last = self.query(project=project, machine=machine, limit=1)
+        if not last:
+            return []
+        return self.query(launch_id=last[0]['launch_id'])
+
+
+class ProbeCache:
+    """The latest probe (GPUs, load, memory; see rmx.cli._probe) of each machine, valid for ttl seconds."""
+    _SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS probes (
+        machine TEXT PRIMARY KEY,
+        probed_at REAL NOT NULL,
+        result TEXT NOT NULL
+    );
+    '''
+
+    def __init__(self, path: str = PROBE_CACHE, ttl: float = 30.) -> None:
+        self.conn = connect(path)
+        self.conn.executescript(self._SCHEMA)
+        self.ttl = ttl
+
+    def get(self, machines: list[str]) -> dict[str, dict]:
+        """{machine: result} for the machines probed within ttl"""
+        import json
+        import time
+        if not machines or self.ttl <= 0:
+            return {}
+        sql = f"SELECT * FROM probes WHERE probed_at >= ? AND machine IN ({', '.join('?' * len(machines))})"
+        rows = self.conn.execute(sql, [time.time() - self.ttl, *machines])
+        return {row['machine']: json.loads(row['result']) for row in rows}
+
+    def put(self, results: dict[str, dict]) -> None:
+        import json
+        import time
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO probes VALUES (?, ?, ?)',
+                                  [(machine, result.get('probed_at', now), json.dumps(result))
+                                   for machine, result in results.items()])
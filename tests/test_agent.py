@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+from rmx.agent import forward, is_running
+
+# Serve with a stub command, so that we only exercise forwarding (fds, cwd, env and exit codes)
+SERVER = '''
+import os, sys, rmx.cli
+def core(args):
+    print('cwd', os.getcwd(), 'env', os.environ.get('RMX_TEST_VAR'), 'args', *args)
+    raise SystemExit(int(args[0]))
+rmx.cli.core = core
+from rmx.agent import AgentServer
+AgentServer(sys.argv[1], sys.argv[2]).serve()
+'''
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self._tmpdir.name, 'agent.sock')
+        self.pidfile = os.path.join(self._tmpdir.name, 'agent.pid')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_no_agent(self):
+        self.assertIsNone(forward(['run', 'birch'], socket_path=self.socket_path))
+
+    def test_forward(self):
+        proc = subprocess.Popen([sys.executable, '-c', SERVER, self.socket_path, self.pidfile],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                env={**os.environ, 'PYTHONPATH': os.getcwd()})
+        try:
+            for _ in range(200):
+                if is_running(self.pidfile) == proc.pid:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(is_running(self.pidfile), proc.pid)
+
+            read_fd, write_fd = os.pipe()
+            os.environ['RMX_TEST_VAR'] = 'hello'
+            try:
+                with open(os.devnull, 'r') as devnull:
+                    code = forward(['3', 'a b'], socket_path=self.socket_path,
+                                   fds=[devnull.fileno(), write_fd, write_fd])
+            finally:
+                del os.environ['RMX_TEST_VAR']
+                os.close(write_fd)
+            with os.fdopen(read_fd) as f:
+                output = f.read()
+            self.assertEqual(code, 3)
+            self.assertEqual(output.strip(), f'cwd {os.getcwd()} env hello args 3 a b')
+        finally:
+            proc.terminate()
+            proc.wait()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_stale(self):
+        """An agent of another rmx installation exits, and the client starts a new one"""
+        proc = subprocess.Popen([sys.executable, '-c', SERVER, self.socket_path, self.pidfile],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                env={**os.environ, 'PYTHONPATH': os.getcwd()})
+        try:
+            for _ in range(200):
+                if is_running(self.pidfile) == proc.pid:
+                    break
+                time.sleep(0.05)
+            with open(os.devnull, 'r') as devnull, mock.patch('rmx.agent.get_stamp', return_value='0.0.0:0'), \
+                    mock.patch('rmx.agent.start') as start:
+                code = forward(['0'], socket_path=self.socket_path, pidfile=self.pidfile,
+                               fds=[devnull.fileno()] * 3)
+            self.assertIsNone(code)
+            start.assert_called_once_with(self.socket_path, self.pidfile, wait=False)
+            self.assertEqual(proc.wait(timeout=10), 0)
+        finally:
+            proc.kill()
+            proc.wait()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertFalse(os.path.exists(self.pidfile))
+
+    def test_reap(self):
+        """Only the forked commands are reaped, so that Popen still gets the exit code of its process"""
+        from rmx.agent import AgentServer
+        server = AgentServer(self.socket_path, self.pidfile)
+        proc = subprocess.Popen(['sh', '-c', 'exit 3'])
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        server._workers.add(pid)
+        time.sleep(0.2)
+        server._reap()
+        self.assertEqual(server._workers, set())
+        self.assertEqual(proc.wait(), 3)
+
+    def test_warm(self):
+        """The cwd and environment of a request don't leak into the agent"""
+        from rmx.agent import AgentServer
+        home = os.path.join(self._tmpdir.name, 'home')
+        project = os.path.join(self._tmpdir.name, 'project')
+        os.makedirs(home)
+        os.makedirs(os.path.join(project, '.git'))
+        with open(os.path.join(home, '.rmx.config'), 'w') as f:
+            f.write('{"machines": {"birch": {"user": "me", "host": "birch.example.com"}}}')
+
+        cwd, environ = os.getcwd(), dict(os.environ)
+        with mock.patch('rmx.manifest.SyncManifest.for_target') as for_target, \
+                mock.patch('rmx.filelist.FileListBuilder') as builder:
+            base_uris = AgentServer(self.socket_path, self.pidfile)._warm(
+                {'args': ['run', 'birch'], 'cwd': project, 'env': {'HOME': home, 'RMX_TEST_VAR': 'hello'}})
+        self.assertEqual(base_uris, ['me@birch.example.com'])
+        # Only the manifest and file list of this project on this machine are loaded
+        for_target.assert_called_once_with(mock.ANY, 'me@birch.example.com:/tmp/me/rmx/project/code')
+        self.assertEqual(builder.call_count, 1)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(dict(os.environ), environ)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from rmx.filelist import IgnoreRule, build_file_list, is_ignored, parse_ignore_lines
+
+
+class TestIgnoreRules(unittest.TestCase):
+    def test_basename_any_depth(self):
+        rules = parse_ignore_lines(['*.pyc', '__pycache__/'])
+        self.assertTrue(is_ignored('a/b/c.pyc', False, rules))
+        self.assertTrue(is_ignored('a/__pycache__', True, rules))
+        self.assertFalse(is_ignored('a/__pycache__', False, rules))
+
+    def test_anchored(self):
+        rules = parse_ignore_lines(['/build', 'docs/_build'])
+        self.assertTrue(is_ignored('build', True, rules))
+        self.assertFalse(is_ignored('src/build', True, rules))
+        self.assertTrue(is_ignored('docs/_build', True, rules))
+        self.assertFalse(is_ignored('src/docs/_build', True, rules))
+
+    def test_double_star(self):
+        rules = parse_ignore_lines(['**/logs', 'data/**', 'a/**/z'])
+        self.assertTrue(is_ignored('x/y/logs', True, rules))
+        self.assertTrue(is_ignored('data/train/0.npz', False, rules))
+        self.assertFalse(is_ignored('data', True, rules))
+        self.assertTrue(is_ignored('a/z', False, rules))
+        self.assertTrue(is_ignored('a/b/c/z', False, rules))
+
+    def test_negation(self):
+        rules = parse_ignore_lines(['*.log', '!keep.log', '# comment', ''])
+        self.assertTrue(is_ignored('x.log', False, rules))
+        self.assertFalse(is_ignored('sub/keep.log', False, rules))
+
+    def test_base(self):
+        """Rules from sub/.gitignore only apply below sub/"""
+        rules = parse_ignore_lines(['/out'], base='sub/')
+        self.assertTrue(is_ignored('sub/out', True, rules))
+        self.assertFalse(is_ignored('out', True, rules))
+
+    def test_rsync_style(self):
+        self.assertTrue(IgnoreRule('a/b', style='rsync').match('x/a/b', False))
+        self.assertFalse(IgnoreRule('a/b', style='gitignore').match('x/a/b', False))
+
+
+class TestBuildFileList(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmpdir.name) / 'proj'
+        self.cache_dir = Path(self._tmpdir.name) / 'cache'
+        for path in ['main.py', 'venv/lib/x.py', 'pkg/mod.py', 'pkg/out/result.txt', 'video.mp4']:
+            (self.root / path).parent.mkdir(parents=True, exist_ok=True)
+            (self.root / path).write_text(path)
+        (self.root / '.gitignore').write_text('venv/\n')
+        (self.root / 'pkg' / '.rmxignore').write_text('out/\n')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def build(self, use_gitignore=True, **kwargs):
+        return build_file_list(self.root, cache_dir=self.cache_dir, use_gitignore=use_gitignore, **kwargs)
+
+    def test_ignore_files(self):
+        self.assertEqual(self.build(exclude=['*.mp4']), ['.gitignore', 'main.py', 'pkg/.rmxignore', 'pkg/mod.py'])
+
+    def test_without_gitignore(self):
+        self.assertIn('venv/lib/x.py', self.build(use_gitignore=False))
+        # .gitignore is opt-in
+        self.assertIn('venv/lib/x.py', build_file_list(self.root, cache_dir=None))
+
+    def test_empty_dirs(self):
+        (self.root / 'empty' / 'nested').mkdir(parents=True)
+        (self.root / 'ckpt').mkdir()
+        (self.root / 'ckpt' / 'model.mp4').write_text('ignored')
+        files = self.build(exclude=['*.mp4'])
+        # Only the leaves are listed; their parents are created on the way
+        self.assertIn('empty/nested/', files)
+        self.assertNotIn('empty/', files)
+        # A directory whose content is all ignored is created empty
+        self.assertIn('ckpt/', files)
+        self.assertNotIn('pkg/', files)
+
+    def test_cache_invalidation(self):
+        self.assertNotIn('new.py', self.build())
+        (self.root / 'new.py').write_text('new')
+        self.assertIn('new.py', self.build())
+
+        # Editing an ignore file in place (the directory mtime does not change)
+        files = self.build()
+        self.assertNotIn('pkg/out/result.txt', files)
+        with open(self.root / 'pkg' / '.rmxignore', 'w') as f:
+            f.write('# nothing\n')
+        os.utime(self.root / 'pkg' / '.rmxignore', ns=(1, 1))
+        self.assertIn('pkg/out/result.txt', self.build())
+
+        # Rules inherited from a parent directory changed
+        (self.root / '.gitignore').write_text('venv/\nmod.py\n')
+        os.utime(self.root / '.gitignore', ns=(2, 2))
+        self.assertNotIn('pkg/mod.py', self.build())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import io
+import os
+import socket
+import struct
+import tempfile
+import unittest
+from rmx.logstream import BatchedWriter, FrameParser, LineBuffer, LogMux, RemoteLogTail
+
+
+class LocalClient:
+    """Runs the commands locally, in place of SimpleSSHClient"""
+    def __init__(self):
+        self.num_bytes = 0
+
+    def capture(self, cmd):
+        import subprocess
+        out = subprocess.run(['sh', '-c', cmd], capture_output=True)
+        self.num_bytes += len(out.stdout)
+        return out.returncode, out.stdout, out.stderr.decode()
+
+
+def frame(stream_type, payload):
+    return struct.pack('>BxxxL', stream_type, len(payload)) + payload
+
+
+class TestLogStream(unittest.TestCase):
+    def test_split_multibyte_char(self):
+        data = 'こんにちは\n'.encode('utf-8')
+        lines = LineBuffer()
+        self.assertEqual(''.join(lines.feed(data[i:i + 1]) for i in range(len(data))), 'こんにちは\n')
+
+    def test_prefixed_lines(self):
+        lines = LineBuffer('[a] ')
+        self.assertEqual(lines.feed(b'one\ntw'), '[a] one\n')
+        self.assertEqual(lines.feed(b'o\nthr'), '[a] two\n')
+        self.assertEqual(lines.feed(b'', final=True), '[a] thr\n')
+
+    def test_frames(self):
+        parser = FrameParser()
+        data = frame(1, b'out\n') + frame(2, b'err\n')
+        self.assertEqual(parser.feed(data[:6]), [])
+        self.assertEqual(parser.feed(data[6:12]), [(1, b'out\n')])
+        self.assertEqual(parser.feed(data[12:]), [(2, b'err\n')])
+
+    def test_mux(self):
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_file = os.path.join(tmpdir, 'logs', 'run.log')
+            mux = LogMux(out, tee=log_file)
+            senders = []
+            for name, framed in [('a', False), ('b', True)]:
+                sender, receiver = socket.socketpair()
+                mux.add(receiver, prefix=f'[{name}] ', framed=framed, stderr=(name == 'a'))
+                senders.append(sender)
+
+            senders[0].sendall(b'a1\na')
+            senders[1].sendall(frame(1, b'b1\n') + frame(2, b'hidden\n'))
+            senders[0].sendall(b'2\n')
+            for sender in senders:
+                sender.close()
+            mux.run()
+
+            self.assertEqual(sorted(out.getvalue().splitlines()), ['[a] a1', '[a] a2', '[b] b1'])
+            with open(log_file) as f:
+                self.assertEqual(f.read(), out.getvalue())
+
+
+    def test_remote_tail(self):
+        out = io.StringIO()
+        client = LocalClient()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tail = RemoteLogTail(client, tmpdir, BatchedWriter(out))
+            with open(os.path.join(tmpdir, '0.log'), 'wb') as f:
+                f.write('a\nβ'.encode('utf-8')[:-1])
+            tail.poll()
+            self.assertEqual(out.getvalue(), 'a\n')
+
+            # Only the new bytes are fetched, and new files are picked up (with prefixes from then on)
+            client.num_bytes = 0
+            with open(os.path.join(tmpdir, '0.log'), 'ab') as f:
+                f.write('β'.encode('utf-8')[-1:] + b'\n')
+            with open(os.path.join(tmpdir, '1.log'), 'wb') as f:
+                f.write(b'x\ny')
+            self.assertEqual(tail.poll(), 5)
+            self.assertLess(client.num_bytes, 50)
+            self.assertEqual(tail.poll(), 0)
+            tail.close()
+            self.assertEqual(out.getvalue().splitlines(), ['a', '[0] β', '[1] x', '[1] y'])
+
+    def test_remote_tail_spaces(self):
+        """File names and log directories with spaces don't break the frames"""
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logdir = os.path.join(tmpdir, 'my logs')
+            os.makedirs(logdir)
+            for name, content in [('run 0.log', b'a 1 2\n'), ('run 1.log', b'b\n')]:
+                with open(os.path.join(logdir, name), 'wb') as f:
+                    f.write(content)
+            tail = RemoteLogTail(LocalClient(), logdir, BatchedWriter(out))
+            self.assertEqual(tail.poll(), 8)
+            self.assertEqual(tail.offsets, {'run 0.log': 6, 'run 1.log': 2})
+            tail.close()
+            self.assertEqual(out.getvalue().splitlines(), ['[run 0] a 1 2', '[run 1] b'])
+
+    def test_parse_frames(self):
+        data = b'rmx-log 0 2 a b.log\nhirmx-log 5 0 c 1 2.log\n'
+        self.assertEqual(RemoteLogTail.parse(data), [('a b.log', 0, b'hi'), ('c 1 2.log', 5, b'')])
+        with self.assertRaises(ValueError):
+            RemoteLogTail.parse(b'oops\n')
+
+    def test_remote_tail_missing(self):
+        tail = RemoteLogTail(LocalClient(), '/nonexistent/rmx/logs', BatchedWriter(io.StringIO()))
+        with self.assertRaises(FileNotFoundError):
+            tail.poll()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import io
+import os
+import shlex
+import tempfile
+import unittest
+from unittest import mock
+from rmx.machine import RemoteConfig, SSHMaster, SimpleSSHClient
+
+# Runs the remote command (the last argument) locally. `ssh -O check` thus fails, and the master is "started".
+FAKE_SSH = """#!/bin/sh
+for last; do :; done
+exec sh -c "$last"
+"""
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_shared_per_host(self):
+        conf = RemoteConfig('user', 'pool-test-host')
+        self.assertIs(SimpleSSHClient(conf).master, SimpleSSHClient(RemoteConfig('user', 'pool-test-host')).master)
+        self.assertIsNot(conf.get_master(), RemoteConfig('other', 'pool-test-host').get_master())
+
+    def test_commands_use_master(self):
+        client = SimpleSSHClient(RemoteConfig('user', 'pool-test-host'))
+        args = client.ssh_args('ls')
+        self.assertEqual(args[1:1 + len(client.master.options)], client.master.options)
+        self.assertEqual(args[-2:], ['user@pool-test-host', 'ls'])
+        self.assertIn('-tt', client.ssh_args('ls', pty=True))
+
+    def test_master_options(self):
+        master = SSHMaster('user@host', control_dir='/tmp/rmx ssh')
+        args = shlex.split(master.ssh_command)
+        self.assertEqual(args[0], 'ssh')
+        self.assertEqual(args[1:], master.options)
+        self.assertIn(f'ControlPath={master.control_path}', args)
+        self.assertNotEqual(master.control_path, SSHMaster('user@other', control_dir='/tmp/rmx ssh').control_path)
+
+
+
+class TestSimpleSSHClient(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, 'ssh'), 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(os.path.join(self.tmpdir.name, 'ssh'), 0o755)
+        patch = mock.patch.dict(os.environ, {'PATH': f'{self.tmpdir.name}:{os.environ["PATH"]}'})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.client = SimpleSSHClient(RemoteConfig('user', 'client-test-host'))
+        self.client.master = SSHMaster('user@client-test-host', control_dir=self.tmpdir.name)
+
+    def test_run(self):
+        out, err = io.StringIO(), io.StringIO()
+        result = self.client.run('echo $GREETING && pwd && echo oops >&2', directory=self.tmpdir.name,
+                                 env={'GREETING': 'hello world'}, in_stream=False, out_stream=out, err_stream=err)
+        self.assertEqual(result.exited, 0)
+        self.assertEqual(result.stdout, f'hello world\n{os.path.realpath(self.tmpdir.name)}\n')
+        self.assertEqual(out.getvalue(), result.stdout)
+        self.assertEqual(err.getvalue(), 'oops\n')
+
+    def test_run_failure(self):
+        result = self.client.run('echo hidden ; exit 3', hide=True, warn=True, in_stream=False)
+        self.assertEqual((result.exited, result.stdout), (3, 'hidden\n'))
+        with self.assertRaises(SystemExit):
+            self.client.run('exit 3', hide=True, in_stream=False)
+        with self.assertRaises(TimeoutError):
+            self.client.run('sleep 10', hide=True, in_stream=False, timeout=0.5)
+
+    def test_pipe_and_put(self):
+        payload = bytes(range(256)) * 1000
+        path = os.path.join(self.tmpdir.name, 'payload')
+        status, num_bytes, _ = self.client.pipe(f'cat > {path}', io.BytesIO(payload))
+        self.assertEqual((status, num_bytes), (0, len(payload)))
+        self.assertEqual(self.client.capture(f'cat {path}'), (0, payload, ''))
+        self.client.put(io.StringIO('#!/bin/sh\n'), os.path.join(self.tmpdir.name, 'script'))
+        with open(os.path.join(self.tmpdir.name, 'script')) as f:
+            self.assertEqual(f.read(), '#!/bin/sh\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
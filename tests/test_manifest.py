@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from rmx.manifest import SyncManifest, load_latest_snapshot, prune_manifests, save_latest_snapshot, scan_tree
+from rmx.filelist import is_excluded
+
+
+class TestIsExcluded(unittest.TestCase):
+    def test_basename(self):
+        self.assertTrue(is_excluded('a/b/__pycache__', ['__pycache__'], is_dir=True))
+        self.assertTrue(is_excluded('a/video.mp4', ['*.mp4']))
+        self.assertFalse(is_excluded('a/video.mp4', ['*.png']))
+
+    def test_anchored(self):
+        self.assertTrue(is_excluded('build', ['/build'], is_dir=True))
+        self.assertFalse(is_excluded('src/build', ['/build'], is_dir=True))
+
+    def test_dir_only(self):
+        self.assertTrue(is_excluded('logs', ['logs/'], is_dir=True))
+        self.assertFalse(is_excluded('logs', ['logs/'], is_dir=False))
+
+
+class TestSyncManifest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = Path(self._tmpdir.name)
+        self.src = self.tmpdir / 'src'
+        (self.src / 'pkg').mkdir(parents=True)
+        (self.src / 'pkg' / 'a.py').write_text('print("a")')
+        (self.src / 'b.txt').write_text('b')
+        (self.src / 'skip.mp4').write_text('video')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_scan_respects_exclude(self):
+        entries = scan_tree(self.src, exclude=['*.mp4'])
+        self.assertEqual(sorted(entries), ['b.txt', 'pkg/a.py'])
+
+    def test_diff(self):
+        manifest = SyncManifest.for_target(self.src, 'user@host:/tmp/code', manifest_dir=self.tmpdir / 'manifests')
+        self.assertFalse(manifest.exists)
+        manifest.save(scan_tree(self.src))
+        sync_id = manifest.sync_id
+
+        # Reload from disk and make sure nothing changed
+        manifest = SyncManifest.for_target(self.src, 'user@host:/tmp/code', manifest_dir=self.tmpdir / 'manifests')
+        self.assertEqual(manifest.sync_id, sync_id)
+        self.assertEqual(manifest.diff(scan_tree(self.src, cache=manifest.entries)), ([], []))
+
+        (self.src / 'b.txt').write_text('bb')
+        (self.src / 'c.txt').write_text('c')
+        os.remove(self.src / 'skip.mp4')
+        changed, removed = manifest.diff(scan_tree(self.src, cache=manifest.entries))
+        self.assertEqual(changed, ['b.txt', 'c.txt'])
+        self.assertEqual(removed, ['skip.mp4'])
+
+    def test_chmod(self):
+        """A change of the permissions alone is synced, as rsync --archive would"""
+        manifest = SyncManifest(self.tmpdir / 'manifest.json')
+        manifest.save(scan_tree(self.src))
+        os.chmod(self.src / 'b.txt', 0o755)
+        self.assertEqual(manifest.diff(scan_tree(self.src, cache=manifest.entries)), (['b.txt'], []))
+
+    def test_touch_without_change(self):
+        """Only mtime changes: the content hash is recomputed and matches."""
+        manifest = SyncManifest(self.tmpdir / 'manifest.json')
+        manifest.save(scan_tree(self.src))
+        os.utime(self.src / 'b.txt', ns=(0, 0))
+        self.assertEqual(manifest.diff(scan_tree(self.src, cache=manifest.entries)), ([], []))
+
+    def test_snapshot_manifests(self):
+        """The manifests of a replaced snapshot are removed"""
+        manifest_dir = self.tmpdir / 'manifests'
+        index_path = manifest_dir / 'snapshots.json'
+        old = SyncManifest.for_target(self.src, 'user@host:/rmx/1/proj/code', manifest_dir=manifest_dir)
+        old.save(scan_tree(self.src))
+        save_latest_snapshot('user@host:/rmx/proj', '/rmx/1', manifests=[old.path], index_path=index_path)
+
+        new = SyncManifest.for_target(self.src, 'user@host:/rmx/2/proj/code', manifest_dir=manifest_dir)
+        new.save(scan_tree(self.src))
+        save_latest_snapshot('user@host:/rmx/proj', '/rmx/2', manifests=[new.path], index_path=index_path)
+        self.assertEqual(load_latest_snapshot('user@host:/rmx/proj', index_path=index_path), '/rmx/2')
+        self.assertFalse(old.path.exists())
+        self.assertTrue(new.path.exists())
+
+        # Manifests untouched for too long are pruned, but not the index
+        os.utime(new.path, (0, 0))
+        os.utime(index_path, (0, 0))
+        self.assertEqual(prune_manifests(60, manifest_dir=manifest_dir), 1)
+        self.assertTrue(index_path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import unittest
+from rmx.cli._probe import distribute_sweep, get_capacity, get_free_gpus, get_probe_cmd, parse_probe
+from rmx.store import ProbeCache
+
+OUTPUT = '''rmx-gpu
+0, GPU-aaa, NVIDIA RTX A6000, 1, 49140, 0
+1, GPU-bbb, NVIDIA RTX A6000, 30211, 49140, 97
+2, GPU-ccc, NVIDIA RTX A6000, 3, 49140, 0
+3, GPU-ddd, NVIDIA RTX A6000, [N/A], 49140, [N/A]
+rmx-app
+GPU-bbb
+GPU-bbb
+GPU-ccc
+rmx-cpu
+64
+12.50 10.01 9.87 3/1234 5678
+rmx-mem
+MemTotal:       263842868 kB
+MemAvailable:   200000000 kB
+'''
+
+
+class TestProbe(unittest.TestCase):
+    def test_parse(self):
+        result = parse_probe(OUTPUT)
+        self.assertEqual([gpu['num_procs'] for gpu in result['gpus']], [0, 2, 1, 0])
+        self.assertIsNone(result['gpus'][3]['memory_used'])
+        # GPU 2 is idle but a process holds it
+        self.assertEqual(get_free_gpus(result), [0, 3])
+        self.assertEqual((result['ncpus'], result['load']), (64, 12.5))
+        self.assertEqual(result['mem_available'], 200000000 * 1024)
+
+    def test_local(self):
+        """The probe command also works on a host without GPUs"""
+        import subprocess
+        result = parse_probe(subprocess.run(['sh', '-c', get_probe_cmd(timeout=5)], capture_output=True,
+                                            text=True, check=True).stdout)
+        self.assertEqual(result['gpus'], [])
+        self.assertGreater(result['ncpus'], 0)
+        self.assertGreater(result['mem_total'], 0)
+
+    def test_nvidia_smi_failure(self):
+        """A GPU machine whose nvidia-smi hangs is reported as a failure, not as a CPU machine"""
+        from argparse import Namespace
+        import rmx.machine
+        from rmx.cli._probe import probe
+
+        class FakeClient:
+            def __init__(self, remote_conf):
+                pass
+
+            def run(self, cmd, **kwargs):
+                FakeClient.kwargs = kwargs
+                stdout = 'rmx-gpu\nrmx-smi\n124\n' + OUTPUT[OUTPUT.index('rmx-cpu'):]
+                return Namespace(stdout=stdout, stderr='', exited=0)
+
+        _client, rmx.machine.SimpleSSHClient = rmx.machine.SimpleSSHClient, FakeClient
+        try:
+            result = probe(Namespace(name='gpu', remote_conf=None), timeout=5)
+        finally:
+            rmx.machine.SimpleSSHClient = _client
+        self.assertIn('timed out', result['error'])
+        self.assertEqual(get_capacity(result), 0)
+        # The timeout is given to the call rather than set on the shared connection
+        self.assertEqual(FakeClient.kwargs['timeout'], 15)
+
+    def test_cache(self):
+        cache = ProbeCache(':memory:', ttl=30.)
+        cache.put({'a': {'gpus': [], 'probed_at': 0.}, 'b': {'gpus': []}})
+        self.assertEqual(list(cache.get(['a', 'b', 'c'])), ['b'])
+        cache.ttl = 0
+        self.assertEqual(cache.get(['a', 'b', 'c']), {})
+
+
+class TestDistribute(unittest.TestCase):
+    def test_capacity(self):
+        result = {**parse_probe(OUTPUT), 'error': None}
+        self.assertEqual(get_capacity(result), 2)
+        self.assertEqual(get_capacity({**result, 'gpus': []}), 51)
+        self.assertEqual(get_capacity({**result, 'error': 'timed out'}), 0)
+
+    def test_fit(self):
+        # Enough room: proportional to the free capacity, in contiguous shares
+        shares = distribute_sweep(range(6), {'a': 4, 'b': 0, 'c': 8}, overflow=['slurm'])
+        self.assertEqual(shares, {'a': [0, 1], 'c': [2, 3, 4, 5]})
+
+    def test_overflow(self):
+        shares = distribute_sweep(range(20), {'a': 4, 'b': 2}, overflow=['s1', 's2'])
+        self.assertEqual({name: len(share) for name, share in shares.items()}, {'a': 4, 'b': 2, 's1': 7, 's2': 7})
+        self.assertEqual(sorted(sum(shares.values(), [])), list(range(20)))
+
+        # Without slurm machines, the rest is spread by capacity, or evenly if nothing is free
+        self.assertEqual({name: len(share) for name, share in distribute_sweep(range(12), {'a': 4, 'b': 2}).items()},
+                         {'a': 8, 'b': 4})
+        self.assertEqual(distribute_sweep([3, 5, 7], {'a': 0, 'b': 0}), {'a': [3, 5], 'b': [7]})
+
+
+if __name__ == '__main__':
+    unittest.main()
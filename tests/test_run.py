@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import unittest
+from argparse import Namespace
+from pathlib import Path
+from rmx.cli.run import get_stage_key_cmd, parse_sweep_idx, parse_sweep_throttle, stage_to_node
+from rmx.config import SlurmConfig
+from rmx.runner import SlurmRunner, parse_sbatch_output, to_slurm_array
+
+
+class FakeClient:
+    """Pretends to run the batch script: every sbatch succeeds except for the ones listed in fail."""
+    def __init__(self, fail=()):
+        self.cmds = []
+        self.fail = fail
+
+    def run(self, cmd, **kwargs):
+        self.cmds.append(cmd)
+        num_jobs = cmd.count('sbatch --parsable')
+        lines = [f'rmx-sbatch {idx} FAILED' if idx in self.fail else f'rmx-sbatch {idx} {8156833 + idx};cluster'
+                 for idx in range(num_jobs)]
+        return Namespace(stdout='\n'.join(lines) + '\n', stderr='')
+
+
+class TestSweep(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(list(parse_sweep_idx('0-4%2')), [0, 1, 2, 3])
+        self.assertEqual(parse_sweep_throttle('0-4%2'), 2)
+        self.assertIsNone(parse_sweep_throttle('0-4'))
+        with self.assertRaises(KeyError):
+            parse_sweep_throttle('0-4%x')
+
+    def test_slurm_array(self):
+        self.assertEqual(to_slurm_array(range(0, 256)), '0-255')
+        self.assertEqual(to_slurm_array([7, 0, 1, 2, 5, 8], throttle=4), '0-2,5,7-8%4')
+
+    def test_array_submission(self):
+        client = FakeClient()
+        rmxdirs = Namespace(codedir='/tmp/rmx/code', mountdir='/tmp/rmx/mount', outdir='/tmp/rmx/output')
+        jobs = SlurmRunner(client, rmxdirs).exec('python train.py --seed $RMX_RUN_SWEEP_IDX', Path('.'),
+                                                 SlurmConfig('job'), sweep_ind=list(range(256)), throttle=16)
+        self.assertEqual(len(jobs), 256)
+        self.assertEqual((jobs[5].jobid, jobs[5].sweep_idx, jobs[5].seq_idx), ('8156833_5', 5, 0))
+        self.assertEqual(len(client.cmds), 1)
+        self.assertIn('#SBATCH --array               0-255%16', client.cmds[0])
+        self.assertIn('export RMX_RUN_SWEEP_IDX=\\$SLURM_ARRAY_TASK_ID', client.cmds[0])
+
+
+    def test_batched_submission(self):
+        """All sequential jobs are submitted in one round trip, and a failure does not shift the other ids."""
+        client = FakeClient(fail=[1])
+        rmxdirs = Namespace(codedir='/tmp/rmx/code', mountdir='/tmp/rmx/mount', outdir='/tmp/rmx/output')
+        jobs = SlurmRunner(client, rmxdirs).exec('python train.py', Path('.'), SlurmConfig('job'), num_sequence=3,
+                                                 sweep_ind=[0, 1])
+        self.assertEqual(len(client.cmds), 1)
+        self.assertEqual([(job.jobid, job.sweep_idx, job.seq_idx) for job in jobs],
+                         [('8156833_0', 0, 0), ('8156833_1', 1, 0), (None, 0, 1), (None, 1, 1),
+                          ('8156835_0', 0, 2), ('8156835_1', 1, 2)])
+        self.assertIsNotNone(jobs[2].error)
+
+    def test_output_dir(self):
+        """The directory of --output is created in the same round trip as the submission"""
+        client = FakeClient()
+        rmxdirs = Namespace(codedir='/tmp/rmx/code', mountdir='/tmp/rmx/mount', outdir='/tmp/rmx/output')
+        SlurmRunner(client, rmxdirs).exec('python train.py', Path('.'), SlurmConfig('job', output='/tmp/logs/run/%j.log'),
+                                          interactive=False, setup=['export RMX_SIF_KEY=1'])
+        self.assertEqual(len(client.cmds), 1)
+        self.assertTrue(client.cmds[0].startswith('mkdir -p /tmp/logs/run\nexport RMX_SIF_KEY=1\n'))
+
+    def test_parse_sbatch_output(self):
+        stdout = 'some noise\nrmx-sbatch 0 123\nrmx-sbatch 1 FAILED\nrmx-sbatch 2 125;cl\n'
+        self.assertEqual(parse_sbatch_output(stdout), {0: '123', 2: '125'})
+
+
+class TestRunLogdir(unittest.TestCase):
+    def test_unique(self):
+        from rmx.cli.run import _make_run_logdir
+        machine = Namespace(name='birch', get_logdir=lambda project_name: Path('/tmp/rmx/logs') / project_name)
+        options = Namespace(name=None, dry_run=False)
+        logdirs = {_make_run_logdir(Namespace(name='proj'), machine, options) for _ in range(10)}
+        self.assertEqual(len(logdirs), 10)
+        options.name = 'exp'
+        self.assertEqual(_make_run_logdir(Namespace(name='proj'), machine, options), '/tmp/rmx/logs/proj/exp')
+
+
+class TestStaging(unittest.TestCase):
+    def test_stage_to_node(self):
+        import os
+        import subprocess
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'shared', 'image.sif')
+            os.makedirs(os.path.dirname(src))
+            with open(src, 'wb') as f:
+                f.write(os.urandom(1 << 20))
+            stage_dir = os.path.join(tmpdir, 'scratch')
+
+            # Concurrent jobs on the same node share a single copy
+            cmd = stage_to_node('RMX_SIF', src, stage_dir) + ' && cmp "$RMX_SIF" "' + src + '" && echo "$RMX_SIF"'
+            procs = [subprocess.Popen(['sh', '-c', cmd], stdout=subprocess.PIPE) for _ in range(8)]
+            paths = {proc.communicate()[0].decode().strip() for proc in procs}
+            self.assertTrue(all(proc.returncode == 0 for proc in procs))
+            self.assertEqual(len(paths), 1)
+            staged = paths.pop()
+            self.assertEqual(os.path.dirname(staged), stage_dir)
+            self.assertEqual([name for name in os.listdir(stage_dir) if not name.endswith('.lock')],
+                             [os.path.basename(staged)])
+
+            # The key computed at submission is the same as the one the job computes by itself
+            out = subprocess.run(['sh', '-c', f'{get_stage_key_cmd("RMX_SIF", src)} && {cmd}'], capture_output=True)
+            self.assertEqual(out.stdout.decode().strip(), staged)
+
+            # A rewrite with the same size and mtime is staged again
+            st = os.stat(src)
+            with open(src, 'wb') as f:
+                f.write(os.urandom(1 << 20))
+            os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns))
+            out = subprocess.run(['sh', '-c', cmd], capture_output=True)
+            self.assertEqual(out.returncode, 0)
+            self.assertNotEqual(out.stdout.decode().strip(), staged)
+
+            # Falls back to the original file if it cannot be staged
+            out = subprocess.run(['sh', '-c', stage_to_node('RMX_SIF', src, '/proc/rmx') + ' && echo "$RMX_SIF"'],
+                                 capture_output=True)
+            self.assertEqual(out.returncode, 0)
+            self.assertEqual(out.stdout.decode().strip(), src)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+import io
+import threading
+import time
+import unittest
+from argparse import Namespace
+from pathlib import Path
+from rmx.config import DockerContainerConfig
+from rmx.runner import DockerRunner, MultiHostRunner, PrefixedStream, format_host_summary
+
+
+class FakeRunner:
+    def __init__(self, exit_code, delay=0.2):
+        self.exit_code = exit_code
+        self.delay = delay
+
+    def exec(self, cmd, relative_workdir, env=None, startup='', dry_run=False, **run_kwargs):
+        if self.exit_code is None:
+            raise ConnectionError('unreachable')
+        run_kwargs['out_stream'].write(f'{cmd} {env["HOST"]}\nno newline')
+        time.sleep(self.delay)
+        return Namespace(exited=self.exit_code)
+
+
+class TestMultiHostRunner(unittest.TestCase):
+    def test_prefixed_stream(self):
+        out = io.StringIO()
+        stream = PrefixedStream('[a] ', out, threading.Lock())
+        stream.write('hel')
+        self.assertEqual(out.getvalue(), '')
+        stream.write('lo\r\nwor')
+        stream.write('ld\n')
+        self.assertEqual(out.getvalue(), '[a] hello\n[a] world\n')
+
+    def test_concurrent(self):
+        names = [f'host{idx}' for idx in range(8)]
+        runners = {name: FakeRunner(exit_code=idx % 2) for idx, name in enumerate(names)}
+        runners['down'] = FakeRunner(exit_code=None)
+        out, err = io.StringIO(), io.StringIO()
+
+        start = time.time()
+        results = MultiHostRunner(runners).exec('echo', '.', envs={name: {'HOST': name} for name in runners},
+                                                out=out, err=err)
+        self.assertLess(time.time() - start, 1.0)
+
+        self.assertEqual([result.name for result in results], names + ['down'])
+        self.assertEqual([result.exit_code for result in results], [0, 1] * 4 + [None])
+        self.assertIn('[host3] echo host3\n', out.getvalue())
+        self.assertIn('[host3] no newline\n', out.getvalue())
+        self.assertIn('[down ] ConnectionError: unreachable\n', err.getvalue())
+        self.assertIn('ERROR', format_host_summary(results))
+
+
+class FakeContainer:
+    def __init__(self, name, removed, events=None):
+        self.name = name
+        self._removed = removed
+        self.events = [] if events is None else events
+
+    def remove(self, force=False):
+        self._removed.append(self.name)
+
+    attrs = {'Config': {'Tty': True}}
+
+    def attach_socket(self, params=None):
+        import socket
+        self.events.append('attach')
+        self._sock, sock = socket.socketpair()
+        return sock
+
+    def start(self):
+        self.events.append('start')
+        # The output is only produced once the container starts
+        if 'attach' in self.events:
+            self._sock.sendall(b'hello\nwor')
+            self._sock.sendall(b'ld\n')
+            self._sock.close()
+
+
+class FakeContainers:
+    def __init__(self, existing):
+        self.existing = existing
+        self.removed, self.launched, self.list_calls = [], [], 0
+
+    def list(self, all=False, filters=None):
+        self.list_calls += 1
+        return [FakeContainer(name, self.removed) for name in self.existing]
+
+    def get(self, name):
+        raise AssertionError('containers.get should not be called for sweeps')
+
+    def create(self, image, cmd, name=None, **kwargs):
+        time.sleep(0.1)
+        if name.endswith('-3'):
+            raise RuntimeError('no such image')
+        self.launched.append((name, kwargs['environment']['RMX_RUN_SWEEP_IDX']))
+        return FakeContainer(name, self.removed)
+
+
+class TestDockerSweep(unittest.TestCase):
+    def test_exec_sweep(self):
+        client = Namespace(containers=FakeContainers(existing=['job-1', 'job-10', 'other']))
+        rmxdirs = Namespace(codedir='/rmx/code', mountdir='/rmx/mount', outdir='/rmx/output')
+        confs = [DockerContainerConfig('image', f'job-{idx}', env={'RMX_RUN_SWEEP_IDX': idx}, use_gpus=False)
+                 for idx in range(1, 9)]
+
+        start = time.time()
+        results = DockerRunner(client, rmxdirs).exec_sweep('python train.py', Path('.'), confs, max_workers=8)
+        self.assertLess(time.time() - start, 0.5)
+
+        self.assertEqual(client.containers.list_calls, 1)
+        self.assertEqual(client.containers.removed, ['job-1'])
+        self.assertEqual([result.name for result in results], [f'job-{idx}' for idx in range(1, 9)])
+        self.assertEqual([idx for idx, result in enumerate(results, 1) if result.error is not None], [3])
+        self.assertEqual(sorted(client.containers.launched), [(f'job-{idx}', str(idx)) for idx in range(1, 9) if idx != 3])
+
+    def test_no_force(self):
+        client = Namespace(containers=FakeContainers(existing=['job-1']))
+        rmxdirs = Namespace(codedir='/rmx/code', mountdir='/rmx/mount', outdir='/rmx/output')
+        confs = [DockerContainerConfig('image', f'job-{idx}', env={'RMX_RUN_SWEEP_IDX': idx}, use_gpus=False)
+                 for idx in range(1, 3)]
+        results = DockerRunner(client, rmxdirs).exec_sweep('ls', Path('.'), confs, kill_existing_container=False)
+        self.assertIsNotNone(results[0].error)
+        self.assertIsNone(results[1].error)
+        self.assertEqual(client.containers.removed, [])
+
+
+    def test_attach_before_start(self):
+        import contextlib
+        containers = FakeContainers(existing=[])
+        client = Namespace(containers=containers)
+        rmxdirs = Namespace(codedir=Path('/rmx/code'), mountdir='/rmx/mount', outdir='/rmx/output')
+        conf = DockerContainerConfig('image', 'job', use_gpus=False)
+        events, cmds = [], []
+
+        def _create(image, cmd, name=None, **kwargs):
+            cmds.append(cmd)
+            return FakeContainer(name, [], events)
+        containers.create = _create
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            DockerRunner(client, rmxdirs).exec('echo hello', Path('.'), conf, kill_existing_container=False,
+                                               interactive=False, quiet=False)
+        self.assertEqual(events, ['attach', 'start'])
+        self.assertEqual(out.getvalue(), 'hello\nworld\n')
+        # Output permissions are handled by umask rather than a recursive chmod afterwards
+        self.assertEqual(cmds, ["/bin/bash -c 'umask 000 && echo hello'"])
+
+    def test_exit_code_file(self):
+        """With log_path, the output and the exit code of the command survive the (auto-removed) container"""
+        import os
+        import subprocess
+        import tempfile
+        containers = FakeContainers(existing=[])
+        client = Namespace(containers=containers)
+        rmxdirs = Namespace(codedir=Path('/rmx/code'), mountdir='/rmx/mount', outdir='/rmx/output')
+        cmds = []
+
+        def _create(image, cmd, name=None, **kwargs):
+            cmds.append(cmd)
+            return FakeContainer(name, [], [])
+        containers.create = _create
+        with tempfile.TemporaryDirectory() as logdir:
+            log_path = os.path.join(logdir, '0.log')
+            conf = DockerContainerConfig('image', 'job', use_gpus=False, log_path=log_path)
+            DockerRunner(client, rmxdirs).exec('echo hello && exit 3', Path('.'), conf, kill_existing_container=False,
+                                               interactive=False, quiet=True)
+            out = subprocess.run(cmds[0], shell=True, capture_output=True, text=True)
+            self.assertEqual(out.returncode, 3)
+            with open(log_path) as f:
+                self.assertEqual(f.read(), 'hello\n')
+            with open(log_path + '.exit') as f:
+                self.assertEqual(f.read(), '3\n')
+
+
+class TestSSHRunner(unittest.TestCase):
+    def test_log_path(self):
+        class FakeClient:
+            def run(self, cmd, **kwargs):
+                self.cmd, self.kwargs = cmd, kwargs
+
+        from rmx.runner import SSHRunner
+        client = FakeClient()
+        rmxdirs = Namespace(codedir=Path('/rmx/code'), mountdir='/rmx/mount', outdir='/rmx/output')
+        SSHRunner(client, rmxdirs).exec('python train.py', Path('.'), disown=True, log_path='/rmx/logs/run/out.log')
+        self.assertEqual(client.cmd, 'mkdir -p /rmx/logs/run && { python train.py ; } >> /rmx/logs/run/out.log 2>&1')
+        self.assertEqual(client.kwargs['env']['RMX_USER_COMMAND'], 'python train.py')
+
+
+class FakeImages:
+    def __init__(self, existing):
+        self.existing = set(existing)
+        self.pulled = []
+
+    def get(self, image):
+        from docker.errors import ImageNotFound
+        if image not in self.existing:
+            raise ImageNotFound(image)
+
+    def pull(self, image):
+        self.pulled.append(image)
+        self.existing.add(image)
+
+
+class TestImagePrefetch(unittest.TestCase):
+    def test_get_preset_images(self):
+        from rmx.cli._docker import get_preset_images
+        preset = {'docker-images': {'mltools': {'name': 'takumaynd/mltools'}, 'plain': 'ubuntu:22.04'}}
+        self.assertEqual(get_preset_images(preset), ['takumaynd/mltools', 'ubuntu:22.04'])
+
+    def test_pulls_only_missing_images(self):
+        from unittest import mock
+        from rmx.cli import _docker
+        images = FakeImages(['ubuntu:22.04'])
+        client = Namespace(images=images)
+        machine = Namespace(name='birch')
+        with mock.patch.object(_docker, 'get_docker_client', return_value=(client, 'unix://fake')):
+            future = _docker.prefetch_images(machine, ['ubuntu:22.04', 'takumaynd/mltools', 'takumaynd/mltools'])
+            _docker.wait_prefetch(future)
+        self.assertEqual(future.result(), ['takumaynd/mltools'])
+        self.assertEqual(images.pulled, ['takumaynd/mltools'])
+
+
+if __name__ == '__main__':
+    unittest.main()
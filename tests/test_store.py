@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import unittest
+from rmx.helpers import parse_sacct
+from rmx.store import JobStore, LaunchHistory
+
+HEADER = 'JobID|JobName|State|ExitCode|NodeList|Elapsed|Submit|Start|End|MaxRSS'
+
+
+def sacct_output(now, rows):
+    return [f'rmx-now {now}', HEADER, *rows]
+
+
+class TestJobStore(unittest.TestCase):
+    def test_parse_sacct(self):
+        entries = parse_sacct('\n'.join([
+            'JobID|JobName|State|MaxRSS',
+            '8231686|rmx-a|COMPLETED|',
+            '8231686.batch|batch|COMPLETED|64844148K',
+            '8231686.extern|extern|COMPLETED|1024K',
+            '8231687|rmx-b|RUNNING|',
+        ]))
+        self.assertEqual([(e['JobID'], e['MaxRSS']) for e in entries], [('8231686', '64844148K'), ('8231687', '')])
+
+    def test_incremental_update(self):
+        store = JobStore(':memory:')
+        self.assertIn("40 hours ago", store.get_refresh_cmd('slurm'))
+        store.update('slurm', sacct_output('2024-01-02T00:00:00', [
+            '100|u-rmx-proj|RUNNING|0:0|n1|00:01:00|2024-01-01T00:00:00|2024-01-01T00:00:01|Unknown|',
+            '101_[0-9%2]|u-rmx-proj|PENDING|0:0|None assigned|00:00:00|2024-01-01T00:00:00|Unknown|Unknown|',
+            '200|other|COMPLETED|0:0|n2|00:00:10|2024-01-01T00:00:00|2024-01-01T00:00:01|2024-01-01T00:00:11|',
+        ]))
+        # The next refresh only asks for the jobs since the last one (on the clock of the remote)
+        self.assertIn('--starttime 2024-01-02T00:00:00', store.get_refresh_cmd('slurm'))
+        self.assertIn('40 hours ago', store.get_refresh_cmd('another'))
+
+        store.update('slurm', sacct_output('2024-01-02T00:01:00', [
+            '100|u-rmx-proj|COMPLETED|0:0|n1|00:02:00|2024-01-01T00:00:00|2024-01-01T00:00:01|2024-01-01T00:02:01|',
+            '100.batch|batch|COMPLETED|0:0|n1|00:02:00|2024-01-01T00:00:00|2024-01-01T00:00:01|2024-01-01T00:02:01|2G',
+            '101_0|u-rmx-proj|RUNNING|0:0|n3|00:00:10|2024-01-01T00:00:00|2024-01-01T00:01:50|Unknown|',
+            '101_[1-9%2]|u-rmx-proj|PENDING|0:0|None assigned|00:00:00|2024-01-01T00:00:00|Unknown|Unknown|',
+        ]))
+        jobs = {job['jobid']: job for job in store.query('slurm', name='u-rmx-proj')}
+        self.assertEqual(sorted(jobs), ['100', '101_0', '101_[1-9%2]'])
+        self.assertEqual(jobs['100']['state'], 'COMPLETED')
+        self.assertEqual(jobs['100']['max_rss'], 2 << 30)
+        self.assertIsNone(jobs['101_0']['end'])
+        self.assertEqual(store.count_states('slurm'), {'COMPLETED': 2, 'RUNNING': 1, 'PENDING': 1})
+        self.assertEqual([job['jobid'] for job in store.query('slurm', states=['RUNNING', 'PENDING'])],
+                         ['101_[1-9%2]', '101_0'])
+
+
+class TestLaunchHistory(unittest.TestCase):
+    def test_log_and_query(self):
+        import os
+        import tempfile
+        import threading
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'launches.sqlite')
+
+            # Concurrent rmx processes append to the same history
+            def _launch(idx):
+                LaunchHistory(path).log([{'project': 'proj', 'machine': f'm{idx % 2}', 'mode': 'slurm', 'name': 'sweep',
+                                          'sweep_idx': i, 'jobid': f'{idx}_{i}'} for i in range(10)])
+            threads = [threading.Thread(target=_launch, args=(idx,)) for idx in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            history = LaunchHistory(path)
+            self.assertEqual(len(history.query(project='proj')), 80)
+            self.assertEqual(len(history.query(machine='m0', sweep_idx=3)), 4)
+            self.assertEqual(history.query(mode='docker'), [])
+
+            latest = history.latest(project='proj', machine='m1')
+            self.assertEqual(len(latest), 10)
+            self.assertEqual(len({entry['launch_id'] for entry in latest}), 1)
+
+            # Old entries are dropped when new ones are logged
+            history.log([{'project': 'proj', 'timestamp': 0.}])
+            self.assertEqual(len(history.query(until=1.)), 0)
+            history.retention = None
+            history.log([{'project': 'proj', 'timestamp': 0.}])
+            self.assertEqual(len(history.query(until=1.)), 1)
+
+    def test_get(self):
+        history = LaunchHistory(':memory:')
+        history.log([{'machine': 'm0', 'jobid': 'job-0', 'logdir': '/old', 'timestamp': 1.}])
+        history.log([{'machine': 'm0', 'jobid': f'job-{i}', 'logdir': '/new', 'sweep_idx': i} for i in range(2)])
+        history.log([{'machine': 'm1', 'jobid': 'job-2'}])
+        launches = history.get('m0', ['job-0', 'job-1', 'job-2'])
+        self.assertEqual(sorted(launches), ['job-0', 'job-1'])
+        self.assertEqual(launches['job-0']['logdir'], '/new')
+        self.assertEqual(launches['job-1']['sweep_idx'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
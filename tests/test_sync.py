@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import unittest
+from argparse import Namespace
+from rmx.cli._sync_engine import TarTask, get_tar_compression, parse_rsync_stats, run_sync_tasks, shard_files
+from rmx.cli._tuning import choose_compression, compression_options
+
+RSYNC_STATS = """
+Number of files: 1,024 (reg: 1,000, dir: 24)
+Number of created files: 3 (reg: 3)
+Number of deleted files: 0
+Number of regular files transferred: 3
+Total file size: 12,345,678 bytes
+Total transferred file size: 4,096 bytes
+Literal data: 4,096 bytes
+Matched data: 0 bytes
+File list size: 0
+Total bytes sent: 5,120
+Total bytes received: 96
+
+sent 5,120 bytes  received 96 bytes  10,432.00 bytes/sec
+total size is 12,345,678  speedup is 2,366.89
+"""
+
+
+class TestRsyncStats(unittest.TestCase):
+    def test_parse(self):
+        stats = parse_rsync_stats(RSYNC_STATS)
+        self.assertEqual(stats['num_files'], 1024)
+        self.assertEqual(stats['files_transferred'], 3)
+        self.assertEqual(stats['total_size'], 12345678)
+        self.assertEqual(stats['bytes_sent'], 5120)
+        self.assertEqual(stats['bytes_received'], 96)
+
+    def test_parse_empty(self):
+        self.assertEqual(parse_rsync_stats('')['bytes_sent'], 0)
+
+
+class TestShardFiles(unittest.TestCase):
+    def test_balanced(self):
+        sizes = {'a': 100, 'b': 60, 'c': 40, 'd': 1}
+        shards = shard_files(list(sizes), sizes, 2)
+        self.assertEqual(len(shards), 2)
+        self.assertEqual(sorted(p for shard in shards for p in shard), ['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(shards), [['a', 'd'], ['b', 'c']])
+
+    def test_more_shards_than_files(self):
+        self.assertEqual(shard_files(['a'], {}, 8), [['a']])
+
+
+class LocalClient:
+    """Runs the "remote" commands locally with sh"""
+    def __init__(self, commands=('gzip',)):
+        import uuid
+        # NOTE: a unique host, as the compressors of each host are cached
+        self.remote_conf = Namespace(base_uri=f'local-{uuid.uuid4().hex}')
+        self.commands = commands
+
+    def run(self, cmd, **kwargs):
+        return Namespace(stdout='\n'.join(self.commands), stderr='', exited=0)
+
+    def pipe(self, cmd, in_stream):
+        import subprocess
+        out = subprocess.run(['sh', '-c', cmd], stdin=in_stream, capture_output=True)
+        return out.returncode, 0, out.stderr.decode()
+
+
+class TestTar(unittest.TestCase):
+    def test_compression(self):
+        # The remote does not have zstd
+        self.assertEqual(get_tar_compression(LocalClient(['gzip'])), 'gzip')
+        self.assertEqual(get_tar_compression(LocalClient(['gzip']), preferred='zstd'), 'gzip')
+        self.assertIsNone(get_tar_compression(LocalClient([])))
+
+    def test_transfer(self):
+        import tempfile
+        from pathlib import Path
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src, dst = Path(tmpdir) / 'src', Path(tmpdir) / 'remote'
+            (src / 'sub').mkdir(parents=True)
+            (src / 'sub' / 'a.txt').write_text('hello')
+            (src / 'empty').mkdir()
+            (src / 'ignored').mkdir()
+            (src / 'ignored' / 'big.bin').write_text('ignored')
+            task = TarTask(LocalClient(), src, str(dst / 'code'), 'code', files=['sub/a.txt', 'empty/', 'ignored/'],
+                           transfer_rootdir=False, compression='gzip', remote_dirs=[str(dst / 'output')])
+            task.run()
+            self.assertEqual((dst / 'code' / 'sub' / 'a.txt').read_text(), 'hello')
+            # The directories in the list are created without their content
+            self.assertTrue((dst / 'code' / 'empty').is_dir())
+            self.assertEqual(list((dst / 'code' / 'ignored').iterdir()), [])
+            # The other directories are created like the rsync streams do
+            self.assertTrue((dst / 'output').is_dir())
+
+            # A lot of warnings from tar (missing files) do not block it
+            task = TarTask(LocalClient(), src, str(dst / 'code'), 'code', compression='gzip',
+                           files=[f'missing-{i:05d}-{"x" * 100}' for i in range(2000)], transfer_rootdir=False)
+            with self.assertRaises(OSError):
+                task.run()
+
+
+    def test_connection_lost(self):
+        """Transport errors are reported like the other failures, after all the streams finish"""
+        import tempfile
+        from pathlib import Path
+
+        class BrokenClient(LocalClient):
+            def pipe(self, cmd, in_stream):
+                in_stream.read(1)
+                raise EOFError('connection closed')
+
+        class Done:
+            label, transport, done = 'other', 'rsync', False
+
+            def run(self, dry_run):
+                self.done = True
+                return {'files_transferred': 1}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = Path(tmpdir)
+            (src / 'a.txt').write_text('hello')
+            task = TarTask(BrokenClient(), src, '/nonexistent', 'code', files=['a.txt'], transfer_rootdir=False,
+                           compression='gzip')
+            other = Done()
+            with self.assertRaises(OSError) as cm:
+                run_sync_tasks([task, other], max_workers=2)
+        self.assertIn('EOFError', str(cm.exception))
+        self.assertTrue(other.done)
+
+
+class TestOutputWatcher(unittest.TestCase):
+    def test_wait(self):
+        import rmx.cli.sync as sync
+        pulls, checks = [], []
+        _pull_output, sync._pull_output = sync._pull_output, lambda *args, **kwargs: pulls.append(1) or {}
+        try:
+            # Without outdir, nothing is pulled and wait returns right away
+            watcher = sync.OutputWatcher(Namespace(outdir=None), Namespace(name='m'), interval=0.01)
+            watcher.start()
+            watcher.wait()
+            self.assertEqual(pulls, [])
+
+            # Stops once the job has finished
+            watcher = sync.OutputWatcher(Namespace(outdir='/tmp/out'), Namespace(name='m'), interval=0.01)
+            watcher.start()
+            watcher.wait(done=lambda: checks.append(1) or len(checks) >= 3)
+            self.assertEqual(len(checks), 3)
+            self.assertGreater(len(pulls), 0)
+        finally:
+            sync._pull_output = _pull_output
+
+
+class TestSentinel(unittest.TestCase):
+    def test_check(self):
+        import os
+        import subprocess
+        import tempfile
+        import rmx.cli.sync as sync
+        from rmx.manifest import SyncManifest
+
+        class ShellClient:
+            def run(self, cmd, **kwargs):
+                out = subprocess.run(['sh', '-c', cmd], capture_output=True, text=True)
+                return Namespace(stdout=out.stdout, stderr=out.stderr, exited=out.returncode)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            client = ShellClient()
+            sources = []
+            for name in ['code', 'mount']:
+                os.makedirs(os.path.join(tmpdir, name))
+                source = Namespace(target_path=os.path.join(tmpdir, name), manifest=SyncManifest(
+                    os.path.join(tmpdir, 'manifests', f'{name}.json')))
+                source.manifest.save({'a.py': [1, 0, 'x']})
+                sources.append(source)
+            # Synced before the sentinels existed
+            self.assertEqual(sync._check_sentinels(client, sources), sources)
+
+            sync._write_sentinels(client, sources)
+            self.assertEqual(sync._check_sentinels(client, sources), [])
+
+            # The remote copy was wiped
+            os.remove(sync._sentinel_path(sources[1]))
+            self.assertEqual(sync._check_sentinels(client, sources), [sources[1]])
+
+
+class TestCompression(unittest.TestCase):
+    def test_choose(self):
+        mb = 1024 * 1024
+        # LAN: faster than we can compress
+        self.assertEqual(choose_compression({'link_rate': 500 * mb, 'compress_rate': 100 * mb, 'zstd': True}), 'none')
+        self.assertEqual(choose_compression({'link_rate': 50 * mb, 'compress_rate': 100 * mb, 'zstd': True}), 'zstd:1')
+        self.assertEqual(choose_compression({'link_rate': 1 * mb, 'compress_rate': 100 * mb, 'zstd': True}), 'zstd:3')
+        self.assertEqual(choose_compression({'link_rate': 1 * mb, 'compress_rate': 100 * mb, 'zstd': False}), 'zlib')
+
+    def test_options(self):
+        self.assertEqual(compression_options('none'), '')
+        self.assertIn('--compress-choice=zstd --compress-level=3', compression_options('zstd:3', (3, 2, 7)))
+        self.assertIn('npz', compression_options('zlib', (3, 2, 7)))
+        with self.assertRaises(ValueError):
+            compression_options('lzma')
+
+    def test_old_rsync(self):
+        # e.g., rsync 2.6.9 on macOS does not know --skip-compress nor --compress-choice
+        self.assertEqual(compression_options('zlib', (2, 6, 9)), '--compress')
+        self.assertEqual(compression_options('zstd:3', (2, 6, 9)), '--compress')
+        self.assertNotIn('--compress-choice', compression_options('zstd:3', (3, 1, 3)))
+        self.assertIn('--skip-compress', compression_options('zstd:3', (3, 1, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import unittest
+from argparse import Namespace
+from rmx.cli.wait import DockerWaiter, SlurmWaiter, expand_array, parse_squeue, wait
+from rmx.store import JobStore
+
+HEADER = 'JobID|JobName|State|ExitCode|NodeList|Elapsed|Submit|Start|End|MaxRSS'
+
+
+def sacct_row(jobid, state):
+    return f'{jobid}|u-rmx-proj|{state}|0:0|n1|00:01:00|2024-01-01T00:00:00|2024-01-01T00:00:01|Unknown|'
+
+
+class FakeCluster:
+    """Each tick, some jobs leave the queue. Records the commands to check that each poll is a single squeue call."""
+    def __init__(self, queue, final):
+        self.queue = queue  # list of squeue outputs, one per poll
+        self.final = final  # {jobid: state} in sacct
+        self.cmds = []
+
+    def run(self, cmd, **kwargs):
+        self.cmds.append(cmd)
+        if cmd.startswith('squeue'):
+            stdout = self.queue.pop(0) if len(self.queue) > 1 else self.queue[0]
+        else:
+            stdout = '\n'.join(['rmx-now 2024-01-02T00:00:00', HEADER,
+                                *[sacct_row(jobid, state) for jobid, state in self.final.items()]])
+        return Namespace(stdout=stdout, stderr='', exited=0)
+
+
+class TestWait(unittest.TestCase):
+    def test_parse_squeue(self):
+        self.assertEqual(expand_array('123_[0-3,7%2]'), ['123_0', '123_1', '123_2', '123_3', '123_7'])
+        self.assertEqual(expand_array('123_4'), ['123_4'])
+        self.assertEqual(parse_squeue('123_[2-3]|PENDING\n123_1|RUNNING\n124|RUNNING\n'),
+                         {'123_2': 'PENDING', '123_3': 'PENDING', '123_1': 'RUNNING', '124': 'RUNNING'})
+
+    def test_slurm(self):
+        import time
+        cluster = FakeCluster(
+            queue=['100_[1-2]|PENDING\n100_0|RUNNING\n101|RUNNING', '100_2|RUNNING\n101|RUNNING', ''],
+            final={'100_0': 'COMPLETED', '100_1': 'COMPLETED', '100_2': 'FAILED', '101': 'COMPLETED'})
+        waiter = SlurmWaiter(Namespace(name='slurm'), ['100_0', '100_1', '100_2', '101'], client=cluster)
+        sleeps = []
+        time_sleep, time.sleep = time.sleep, sleeps.append
+        try:
+            self.assertTrue(wait([waiter], interval=1., max_interval=60., store=JobStore(':memory:')))
+        finally:
+            time.sleep = time_sleep
+        self.assertEqual(waiter.states, {'100_0': 'COMPLETED', '100_1': 'COMPLETED', '100_2': 'FAILED',
+                                         '101': 'COMPLETED'})
+        self.assertEqual(sum(cmd.startswith('squeue') for cmd in cluster.cmds), 3)
+        # Nothing finished at the first poll, then some jobs did at the second one
+        self.assertEqual(sleeps, [1.5, 1.])
+
+    def test_backoff(self):
+        import time
+        cluster = FakeCluster(queue=['101|RUNNING'] * 5 + [''], final={'101': 'CANCELLED'})
+        waiter = SlurmWaiter(Namespace(name='slurm'), ['101'], client=cluster)
+        sleeps = []
+        time_sleep, time.sleep = time.sleep, sleeps.append
+        try:
+            self.assertTrue(wait([waiter], interval=2., max_interval=5., store=JobStore(':memory:')))
+        finally:
+            time.sleep = time_sleep
+        self.assertEqual(sleeps, [3., 4.5, 5., 5., 5.])
+        self.assertEqual(waiter.states, {'101': 'CANCELLED'})
+        # sacct is only queried once the job leaves the queue
+        self.assertEqual(sum(not cmd.startswith('squeue') for cmd in cluster.cmds), 1)
+
+    def test_timeout(self):
+        import time
+        cluster = FakeCluster(queue=['101|RUNNING'], final={})
+        waiter = SlurmWaiter(Namespace(name='slurm'), ['101'], client=cluster)
+        time_sleep, time.sleep = time.sleep, lambda _: None
+        try:
+            self.assertFalse(wait([waiter], interval=0.5, timeout=0.1, store=JobStore(':memory:')))
+        finally:
+            time.sleep = time_sleep
+        self.assertEqual(waiter.pending, {'101'})
+
+    def test_docker(self):
+        import os
+        import subprocess
+        import tempfile
+        import time
+
+        class FakeRunner:
+            """Containers are auto-removed once they exit"""
+            def __init__(self):
+                self.polls = [{'job-0': 'running', 'job-1': 'running', 'job-2': 'running'},
+                              {'job-0': 'running'}, {}]
+
+            def find_containers(self, prefix):
+                statuses = self.polls.pop(0) if len(self.polls) > 1 else self.polls[0]
+                return {name: Namespace(status=status, attrs={'State': {'ExitCode': 0}})
+                        for name, status in statuses.items()}
+
+        class LocalClient:
+            def __init__(self):
+                self.cmds = []
+
+            def run(self, cmd, **kwargs):
+                self.cmds.append(cmd)
+                out = subprocess.run(['sh', '-c', cmd], capture_output=True, text=True)
+                return Namespace(stdout=out.stdout, stderr=out.stderr, exited=out.returncode)
+
+        with tempfile.TemporaryDirectory() as logdir:
+            # job-0 succeeded, job-1 crashed, and job-2 was killed without leaving its exit code
+            for name, code in [('job-0', 0), ('job-1', 3)]:
+                with open(os.path.join(logdir, f'{name}.log.exit'), 'w') as f:
+                    f.write(f'{code}\n')
+            client = LocalClient()
+            waiter = DockerWaiter(Namespace(name='docker'), ['job-0', 'job-1', 'job-2'], runner=FakeRunner(),
+                                  client=client,
+                                  exit_paths={f'job-{i}': os.path.join(logdir, f'job-{i}.log.exit') for i in range(3)})
+            time_sleep, time.sleep = time.sleep, lambda _: None
+            try:
+                self.assertTrue(wait([waiter], interval=1., store=JobStore(':memory:')))
+            finally:
+                time.sleep = time_sleep
+        self.assertEqual(waiter.states, {'job-0': 'COMPLETED', 'job-1': 'FAILED (3)', 'job-2': 'UNKNOWN'})
+        # The exit codes are read once per poll, only for the containers that are done
+        self.assertEqual(len(client.cmds), 2)
+
+    def test_docker_jobs(self):
+        """With --jobs, the exit code files of the containers are found via the launch history"""
+        from unittest import mock
+        from rmx.cli.wait import _get_waiter
+        from rmx.runner import get_exit_path
+        from rmx.cli.run import get_docker_log_path
+        from rmx.store import LaunchHistory
+        history = LaunchHistory(':memory:')
+        history.log([{'machine': 'docker', 'mode': 'docker', 'jobid': f'job-{i}', 'logdir': '/logs', 'sweep_idx': i}
+                     for i in range(2)])
+        machine = Namespace(name='docker', parsed_conf={'mode': 'docker'})
+        with mock.patch('rmx.store.LaunchHistory', return_value=history), \
+                mock.patch('rmx.cli.wait.DockerWaiter') as waiter:
+            _get_waiter(Namespace(name='proj'), machine, Namespace(jobs='job-0,job-1,job-2'))
+        waiter.assert_called_once_with(machine, ['job-0', 'job-1', 'job-2'], exit_paths={
+            f'job-{i}': get_exit_path(get_docker_log_path('/logs', i)) for i in range(2)})
+
+
+if __name__ == '__main__':
+    unittest.main()